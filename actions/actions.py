@@ -0,0 +1,38 @@
+#!/usr/local/sbin/charm-env python3
+
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Run a Juju action.
+
+Each action is a symlink to this script. The actions.<name> state is
+set and the reactive framework run, as for a hook, and the handlers
+for that state do the work.
+"""
+
+import os.path
+import sys
+sys.path.append('lib')
+
+from charms.layer import basic  # noqa
+basic.bootstrap_charm_deps()
+
+from charmhelpers.core import hookenv  # noqa
+hookenv.atstart(basic.init_config_states)
+hookenv.atexit(basic.clear_config_states)
+
+from charms import reactive  # noqa
+reactive.set_state('actions.{}'.format(os.path.basename(sys.argv[0])))
+reactive.main()
@@ -0,0 +1,75 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Deterministic, weighted spreading of load over a set of endpoints.
+
+Orderings are calculated with weighted rendezvous (highest random
+weight) hashing. The same key always produces the same ordering of the
+same endpoints, different keys are spread in proportion to the weights,
+and adding or removing an endpoint only moves the keys that preferred
+it.
+'''
+
+import hashlib
+import math
+import re
+
+
+def parse_weights(spec):
+    '''Parse a 'host=weight, host:port=weight' list into a dictionary.
+
+    >>> sorted(parse_weights('10.0.0.1=2, 10.0.0.2:5433=0').items())
+    [('10.0.0.1', 2.0), ('10.0.0.2:5433', 0.0)]
+    '''
+    weights = {}
+    for item in re.split(r'[,\s]+', spec or ''):
+        if not item:
+            continue
+        endpoint, sep, weight = item.partition('=')
+        try:
+            value = float(weight) if sep else None
+        except ValueError:
+            value = None
+        if value is None or not 0 <= value < float('inf'):
+            raise ValueError('Invalid weight {!r}'.format(item))
+        weights[endpoint.strip()] = value
+    return weights
+
+
+def weight_for(weights, host, port=None):
+    '''Look up the weight of host:port, falling back to host, then 1.'''
+    if port is not None:
+        key = '{}:{}'.format(host, port)
+        if key in weights:
+            return weights[key]
+    return weights.get(host, 1.0)
+
+
+def _score(key, node, weight):
+    digest = hashlib.sha1('{}\0{}'.format(key, node).encode()).digest()
+    # Uniformly distributed in the open interval (0, 1).
+    u = (int.from_bytes(digest[:8], 'big') + 1) / (2 ** 64 + 2)
+    return -weight / math.log(u)
+
+
+def rendezvous_order(key, nodes):
+    '''Order nodes for key.
+
+    nodes is a sequence of (node, weight) tuples, where node is a
+    string. Nodes with a weight of zero or less are dropped.
+    '''
+    scored = [(_score(key, node, weight), node)
+              for node, weight in nodes if weight > 0]
+    return [node for _, node in sorted(scored, reverse=True)]
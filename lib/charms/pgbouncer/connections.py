@@ -0,0 +1,116 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Backend connections shared for the lifetime of a single hook.'''
+
+from collections import Counter
+import threading
+
+from charmhelpers.core import hookenv
+import psycopg2
+import psycopg2.extensions
+
+
+# Statements and round trips made through cached connections.
+stats = Counter()
+_stats_lock = threading.Lock()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    '''A cursor recording its round trips and statements in stats.
+
+    Statements batched into one round trip are counted separately.
+    '''
+    def execute(self, query, vars=None):
+        statements = query.count(b';\n' if isinstance(query, bytes)
+                                 else ';\n') + 1
+        with _stats_lock:
+            stats['round_trips'] += 1
+            stats['statements'] += statements
+        return super(CountingCursor, self).execute(query, vars)
+
+
+class ConnectionCache(object):
+    '''Autocommit psycopg2 connections keyed by connection string.
+
+    A connection is opened on first use and reused for the rest of the
+    hook. close() closes every cached connection; the cache returned by
+    get_cache() arranges for that to happen when the hook exits. The
+    cache may be shared between threads, but each connection should
+    only be used by one thread at a time.
+    '''
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def get(self, dsn):
+        '''Return an open connection to dsn.
+
+        Raises psycopg2.OperationalError if the connection fails.
+        '''
+        with self._lock:
+            con = self._connections.get(dsn)
+            if con is not None and not con.closed:
+                return con
+        # Connect without holding the lock, so threads may connect to
+        # different databases concurrently.
+        con = psycopg2.connect(dsn, cursor_factory=CountingCursor)
+        con.autocommit = True
+        with self._lock:
+            existing = self._connections.get(dsn)
+            if existing is not None and not existing.closed:
+                con.close()
+                return existing
+            self._connections[dsn] = con
+            self.opened += 1
+        with _stats_lock:
+            stats['connections'] += 1
+        return con
+
+    def discard(self, dsn):
+        '''Close and forget the connection to dsn, if any.'''
+        with self._lock:
+            con = self._connections.pop(dsn, None)
+        if con is not None and not con.closed:
+            con.close()
+
+    def close(self):
+        '''Close all cached connections.'''
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for con in connections:
+            if not con.closed:
+                con.close()
+
+
+_cache = None
+
+
+def get_cache():
+    '''Return the ConnectionCache for the current hook.'''
+    global _cache
+    if _cache is None:
+        _cache = ConnectionCache()
+        hookenv.atexit(_close_cache)
+    return _cache
+
+
+def _close_cache():
+    global _cache
+    if _cache is not None:
+        _cache.close()
+        _cache = None
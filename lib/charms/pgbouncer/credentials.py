@@ -0,0 +1,83 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Copy hashed credentials from the backend into userlist.txt.
+
+With auth_user set, pgbouncer looks up users missing from userlist.txt
+with auth_query, a backend round trip for every login. Users whose
+credentials have been copied into userlist.txt are authenticated
+locally instead. Only the stored hashes are copied, MD5 or SCRAM, both
+of which pgbouncer accepts in userlist.txt.
+'''
+
+
+CREDENTIALS_SQL = """
+    SELECT usename::text, passwd::text
+    FROM pg_shadow
+    WHERE
+        passwd IS NOT NULL
+        AND (usename = ANY(%s) OR usename LIKE ANY(%s))
+    """
+
+
+def allowlist(setting):
+    '''Parse the credential_sync_roles option.
+
+    Returns the sorted names and patterns. * matches any characters.
+
+    >>> allowlist('app_*, reporting,,')
+    ['app_*', 'reporting']
+    '''
+    return sorted(set(role.strip() for role in (setting or '').split(',')
+                      if role.strip()))
+
+
+def like_pattern(pattern):
+    r'''Convert a * wildcard pattern to an SQL LIKE pattern.
+
+    >>> print(like_pattern('app_*'))
+    app\_%
+    '''
+    escaped = (pattern.replace('\\', '\\\\').replace('%', '\\%')
+               .replace('_', '\\_'))
+    return escaped.replace('*', '%')
+
+
+def fetch(con, roles, exclude=()):
+    '''Return the hashed passwords of the allowlisted roles.
+
+    Users in exclude, such as those with charm generated passwords,
+    are left out.
+    '''
+    names = [r for r in roles if '*' not in r]
+    patterns = [like_pattern(r) for r in roles if '*' in r]
+    cur = con.cursor()
+    cur.execute(CREDENTIALS_SQL, (names, patterns))
+    exclude = set(exclude)
+    return dict((user, passwd) for user, passwd in cur.fetchall()
+                if user not in exclude)
+
+
+def diff(old, new):
+    '''Return the users added, changed and removed between old and new.
+
+    >>> diff(dict(a='1', b='2', c='3'), dict(b='2', c='4', d='5'))
+    (['d'], ['c'], ['a'])
+    '''
+    added = sorted(set(new) - set(old))
+    removed = sorted(set(old) - set(new))
+    changed = sorted(user for user in set(old) & set(new)
+                     if old[user] != new[user])
+    return added, changed, removed
@@ -0,0 +1,178 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Restart pgbouncer processes without refusing connections.
+
+Processes listening with SO_REUSEPORT share the listen port, so some
+can be restarted while another keeps accepting connections. A spare
+process is started for the duration, and covers while all the others
+are restarted at once.
+
+The processes being restarted are drained rather than killed. SHUTDOWN
+WAIT_FOR_CLIENTS, in pgbouncer 1.23 or later, closes the listening
+socket at once, so new clients go to the processes still listening,
+and exits once the connected clients have disconnected. Older versions
+keep their listening socket while they drain, so are not handed over.
+Processes are stopped once the drain timeout expires. The spare is
+drained last, after the hook, by a systemd timer.
+'''
+
+import subprocess
+import time
+
+from charmhelpers.core import host
+import psycopg2
+
+from charms.pgbouncer.instrumentation import timed_hookenv as hookenv
+
+
+# Seconds to wait for a started process to accept connections.
+START_TIMEOUT = 30
+
+# The transient systemd timer stopping a process drained after the hook.
+STOP_UNIT = 'pgbouncer-drain-{}'
+
+
+def _admin(dsn, sql):
+    con = psycopg2.connect(dsn)
+    try:
+        con.autocommit = True
+        cur = con.cursor()
+        cur.execute(sql)
+        return cur.fetchall() if cur.description else None
+    finally:
+        con.close()
+
+
+def accepting(dsn):
+    '''Return True if the pgbouncer admin console at dsn answers.'''
+    try:
+        _admin(dsn, 'SHOW VERSION')
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def reuseport_enabled(dsn):
+    '''Return True if the pgbouncer at dsn is listening with SO_REUSEPORT.
+    '''
+    try:
+        rows = _admin(dsn, 'SHOW CONFIG')
+    except psycopg2.Error:
+        return False
+    return any(row[0] == 'so_reuseport' and row[1] == '1' for row in rows)
+
+
+def wait_until_accepting(instance, dsn, timeout=START_TIMEOUT):
+    hookenv.status_set('maintenance', 'Waiting for {} to accept '
+                       'connections'.format(instance.service))
+    deadline = time.time() + timeout
+    while not accepting(dsn):
+        if time.time() > deadline:
+            return False
+        time.sleep(1)
+    return True
+
+
+def shutdown(instance, dsn):
+    '''Tell instance to stop listening and exit once its clients leave.
+    '''
+    try:
+        _admin(dsn, 'SHUTDOWN WAIT_FOR_CLIENTS')
+    except psycopg2.Error as x:
+        hookenv.log('SHUTDOWN WAIT_FOR_CLIENTS failed on {}: {}'.format(
+            instance.service, x), hookenv.WARNING)
+        subprocess.call(['systemctl', 'kill', '--signal=SIGINT',
+                         instance.service])
+
+
+def drain(instances, timeout):
+    '''Stop instances once their clients have gone, or timeout expires.
+
+    instances is a list of (instance, dsn) pairs, drained at once.
+    '''
+    draining = [instance for instance, dsn in instances
+                if host.service_running(instance.service)]
+    for instance, dsn in instances:
+        if instance in draining:
+            shutdown(instance, dsn)
+    start = time.time()
+    while True:
+        draining = [instance for instance in draining
+                    if host.service_running(instance.service)]
+        elapsed = time.time() - start
+        if not draining or elapsed > timeout:
+            break
+        hookenv.status_set('maintenance', 'Draining {} processes ({}s of '
+                           '{}s)'.format(len(draining), int(elapsed),
+                                         timeout))
+        time.sleep(1)
+    for instance in draining:
+        hookenv.log('{} not drained after {}s, stopping'
+                    ''.format(instance.service, timeout), hookenv.WARNING)
+    for instance, _ in instances:
+        host.service_stop(instance.service)
+
+
+def _stop_timer(instance):
+    unit = STOP_UNIT.format(instance.index)
+    subprocess.call(['systemctl', 'stop', unit + '.timer', unit + '.service'],
+                    stderr=subprocess.DEVNULL)
+
+
+def drain_later(instance, dsn, timeout):
+    '''Drain instance, stopping it after the hook once timeout expires.
+    '''
+    _stop_timer(instance)
+    shutdown(instance, dsn)
+    subprocess.call(['systemd-run', '--unit',
+                     STOP_UNIT.format(instance.index),
+                     '--on-active={}'.format(timeout),
+                     '/bin/systemctl', 'stop', instance.service])
+
+
+def cancel_drain(instance):
+    '''Cancel a pending drain_later(), stopping instance now.'''
+    _stop_timer(instance)
+    host.service_stop(instance.service)
+
+
+def restart(instances, timeout, spare, spare_dsn):
+    '''Restart instances, draining them while spare accepts connections.
+
+    instances is a list of (instance, dsn) pairs. The spare is started
+    first, and drained in the background once the instances are back.
+    If it fails to start, the instances are restarted normally.
+    Returns False if any instance failed to start.
+    '''
+    hookenv.log('Starting {} to cover restart'.format(spare.service))
+    # A spare still draining from an earlier restart is not listening.
+    cancel_drain(spare)
+    host.service_start(spare.service)
+    if not wait_until_accepting(spare, spare_dsn):
+        hookenv.log('{} failed to start'.format(spare.service),
+                    hookenv.WARNING)
+        host.service_stop(spare.service)
+        return all([host.service_restart(instance.service)
+                    for instance, _ in instances])
+    drain(instances, timeout)
+    for instance, _ in instances:
+        host.service_start(instance.service)
+    started = all([wait_until_accepting(instance, dsn)
+                   for instance, dsn in instances])
+    # If a restart failed, the spare is left running.
+    if started:
+        drain_later(spare, spare_dsn, timeout)
+    return started
@@ -0,0 +1,81 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+
+from psycopg2.extensions import AsIs
+
+
+def pgidentifier(token):
+    '''Wrap a string for interpolation by psycopg2 as an SQL identifier'''
+    return AsIs(quote_identifier(token))
+
+
+def quote_identifier(identifier):
+    r'''Quote an identifier, such as a table or role name.
+
+    In SQL, identifiers are quoted using " rather than ' (which is reserved
+    for strings).
+
+    >>> print(quote_identifier('hello'))
+    "hello"
+
+    Quotes and Unicode are handled if you make use of them in your
+    identifiers.
+
+    >>> print(quote_identifier("'"))
+    "'"
+    >>> print(quote_identifier('"'))
+    """"
+    >>> print(quote_identifier("\\"))
+    "\"
+    >>> print(quote_identifier('\\"'))
+    "\"""
+    >>> print(quote_identifier('\\ aargh \u0441\u043b\u043e\u043d'))
+    U&"\\ aargh \0441\043b\043e\043d"
+    '''
+    try:
+        identifier.encode('ascii')
+        return '"{}"'.format(identifier.replace('"', '""'))
+    except UnicodeEncodeError:
+        escaped = []
+        for c in identifier:
+            if c == '\\':
+                escaped.append(b'\\\\')
+            elif c == '"':
+                escaped.append(b'""')
+            else:
+                c = c.encode('ascii', 'backslashreplace')
+                # Note Python only supports 32 bit unicode, so we use
+                # the 4 hexdigit PostgreSQL syntax (\1234) rather than
+                # the 6 hexdigit format (\+123456).
+                if c.startswith(b'\\u'):
+                    c = b'\\' + c[2:]
+                escaped.append(c)
+        return 'U&"{}"'.format(''.join(s.decode('ascii') for s in escaped))
+
+
+def fingerprint(*values):
+    '''Return a stable hash of JSON serializable values.
+
+    Dictionaries hash the same whatever their ordering, and other
+    objects are hashed by their string representation.
+
+    >>> fingerprint(dict(a=1, b=2)) == fingerprint(dict(b=2, a=1))
+    True
+    '''
+    text = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('UTF-8')).hexdigest()
@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''A bounded on-disk history of pgbouncer pool statistics.
+
+The collector samples SHOW STATS and SHOW POOLS from each local
+pgbouncer process every --interval seconds, summing the processes, and
+appends the values for each database to ring files, one per metric. A
+ring file is a fixed size array of (timestamp, value) slots, written
+through mmap, so disk use depends only on the retention and the number
+of databases, never on uptime. The files of databases no longer
+configured are removed.
+
+The collector runs as a systemd service, from a copy of this file, so
+only the standard library and psycopg2 are used. The password is read
+from the PGPASSWORD environment variable.
+'''
+
+from argparse import ArgumentParser
+from collections import defaultdict
+import mmap
+import os
+import os.path
+import shutil
+import struct
+import sys
+import time
+from urllib.parse import quote, unquote
+
+import psycopg2
+
+
+HISTORY_DIR = '/var/lib/pgbouncer-charm/history'
+
+MAGIC = b'PGBRING1'
+
+# Magic, capacity in slots and the number of samples ever appended.
+HEADER = struct.Struct('<8sQQ')
+
+# Timestamp and value.
+SLOT = struct.Struct('<dd')
+
+# Cumulative totals from SHOW STATS, less their total_ prefix. Times
+# are in microseconds.
+COUNTERS = ['xact_count', 'query_count', 'wait_time', 'xact_time',
+            'query_time']
+
+# Values from SHOW POOLS, summed over users and processes, except
+# maxwait which is the largest.
+GAUGES = ['cl_active', 'cl_waiting', 'sv_active', 'sv_idle', 'maxwait']
+
+PERCENTILES = [50, 95, 99]
+
+
+class Ring(object):
+    '''A ring file of (timestamp, value) samples.
+
+    Opening with a capacity creates the file, or resizes it keeping
+    the most recent samples. Opening without one is read only.
+    '''
+    def __init__(self, path, capacity=None):
+        self.path = path
+        if capacity is not None:
+            self._create(capacity)
+        self._file = open(path, 'rb' if capacity is None else 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0,
+                              access=(mmap.ACCESS_READ if capacity is None
+                                      else mmap.ACCESS_WRITE))
+        magic, self.capacity, _ = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('{} is not a ring file'.format(path))
+
+    def _create(self, capacity):
+        kept = []
+        if os.path.exists(self.path):
+            try:
+                ring = Ring(self.path)
+            except ValueError:
+                ring = None
+            if ring is not None:
+                same = ring.capacity == capacity
+                kept = [] if same else ring.samples()[-capacity:]
+                ring.close()
+                if same:
+                    return
+        tmp = self.path + '.new'
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, capacity, 0))
+            f.truncate(HEADER.size + SLOT.size * capacity)
+        os.rename(tmp, self.path)
+        if kept:
+            ring = Ring(self.path, capacity)
+            for timestamp, value in kept:
+                ring.append(timestamp, value)
+            ring.close()
+
+    @property
+    def count(self):
+        return HEADER.unpack_from(self._map, 0)[2]
+
+    def append(self, timestamp, value):
+        count = self.count
+        SLOT.pack_into(self._map,
+                       HEADER.size + SLOT.size * (count % self.capacity),
+                       timestamp, value)
+        # The slot is written before it is counted, so readers never
+        # see a half written sample.
+        HEADER.pack_into(self._map, 0, MAGIC, self.capacity, count + 1)
+
+    def samples(self, start=0, end=float('inf')):
+        '''Return the samples from start to end, oldest first.'''
+        count = self.count
+        result = []
+        for n in range(max(0, count - self.capacity), count):
+            timestamp, value = SLOT.unpack_from(
+                self._map, HEADER.size + SLOT.size * (n % self.capacity))
+            if start <= timestamp <= end:
+                result.append((timestamp, value))
+        return result
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def capacity(retention, interval):
+    '''The slots needed to keep retention seconds of samples.
+
+    >>> capacity(7 * 24 * 3600, 10)
+    60480
+    '''
+    return max(2, int(retention // interval))
+
+
+def ring_path(directory, database, metric):
+    return os.path.join(directory, quote(database, safe=''),
+                        metric + '.ring')
+
+
+def sample(cons):
+    '''Return the metrics of each database, summed over processes.'''
+    values = defaultdict(lambda: defaultdict(float))
+    for con in cons:
+        cur = con.cursor()
+        cur.execute('SHOW STATS')
+        columns = [d[0] for d in cur.description]
+        for row in cur.fetchall():
+            row = dict(zip(columns, row))
+            for name in COUNTERS:
+                if 'total_' + name in row:
+                    values[row['database']][name] += float(
+                        row['total_' + name])
+        cur.execute('SHOW POOLS')
+        columns = [d[0] for d in cur.description]
+        for row in cur.fetchall():
+            row = dict(zip(columns, row))
+            database = values[row['database']]
+            for name in GAUGES:
+                if name == 'maxwait':
+                    wait = (float(row['maxwait']) +
+                            float(row.get('maxwait_us') or 0) / 1000000)
+                    database[name] = max(database[name], wait)
+                else:
+                    database[name] += float(row[name])
+        cur.close()
+    values.pop('pgbouncer', None)
+    return values
+
+
+class Collector(object):
+    '''Append samples to the ring files in a directory.'''
+    def __init__(self, directory, capacity):
+        self.directory = directory
+        self.capacity = capacity
+        self.rings = {}
+
+    def record(self, timestamp, values):
+        for database, metrics in sorted(values.items()):
+            for metric, value in sorted(metrics.items()):
+                path = ring_path(self.directory, database, metric)
+                if path not in self.rings:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    self.rings[path] = Ring(path, self.capacity)
+                self.rings[path].append(timestamp, value)
+        self.prune(values)
+
+    def prune(self, databases):
+        '''Remove the history of databases no longer configured.'''
+        keep = set(quote(database, safe='') for database in databases)
+        for path in list(self.rings):
+            if os.path.basename(os.path.dirname(path)) not in keep:
+                self.rings.pop(path).close()
+        if not os.path.isdir(self.directory):
+            return
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if name not in keep and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
+
+
+def read(directory, start=0, end=float('inf')):
+    '''Return the samples of each database and metric in a time range.'''
+    history = {}
+    if not os.path.isdir(directory):
+        return history
+    for name in sorted(os.listdir(directory)):
+        metrics = {}
+        for metric in COUNTERS + GAUGES:
+            path = ring_path(directory, unquote(name), metric)
+            if not os.path.exists(path):
+                continue
+            try:
+                ring = Ring(path)
+            except ValueError:
+                continue
+            metrics[metric] = dict(ring.samples(start, end))
+            ring.close()
+        if metrics:
+            history[unquote(name)] = metrics
+    return history
+
+
+def percentile(values, pct):
+    '''The nearest rank percentile of values.
+
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 95)
+    10
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 50)
+    5
+    '''
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def _deltas(series, timestamps):
+    # Counters restart from zero when pgbouncer restarts.
+    deltas = []
+    for previous, current in zip(timestamps, timestamps[1:]):
+        delta = series[current] - series[previous]
+        deltas.append(series[current] if delta < 0 else delta)
+    return deltas
+
+
+def summarise(metrics):
+    '''Compute rates and percentiles for one database's samples.
+
+    Returns a dict of series, each summarised as its mean, percentiles
+    and maximum, and the share of samples with clients waiting.
+
+    >>> s = summarise(dict(xact_count={0: 0, 10: 100, 20: 300},
+    ...                    wait_time={0: 0, 10: 1000, 20: 1000},
+    ...                    cl_waiting={0: 0, 10: 2, 20: 0}))
+    >>> s['tps']['mean'], s['tps']['max'], s['saturation']
+    (15.0, 20.0, 0.333)
+    >>> s['avg_wait_ms']['p99']
+    0.01
+    '''
+    timestamps = sorted(set.intersection(*[set(series)
+                                           for series in metrics.values()]))
+    result = dict(samples=len(timestamps))
+    if not timestamps:
+        return result
+    result.update(start=timestamps[0], end=timestamps[-1])
+    elapsed = [b - a for a, b in zip(timestamps, timestamps[1:])]
+    deltas = dict((name, _deltas(metrics[name], timestamps))
+                  for name in COUNTERS if name in metrics)
+
+    def ratio(numerator, denominator, scale=1.0):
+        return [n * scale / d for n, d in zip(numerator, denominator) if d]
+
+    series = {}
+    if 'xact_count' in deltas:
+        series['tps'] = ratio(deltas['xact_count'], elapsed)
+        if 'wait_time' in deltas:
+            series['avg_wait_ms'] = ratio(deltas['wait_time'],
+                                          deltas['xact_count'], 0.001)
+        if 'xact_time' in deltas:
+            series['avg_xact_ms'] = ratio(deltas['xact_time'],
+                                          deltas['xact_count'], 0.001)
+    if 'query_count' in deltas:
+        series['qps'] = ratio(deltas['query_count'], elapsed)
+        if 'query_time' in deltas:
+            series['avg_query_ms'] = ratio(deltas['query_time'],
+                                           deltas['query_count'], 0.001)
+    for name in GAUGES:
+        if name in metrics:
+            series[name] = [metrics[name][t] for t in timestamps]
+
+    for name, values in series.items():
+        if not values:
+            continue
+        summary = dict(mean=round(sum(values) / len(values), 3),
+                       max=round(max(values), 3))
+        for pct in PERCENTILES:
+            summary['p{}'.format(pct)] = round(percentile(values, pct), 3)
+        result[name] = summary
+    if 'cl_waiting' in metrics:
+        waiting = sum(1 for t in timestamps if metrics['cl_waiting'][t] > 0)
+        result['saturation'] = round(waiting / len(timestamps), 3)
+    if 'tps' in series and elapsed:
+        result['tps']['mean'] = round(
+            sum(deltas['xact_count']) / sum(elapsed), 3)
+    return result
+
+
+def report(history):
+    '''Summarise the history of each database as text.'''
+    columns = ['tps', 'qps', 'avg_wait_ms', 'avg_query_ms', 'cl_waiting',
+               'maxwait']
+    lines = ['{:<30} {:<13} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'database', 'series', 'mean', 'p50', 'p95', 'p99', 'max')]
+    for database, metrics in sorted(history.items()):
+        summary = summarise(metrics)
+        if summary['samples'] < 2:
+            continue
+        for name in columns:
+            if name not in summary:
+                continue
+            s = summary[name]
+            lines.append('{:<30} {:<13} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+                database, name, s['mean'], s['p50'], s['p95'], s['p99'],
+                s['max']))
+        if 'saturation' in summary:
+            lines.append('{:<30} {:<13} {:>9}'.format(
+                database, 'saturation', summary['saturation']))
+    return '\n'.join(lines)
+
+
+def log(msg):
+    sys.stderr.write('{}\n'.format(msg))
+    sys.stderr.flush()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--directory', default=HISTORY_DIR)
+    parser.add_argument('--interval', type=float, default=10,
+                        help='seconds between samples')
+    parser.add_argument('--retention', type=float, default=7 * 24 * 3600,
+                        help='seconds of samples to keep')
+    parser.add_argument('--port', type=int, default=6432,
+                        help='pgbouncer listen port')
+    parser.add_argument('--user', default='nagios')
+    parser.add_argument('--socket-dir', action='append', dest='socket_dirs',
+                        help='unix socket directory of a pgbouncer process. '
+                        'May be repeated.')
+    options = parser.parse_args()
+
+    dsns = ['dbname=pgbouncer host={} port={} user={}'.format(
+        socket_dir, options.port, options.user)
+        for socket_dir in options.socket_dirs or ['/var/run/postgresql']]
+    collector = Collector(options.directory,
+                          capacity(options.retention, options.interval))
+    cons = []
+    while True:
+        next_sample = time.time() + options.interval
+        try:
+            while len(cons) < len(dsns):
+                cons.append(psycopg2.connect(dsns[len(cons)]))
+                cons[-1].autocommit = True
+            collector.record(time.time(), sample(cons))
+        except psycopg2.Error as x:
+            log('Unable to sample pgbouncer: {}'.format(x))
+            for con in cons:
+                con.close()
+            cons = []
+        time.sleep(max(0, next_sample - time.time()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Per-hook timing of handlers, hook tools and backend round trips.
+
+Functions decorated with instrumented(), and blocks run in phase(), are
+timed along with the backend round trips and statements made through
+the ConnectionCache while they run. The charm calls the hook tools
+that shell out to Juju through TimedTools proxies, so their calls and
+time are accounted too, without changing the charmhelpers modules used
+by other layers. When the hook exits, one JSON record is appended to
+HOOK_LOG, which is rotated by size, unless the hook_timings option is
+false.
+'''
+
+from contextlib import contextmanager
+from functools import wraps
+import json
+import logging
+import logging.handlers
+import os.path
+import threading
+import time
+
+from charmhelpers.core import hookenv
+
+from charms.pgbouncer import connections
+
+
+HOOK_LOG = '/var/log/juju/pgbouncer-charm-hooks.log'
+HOOK_LOG_BYTES = 1024 * 1024
+HOOK_LOG_BACKUPS = 4
+
+# (module attribute, hook tool) pairs timed by TimedTools.
+HOOKENV_TOOLS = [('relation_get', 'relation-get'),
+                 ('relation_set', 'relation-set'),
+                 ('relation_ids', 'relation-ids'),
+                 ('related_units', 'relation-list'),
+                 ('status_set', 'status-set'),
+                 ('open_port', 'open-port'),
+                 ('close_port', 'close-port'),
+                 ('action_set', 'action-set')]
+LEADERSHIP_TOOLS = [('leader_get', 'leader-get'),
+                    ('leader_set', 'leader-set')]
+
+# The process started, which is near enough the start of the hook.
+_started = time.time()
+
+_recorder = None
+
+
+class Recorder(object):
+    '''Timings for the current hook.'''
+    def __init__(self, start):
+        self.start = start
+        self.calls = []
+        self.tools = {}
+        self.depth = 0
+        self.lock = threading.Lock()
+        self.initial = dict(connections.stats)
+        self.enabled = (hookenv.config() or {}).get('hook_timings', True)
+
+    def tool(self, name, seconds):
+        with self.lock:
+            calls, total = self.tools.get(name, (0, 0.0))
+            self.tools[name] = (calls + 1, total + seconds)
+
+    @contextmanager
+    def timed(self, name):
+        before = dict(connections.stats)
+        start = time.time()
+        depth = self.depth
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth = depth
+            after = connections.stats
+            self.calls.append(dict(
+                name=name, depth=depth,
+                seconds=round(time.time() - start, 6),
+                round_trips=(after['round_trips'] -
+                             before.get('round_trips', 0)),
+                statements=(after['statements'] -
+                            before.get('statements', 0))))
+
+    def record(self):
+        stats = connections.stats
+        return dict(
+            hook=hookenv.hook_name(),
+            unit=hookenv.local_unit(),
+            start=round(self.start, 3),
+            seconds=round(time.time() - self.start, 6),
+            round_trips=(stats['round_trips'] -
+                         self.initial.get('round_trips', 0)),
+            statements=(stats['statements'] -
+                        self.initial.get('statements', 0)),
+            connections=(stats['connections'] -
+                         self.initial.get('connections', 0)),
+            handlers=self.calls,
+            tools=dict((name, dict(calls=calls, seconds=round(total, 6)))
+                       for name, (calls, total) in self.tools.items()))
+
+
+def get_recorder():
+    '''Return the :class:`Recorder` for the current hook.'''
+    global _recorder
+    if _recorder is None:
+        _recorder = Recorder(_started)
+        hookenv.atexit(_write_record)
+    return _recorder
+
+
+def _write_record():
+    global _recorder, _started
+    recorder, _recorder = _recorder, None
+    _started = time.time()
+    if recorder is None or not recorder.enabled:
+        return
+    try:
+        write_record(recorder.record())
+    except (IOError, OSError) as x:
+        hookenv.log('Unable to write hook timings: {}'.format(x),
+                    hookenv.WARNING)
+
+
+def _logger():
+    logger = logging.getLogger('pgbouncer-charm.hooks')
+    if not logger.handlers:
+        handler = logging.handlers.RotatingFileHandler(
+            HOOK_LOG, maxBytes=HOOK_LOG_BYTES, backupCount=HOOK_LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def write_record(record):
+    _logger().info(json.dumps(record, sort_keys=True))
+
+
+def read_records(path=None):
+    '''Yield the records from the hook log, including rotated files.'''
+    path = path or HOOK_LOG
+    paths = ['{}.{}'.format(path, i)
+             for i in range(HOOK_LOG_BACKUPS, 0, -1)] + [path]
+    for p in paths:
+        if not os.path.exists(p):
+            continue
+        with open(p, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def _action_ids(func):
+    # charms.reactive identifies handlers by their code object. The
+    # wrapper's code is shared, so the wrapped function's ids are
+    # given explicitly.
+    code = func.__code__
+    action_id = getattr(func, '_action_id', '{}:{}:{}'.format(
+        code.co_filename, code.co_firstlineno, code.co_name))
+    short_id = getattr(func, '_short_action_id', '{}:{}:{}'.format(
+        os.path.relpath(code.co_filename, hookenv.charm_dir()),
+        code.co_firstlineno, code.co_name))
+    return action_id, short_id
+
+
+def instrumented(func):
+    '''Time every call of func, a reactive handler or helper.
+
+    Must be applied before the reactive decorators, nearest the
+    function definition.
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with get_recorder().timed(func.__name__):
+            return func(*args, **kwargs)
+    wrapper._action_id, wrapper._short_action_id = _action_ids(func)
+    return wrapper
+
+
+@contextmanager
+def phase(name):
+    '''Time a block, such as one phase of a handler.'''
+    with get_recorder().timed(name):
+        yield
+
+
+def _timed_tool(func, tool):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            get_recorder().tool(tool, time.time() - start)
+    return wrapper
+
+
+class TimedTools(object):
+    '''A module, with the functions running hook tools timed.
+
+    Other attributes are the module's own. The module itself is left
+    unchanged.
+    '''
+    def __init__(self, module, tools):
+        self._module = module
+        self._tools = dict(tools)
+
+    def __getattr__(self, attr):
+        value = getattr(self._module, attr)
+        if attr in self._tools:
+            return _timed_tool(value, self._tools[attr])
+        return value
+
+
+timed_hookenv = TimedTools(hookenv, HOOKENV_TOOLS)
+
+
+def slowest(records, count):
+    '''Summarise the count slowest hook records as text.'''
+    records = sorted(records, key=lambda r: r.get('seconds', 0),
+                     reverse=True)[:count]
+    lines = ['{:<20} {:<28} {:>9} {:>6} {:>7}  {}'.format(
+        'start', 'hook', 'seconds', 'trips', 'tools', 'slowest handlers')]
+    for r in records:
+        handlers = sorted((h for h in r.get('handlers', [])
+                           if h.get('depth') == 0),
+                          key=lambda h: h['seconds'], reverse=True)[:3]
+        tool_seconds = sum(t['seconds'] for t in r.get('tools', {}).values())
+        lines.append('{:<20} {:<28} {:>9.3f} {:>6} {:>7.3f}  {}'.format(
+            time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(r['start'])),
+            r.get('hook', ''), r['seconds'], r.get('round_trips', 0),
+            tool_seconds, ', '.join('{} {:.3f}s'.format(h['name'],
+                                                        h['seconds'])
+                                    for h in handlers)))
+    return '\n'.join(lines)
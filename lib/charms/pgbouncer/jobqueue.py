@@ -0,0 +1,452 @@
+#!/usr/bin/python3
+
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''A durable queue of backend provisioning jobs, and its worker.
+
+The leader queues its DDL here rather than running it during the hook.
+Each job is a JSON file in the pending directory, named for what it
+provisions, so a newer job for the same roles or database replaces an
+older one. The worker runs jobs whose dependencies have completed,
+several at a time, retrying failures with a growing delay. Completed
+jobs move to the done directory, and jobs that keep failing to the
+failed directory, along with the jobs waiting for them. Only the name,
+id, key and outcome of those are kept, not their DSNs or statements.
+
+The worker runs as a systemd service, from a copy of this file, so
+only the standard library and psycopg2 are used.
+'''
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2
+
+
+QUEUE_DIR = '/var/lib/pgbouncer-charm/provisioning'
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# Jobs run at once. Each holds a backend connection.
+MAX_WORKERS = 4
+
+MAX_ATTEMPTS = 5
+
+# Seconds before the first retry, doubled for each further attempt.
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 300
+
+POLL_INTERVAL = 2
+
+# Seconds between attempts to run update-status, if one fails.
+NOTIFY_RETRY = 30
+
+# Seconds allowed for the unit's hook tools to answer.
+TOOL_TIMEOUT = 120
+
+# The fields kept once a job has completed or failed. The others hold
+# the backend admin DSN and statements with passwords.
+RECORD_FIELDS = ['name', 'id', 'key', 'attempts', 'error']
+
+DUPLICATE_DATABASE = '42P04'
+
+
+def make_job(name, dsn, statements=(), key=None, database_dsn=None,
+             extensions=None, after=()):
+    '''Return a job, ready to be queued.
+
+    statements are run in order against dsn, each as one round trip.
+    extensions maps extension names to the statement creating them,
+    run against database_dsn for those not already installed. after
+    lists the (name, id) of jobs that must complete first. key
+    describes the state the job brings about; a job without statements
+    is not rerun once a job with the same key has completed.
+    '''
+    job = dict(name=name, statements=list(statements), key=key,
+               extensions=dict(extensions or {}),
+               after=[list(a) for a in after])
+    text = json.dumps(job, sort_keys=True, default=str)
+    job.update(id=hashlib.sha256(text.encode('UTF-8')).hexdigest()[:16],
+               dsn=dsn, database_dsn=database_dsn, attempts=0,
+               not_before=0, error=None)
+    return job
+
+
+class Queue(object):
+    '''The job files in a queue directory.
+
+    The charm and the worker both lock the queue while changing it.
+    '''
+    def __init__(self, directory=None):
+        self.directory = directory or QUEUE_DIR
+
+    @contextmanager
+    def lock(self):
+        for state in [PENDING, DONE, FAILED]:
+            os.makedirs(os.path.join(self.directory, state), mode=0o700,
+                        exist_ok=True)
+        with open(os.path.join(self.directory, 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _path(self, state, name):
+        filename = hashlib.sha256(name.encode('UTF-8')).hexdigest()[:16]
+        return os.path.join(self.directory, state, filename + '.json')
+
+    def _read(self, state, name):
+        try:
+            with open(self._path(state, name), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, state, job):
+        path = self._path(state, job['name'])
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(job, f, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def _write_record(self, state, job):
+        self._write(state, dict((field, job.get(field))
+                                for field in RECORD_FIELDS))
+
+    def _remove(self, state, name):
+        try:
+            os.unlink(self._path(state, name))
+        except FileNotFoundError:
+            pass
+
+    def jobs(self, state):
+        '''Return the jobs in the given state.'''
+        jobs = []
+        directory = os.path.join(self.directory, state)
+        if not os.path.isdir(directory):
+            return jobs
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(directory, filename), 'r') as f:
+                    jobs.append(json.load(f))
+            except (IOError, OSError, ValueError):
+                continue
+        return jobs
+
+    def enqueue(self, job):
+        '''Queue job, unless it has nothing to do.
+
+        Returns the job's state, DONE, PENDING or FAILED. A job that
+        has already failed is not queued again until reset().
+        '''
+        if not job['statements'] and not job['extensions']:
+            return DONE
+        name = job['name']
+        with self.lock():
+            done = self._read(DONE, name)
+            if (not job['statements'] and done is not None and
+                    done['key'] == job['key']):
+                return DONE
+            failed = self._read(FAILED, name)
+            if failed is not None and failed['id'] == job['id']:
+                return FAILED
+            blocker = self._blocker(job)
+            if blocker is not None:
+                self._remove(PENDING, name)
+                self._write_record(FAILED, dict(
+                    job, error='{} failed'.format(blocker)))
+                return FAILED
+            pending = self._read(PENDING, name)
+            if pending is not None and pending['id'] == job['id']:
+                return PENDING
+            self._remove(FAILED, name)
+            self._write(PENDING, job)
+            return PENDING
+
+    def state(self, name, job_id):
+        '''Return the state of the job, or None if it is not queued.'''
+        for state in [DONE, PENDING, FAILED]:
+            job = self._read(state, name)
+            if job is not None and job['id'] == job_id:
+                return state
+        return None
+
+    def _blocker(self, job):
+        '''The name of a failed job that job waits for, or None.'''
+        for name, job_id in job['after']:
+            if self.state(name, job_id) == FAILED:
+                return name
+        return None
+
+    def ready(self, now=None):
+        '''Return the pending jobs that may run now.'''
+        now = time.time() if now is None else now
+        with self.lock():
+            return [job for job in self.jobs(PENDING)
+                    if job['not_before'] <= now and
+                    all(self.state(name, job_id) == DONE
+                        for name, job_id in job['after'])]
+
+    def blocked(self):
+        '''Return the pending jobs that wait for a failed job.
+
+        They will never run, so count as failed.
+        '''
+        with self.lock():
+            return [dict(job, error='{} failed'.format(blocker))
+                    for job, blocker in ((job, self._blocker(job))
+                                         for job in self.jobs(PENDING))
+                    if blocker is not None]
+
+    def finish(self, job):
+        '''Record job as complete.'''
+        with self.lock():
+            pending = self._read(PENDING, job['name'])
+            if pending is not None and pending['id'] == job['id']:
+                self._remove(PENDING, job['name'])
+            self._write_record(DONE, dict(job, error=None))
+
+    def fail(self, job, error, max_attempts=MAX_ATTEMPTS):
+        '''Record a failed attempt, giving up after max_attempts.
+
+        Returns True if the job will be retried.
+        '''
+        attempts = job['attempts'] + 1
+        delay = min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+        job = dict(job, attempts=attempts, error=error,
+                   not_before=time.time() + delay)
+        with self.lock():
+            pending = self._read(PENDING, job['name'])
+            if pending is None or pending['id'] != job['id']:
+                # Replaced while running. The new job will be run.
+                return True
+            if attempts < max_attempts:
+                self._write(PENDING, job)
+                return True
+            self._remove(PENDING, job['name'])
+            self._write_record(FAILED, job)
+            self._fail_dependents(job)
+            return False
+
+    def _fail_dependents(self, job):
+        # Jobs waiting for a failed job, directly or not, fail with it.
+        failed = [job]
+        while failed:
+            job = failed.pop()
+            for dependent in self.jobs(PENDING):
+                if [job['name'], job['id']] in dependent['after']:
+                    dependent = dict(dependent, error='{} failed'.format(
+                        job['name']))
+                    self._remove(PENDING, dependent['name'])
+                    self._write_record(FAILED, dependent)
+                    failed.append(dependent)
+
+    def scrub(self):
+        '''Drop the DSNs and statements of completed and failed jobs
+        recorded by earlier versions.
+        '''
+        with self.lock():
+            for state in [DONE, FAILED]:
+                for job in self.jobs(state):
+                    if set(job) - set(RECORD_FIELDS):
+                        self._write_record(state, job)
+
+    def discard_pending(self):
+        '''Drop the pending jobs, returning how many there were.'''
+        with self.lock():
+            pending = self.jobs(PENDING)
+            for job in pending:
+                self._remove(PENDING, job['name'])
+            return len(pending)
+
+    def reset(self):
+        '''Forget completed and failed jobs, so all are run again.'''
+        with self.lock():
+            for state in [DONE, FAILED]:
+                shutil.rmtree(os.path.join(self.directory, state))
+
+
+def connect(dsn):
+    con = psycopg2.connect(dsn)
+    con.autocommit = True
+    return con
+
+
+def run_job(job):
+    '''Run a job's statements, then create its missing extensions.'''
+    con = connect(job['dsn'])
+    try:
+        cur = con.cursor()
+        for sql in job['statements']:
+            try:
+                cur.execute(sql)
+            except psycopg2.Error as x:
+                # Created by another unit, or by an earlier attempt.
+                duplicate = (x.pgcode == DUPLICATE_DATABASE or
+                             isinstance(x, psycopg2.IntegrityError))
+                if not (sql.startswith('CREATE DATABASE') and duplicate):
+                    raise
+    finally:
+        con.close()
+
+    if not job['extensions']:
+        return
+    con = connect(job['database_dsn'])
+    try:
+        cur = con.cursor()
+        cur.execute("SELECT extname FROM pg_extension "
+                    "WHERE extname = ANY(%s)", (sorted(job['extensions']),))
+        installed = set(r[0] for r in cur.fetchall())
+        missing = sorted(set(job['extensions']) - installed)
+        if missing:
+            cur.execute(';\n'.join(job['extensions'][ext]
+                                   for ext in missing))
+    finally:
+        con.close()
+
+
+def run_ready(queue, workers=MAX_WORKERS, max_attempts=MAX_ATTEMPTS,
+              unit=None):
+    '''Run the jobs ready to run, returning how many were run.
+
+    If unit is given, each job is only run while it is the leader, as
+    a new leader queues its own jobs.
+    '''
+    jobs = queue.ready()
+    if not jobs:
+        return 0
+    if unit is not None and not is_leader(unit):
+        log('{} is not known to be the leader, not running {} jobs'
+            ''.format(unit, len(jobs)))
+        return 0
+
+    def _run(job):
+        if unit is not None and not is_leader(unit):
+            log('{} is not known to be the leader, not running {}'
+                ''.format(unit, job['name']))
+            return
+        try:
+            run_job(job)
+        except Exception as x:
+            retry = queue.fail(job, str(x).strip(), max_attempts)
+            log('{} failed{}: {}'.format(job['name'],
+                                         '' if retry else ', giving up',
+                                         str(x).strip()))
+        else:
+            queue.finish(job)
+            log('{} complete'.format(job['name']))
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+        list(pool.map(_run, jobs))
+    return len(jobs)
+
+
+def _hook_tool(unit, command):
+    '''Run a command in the unit's hook context, returning its output.
+
+    Returns None if it could not be run.
+    '''
+    for tool in ['juju-exec', 'juju-run']:
+        path = shutil.which(tool)
+        if path is None:
+            continue
+        try:
+            return subprocess.check_output([path, unit, command],
+                                           universal_newlines=True,
+                                           timeout=TOOL_TIMEOUT)
+        except (OSError, subprocess.SubprocessError) as x:
+            log('Unable to run {} on {}: {}'.format(command, unit, x))
+            return None
+    log('Unable to run {} on {}: neither juju-exec nor juju-run found'
+        ''.format(command, unit))
+    return None
+
+
+def is_leader(unit):
+    '''Return True if unit is the leader.
+
+    Returns False if that cannot be determined.
+    '''
+    out = _hook_tool(unit, 'is-leader')
+    return out is not None and out.strip() == 'True'
+
+
+def notify(unit):
+    '''Run the unit's update-status hook, so the charm sees the results.
+
+    Returns False if it could not be run.
+    '''
+    return _hook_tool(unit, 'hooks/update-status') is not None
+
+
+def log(message):
+    print(message, flush=True)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--queue-dir', default=QUEUE_DIR)
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS)
+    parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS)
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between checks for new jobs')
+    parser.add_argument('--notify-unit',
+                        help='unit to run update-status on when idle. '
+                        'Jobs only run while it is the leader.')
+    options = parser.parse_args()
+
+    queue = Queue(options.queue_dir)
+    queue.scrub()
+    next_notify = None
+    while True:
+        ran = run_ready(queue, options.workers, options.max_attempts,
+                        options.notify_unit)
+        if ran and options.notify_unit and not queue.jobs(PENDING):
+            next_notify = time.time()
+        if next_notify is not None and time.time() >= next_notify:
+            if notify(options.notify_unit):
+                next_notify = None
+            else:
+                log('Retrying update-status in {}s'.format(NOTIFY_RETRY))
+                next_notify = time.time() + NOTIFY_RETRY
+        if not ran:
+            time.sleep(options.interval)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
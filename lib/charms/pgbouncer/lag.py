@@ -0,0 +1,161 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Replication lag of the backend standbys.
+
+A standby's lag is the age of the last transaction it replayed, or
+zero when it is up to date. A standby is up to date when it has
+replayed the WAL the master had written when the lag was measured, or,
+failing that, when its WAL receiver is streaming and it has replayed
+everything it has received, as happens when the master is idle. A
+standby whose WAL receiver has stopped is never taken to be up to date
+by the second test, so one stuck behind the master shows its true lag.
+Standbys lagging more than a threshold are taken out of routing, and
+only put back once their lag has fallen well below it, so a standby
+hovering around the threshold does not flap.
+'''
+
+import psycopg2
+
+
+POSITION_SQL = "SELECT pg_current_{wal}_{position}()::text"
+
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN NULL
+        WHEN %(master)s::text IS NOT NULL AND pg_{wal}_{lsn}_diff(
+                %(master)s::pg_lsn, pg_last_{wal}_replay_{lsn}()) <= 0
+            THEN 0
+        WHEN pg_last_{wal}_receive_{lsn}() = pg_last_{wal}_replay_{lsn}()
+                AND {streaming}
+            THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM
+                now() - pg_last_xact_replay_timestamp()), 0)
+        END
+    """
+
+# True while the WAL receiver is connected to the master. The view
+# appeared in PostgreSQL 9.6.
+STREAMING_SQL = """
+    EXISTS (SELECT 1 FROM pg_stat_wal_receiver
+            WHERE status = 'streaming')"""
+
+# Minimum seconds between measurements, as hooks may run in bursts.
+CHECK_INTERVAL = 30
+
+# Seconds to wait when connecting to a standby.
+CONNECT_TIMEOUT = 5
+
+# An excluded standby is readmitted once its lag falls below this
+# fraction of the threshold.
+RECOVERY_FRACTION = 0.5
+
+
+def _version(version):
+    try:
+        return tuple(int(n) for n in str(version).split('.')[:2])
+    except ValueError:
+        return (10,)
+
+
+def lag_sql(version):
+    '''The lag query for a PostgreSQL version, such as '9.6' or '12'.
+
+    The WAL functions were renamed in PostgreSQL 10.
+
+    >>> 'pg_last_xlog_replay_location' in lag_sql('9.6')
+    True
+    >>> 'pg_last_wal_replay_lsn' in lag_sql('12')
+    True
+    >>> 'pg_stat_wal_receiver' in lag_sql('9.5')
+    False
+    '''
+    version = _version(version)
+    streaming = STREAMING_SQL if version >= (9, 6) else 'true'
+    if version < (10,):
+        return LAG_SQL.format(wal='xlog', lsn='location', streaming=streaming)
+    return LAG_SQL.format(wal='wal', lsn='lsn', streaming=streaming)
+
+
+def position_sql(version):
+    '''The query for the master's current WAL position.
+
+    >>> position_sql('12')
+    'SELECT pg_current_wal_lsn()::text'
+    '''
+    if _version(version) < (10,):
+        return POSITION_SQL.format(wal='xlog', position='location')
+    return POSITION_SQL.format(wal='wal', position='lsn')
+
+
+def master_position(cache, dsn, version):
+    '''Return the WAL position of the master at dsn, or None.'''
+    try:
+        cur = cache.get(dsn).cursor()
+        cur.execute(position_sql(version))
+        return cur.fetchone()[0]
+    except psycopg2.Error:
+        cache.discard(dsn)
+        return None
+
+
+def measure(con, version, master=None):
+    '''Return the replay lag in seconds of the standby at con.
+
+    master is the master's WAL position, read just before, if known.
+    Returns None if con is not a standby.
+    '''
+    cur = con.cursor()
+    cur.execute(lag_sql(version), dict(master=master))
+    lag = cur.fetchone()[0]
+    return None if lag is None else float(lag)
+
+
+def measure_all(cache, dsns, version, master_dsn=None):
+    '''Measure the lag of several standbys.
+
+    dsns maps a name to each standby's connection string. The master's
+    WAL position is read first from master_dsn, if given. Standbys
+    that cannot be reached, or are not in recovery, are given an
+    infinite lag.
+    '''
+    master = None
+    if master_dsn is not None:
+        master = master_position(cache, master_dsn, version)
+    lags = {}
+    for name, dsn in dsns.items():
+        try:
+            lag = measure(cache.get(dsn), version, master)
+        except psycopg2.Error:
+            cache.discard(dsn)
+            lag = None
+        lags[name] = float('inf') if lag is None else lag
+    return lags
+
+
+def lagging(lags, excluded, threshold, recovery=RECOVERY_FRACTION):
+    '''Return the set of standbys to exclude from routing.
+
+    Standbys are excluded when their lag exceeds threshold, and stay
+    excluded until it falls to recovery times threshold.
+
+    >>> sorted(lagging(dict(a=1, b=40, c=20), set(), 30))
+    ['b']
+    >>> sorted(lagging(dict(a=1, b=20, c=10), {'b', 'c'}, 30))
+    ['b']
+    '''
+    return set(name for name, lag in lags.items()
+               if lag > (threshold * recovery if name in excluded
+                         else threshold))
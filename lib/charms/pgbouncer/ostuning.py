@@ -0,0 +1,146 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Operating system limits sized for the configured connections.
+
+Every client and server connection holds a file descriptor, so the
+pgbouncer services' LimitNOFILE is raised with systemd drop-ins. The
+kernel's listen and SYN queues are raised to the listen_backlog, and
+the ephemeral port range widened when many server connections are
+made. Kernel settings are only ever raised, never lowered.
+'''
+
+import os.path
+import subprocess
+
+from charmhelpers.core import hookenv, host
+
+from charms.pgbouncer import service
+
+
+# Descriptors used besides connections: listening and unix sockets,
+# the log file, DNS lookups and the like.
+FD_OVERHEAD = 64
+
+# Headroom over the configured connections.
+FD_MARGIN = 1.1
+
+# The kernel's limit on LimitNOFILE, when it cannot be read.
+DEFAULT_NR_OPEN = 1048576
+
+# Server connections beyond which the ephemeral port range is widened.
+# The usual range of 32768-60999 allows 28232 connections to each
+# backend address.
+WIDE_PORT_RANGE = (10240, 65535)
+PORT_RANGE_THRESHOLD = 14000
+
+SYSCTL_PATH = '/etc/sysctl.d/50-pgbouncer-charm.conf'
+
+DROPIN_PATHS = ['/etc/systemd/system/{}.service.d/limits.conf'.format(name)
+                for name in [service.SERVICE_NAME, 'pgbouncer-instance@']]
+
+
+def required_fds(clients, servers):
+    '''The file descriptors one pgbouncer process may need.
+
+    >>> required_fds(100, 40)
+    218
+    >>> required_fds(10000, 200)
+    11284
+    '''
+    return int((clients + servers) * FD_MARGIN) + FD_OVERHEAD
+
+
+def read_sysctl(key):
+    '''Return the current value of a kernel setting, or None.'''
+    path = os.path.join('/proc/sys', key.replace('.', '/'))
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def fd_ceiling():
+    '''The largest LimitNOFILE the kernel allows.'''
+    value = read_sysctl('fs.nr_open')
+    return int(value) if value else DEFAULT_NR_OPEN
+
+
+def sysctls(backlog, servers):
+    '''The kernel settings wanted for a listen backlog and the
+    number of server connections.
+
+    >>> sorted(sysctls(1024, 100).items())
+    [('net.core.somaxconn', 1024), ('net.ipv4.tcp_max_syn_backlog', 1024)]
+    >>> sysctls(128, 20000)['net.ipv4.ip_local_port_range']
+    [10240, 65535]
+    '''
+    settings = {'net.core.somaxconn': backlog,
+                'net.ipv4.tcp_max_syn_backlog': backlog}
+    if servers > PORT_RANGE_THRESHOLD:
+        settings['net.ipv4.ip_local_port_range'] = list(WIDE_PORT_RANGE)
+    return settings
+
+
+def effective(settings):
+    '''Raise settings to the current values where those are higher.'''
+    result = {}
+    for key, value in sorted(settings.items()):
+        current = (read_sysctl(key) or '').split()
+        if isinstance(value, list):
+            # A range is kept if it is already at least as wide.
+            if (len(current) == 2 and int(current[0]) <= value[0] and
+                    int(current[1]) >= value[1]):
+                value = [int(c) for c in current]
+            result[key] = ' '.join(str(v) for v in value)
+        else:
+            if current:
+                value = max(value, int(current[0]))
+            result[key] = str(value)
+    return result
+
+
+def apply_sysctls(settings):
+    '''Persist and load the kernel settings.
+
+    Returns False if they could not be loaded, as in a container.
+    '''
+    values = effective(settings)
+    contents = ''.join('{} = {}\n'.format(k, v)
+                       for k, v in sorted(values.items()))
+    host.write_file(SYSCTL_PATH,
+                    ('# This file is maintained by the pgbouncer juju '
+                     'charm.\n' + contents).encode(), perms=0o644)
+    if subprocess.call(['sysctl', '-p', SYSCTL_PATH]) != 0:
+        hookenv.log('Unable to apply {}'.format(SYSCTL_PATH),
+                    hookenv.WARNING)
+        return False
+    return True
+
+
+def install_limits(nofile):
+    '''Set LimitNOFILE for the pgbouncer services.
+
+    Returns True if a drop-in changed, and running processes need a
+    restart to pick it up.
+    '''
+    contents = ('# This file is maintained by the pgbouncer juju charm.\n'
+                '[Service]\nLimitNOFILE={}\n'.format(nofile))
+    changed = False
+    for path in DROPIN_PATHS:
+        host.mkdir(os.path.dirname(path), perms=0o755)
+        changed = service.install_unit(path, contents) or changed
+    return changed
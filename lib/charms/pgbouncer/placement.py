@@ -0,0 +1,109 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Placement of client databases on backend clusters.
+
+Each backend relation is a PostgreSQL cluster, named for the related
+application. A database stays on the cluster it was placed on, as its
+data lives there, for as long as that cluster is related, even while
+it has no master. Otherwise it goes to the cluster named for it in the
+database_backends option, else to the one its client asks for, and
+failing those to the available cluster holding the fewest databases.
+'''
+
+import json
+import re
+
+
+def parse_mapping(spec):
+    '''Parse a 'database=cluster, database=cluster' list.
+
+    >>> sorted(parse_mapping('app=pg-a, reports = pg-b,').items())
+    [('app', 'pg-a'), ('reports', 'pg-b')]
+    '''
+    mapping = {}
+    for item in re.split(r'\s*,\s*', (spec or '').strip()):
+        if not item:
+            continue
+        database, sep, cluster = item.partition('=')
+        if not sep or not database.strip() or not cluster.strip():
+            raise ValueError('Invalid placement {!r}'.format(item))
+        mapping[database.strip()] = cluster.strip()
+    return mapping
+
+
+def place(databases, clusters, current=None, mapping=None, requested=None,
+          available=None):
+    '''Return the cluster of each database.
+
+    databases is the databases to place, and clusters the clusters
+    related. New databases are only placed on the available clusters,
+    by default all of them. current holds the existing placements,
+    mapping those from the database_backends option and requested
+    those asked for by clients. Neither moves a database already
+    placed. Databases explicitly placed on a cluster that is not
+    related are left out.
+
+    >>> sorted(place(['a', 'b', 'c'], ['pg1', 'pg2']).items())
+    [('a', 'pg1'), ('b', 'pg2'), ('c', 'pg1')]
+    >>> sorted(place(['a', 'b', 'c'], ['pg1', 'pg2'], current=dict(a='pg1'),
+    ...              mapping=dict(a='pg2', b='pg1')).items())
+    [('a', 'pg1'), ('b', 'pg1'), ('c', 'pg2')]
+    >>> sorted(place(['a', 'b'], ['pg1', 'pg2'], current=dict(a='pg1'),
+    ...              available=['pg2']).items())
+    [('a', 'pg1'), ('b', 'pg2')]
+    >>> place(['a'], ['pg1'], requested=dict(a='pg9'))
+    {}
+    '''
+    clusters = set(clusters)
+    available = clusters if available is None else clusters & set(available)
+    current = current or {}
+    mapping = mapping or {}
+    requested = requested or {}
+    placed = {}
+    unplaced = []
+    for database in sorted(set(databases)):
+        explicit = mapping.get(database) or requested.get(database)
+        if current.get(database) in clusters:
+            placed[database] = current[database]
+        elif explicit:
+            if explicit in clusters:
+                placed[database] = explicit
+        else:
+            unplaced.append(database)
+
+    # Placed databases no longer wanted still hold their data.
+    loads = dict((cluster, 0) for cluster in available)
+    for database, cluster in dict(current, **placed).items():
+        if cluster in loads:
+            loads[cluster] += 1
+    for database in unplaced:
+        if not loads:
+            break
+        cluster = min(sorted(loads), key=lambda c: loads[c])
+        placed[database] = cluster
+        loads[cluster] += 1
+    return placed
+
+
+def serialize(placements):
+    return json.dumps(placements, sort_keys=True)
+
+
+def deserialize(text):
+    try:
+        return dict(json.loads(text or '{}'))
+    except (TypeError, ValueError):
+        return {}
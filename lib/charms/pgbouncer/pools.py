@@ -0,0 +1,114 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Per-database pool parameters requested by clients.
+
+Clients may set pool_size, pool_mode, reserve_pool, max_db_connections
+and connect_query in their relation data. Valid settings are rendered
+on the client's [databases] stanzas, overriding the global defaults.
+'''
+
+from charms.pgbouncer.rendering import per_instance
+
+
+POOL_MODES = ('session', 'transaction', 'statement')
+
+# Settings limiting backend connections, and the smallest value each
+# process may be given when they are divided between processes. A
+# max_db_connections of 0 means unlimited, and is never divided.
+CONNECTION_LIMITS = dict(pool_size=1, reserve_pool=0, max_db_connections=1)
+
+PARAMETERS = ('pool_size', 'pool_mode', 'reserve_pool', 'max_db_connections',
+              'connect_query')
+
+
+def _validate(key, value):
+    if key in CONNECTION_LIMITS:
+        value = int(value)
+        if value < (1 if key == 'pool_size' else 0):
+            raise ValueError('{} out of range'.format(key))
+        return value
+    if key == 'pool_mode':
+        if value not in POOL_MODES:
+            raise ValueError('unknown pool_mode')
+        return value
+    if any(c in value for c in '\r\n\0'):
+        raise ValueError('{} contains control characters'.format(key))
+    return value
+
+
+def parse(relinfo):
+    '''Extract the pool parameters from a client's relation data.
+
+    Returns a (parameters, errors) tuple. Invalid settings are left out
+    of parameters, and described in the list of errors.
+
+    >>> parse(dict(pool_size='5', pool_mode='session', database='x'))
+    ({'pool_size': 5, 'pool_mode': 'session'}, [])
+    >>> parse(dict(pool_size='0', pool_mode='fast'))[1]
+    ['pool_size out of range', 'unknown pool_mode']
+    '''
+    params = {}
+    errors = []
+    for key in PARAMETERS:
+        value = (relinfo.get(key) or '').strip()
+        if not value:
+            continue
+        try:
+            params[key] = _validate(key, value)
+        except ValueError as x:
+            errors.append(str(x))
+    return params, errors
+
+
+def server_connections(params, default_pool_size, reserve_pool_size):
+    """The server connections a pool may open, across all processes.
+
+    >>> server_connections(dict(pool_size=5, reserve_pool=2), 20, 0)
+    7
+    >>> server_connections(dict(max_db_connections=10), 20, 5)
+    10
+    """
+    connections = (params.get('pool_size', default_pool_size) +
+                   params.get('reserve_pool', reserve_pool_size))
+    if params.get('max_db_connections'):
+        connections = min(connections, params['max_db_connections'])
+    return connections
+
+
+def quote(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def render(params, count):
+    """Render parameters as pgbouncer database settings.
+
+    Connection limits are shared between count processes.
+
+    >>> render(dict(pool_size=5, connect_query="SET x='y'"), 2)
+    " pool_size=2 connect_query='SET x=''y'''"
+    """
+    settings = []
+    for key in PARAMETERS:
+        if key not in params:
+            continue
+        value = params[key]
+        if key in CONNECTION_LIMITS:
+            if value:
+                value = per_instance(value, count, CONNECTION_LIMITS[key])
+        elif key == 'connect_query':
+            value = quote(value)
+        settings.append(' {}={}'.format(key, value))
+    return ''.join(settings)
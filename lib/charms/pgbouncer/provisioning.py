@@ -0,0 +1,209 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Snapshot-and-diff provisioning of backend roles and databases.
+
+The Provisioner reads pg_roles, pg_auth_members and pg_database in a
+single query, diffs them against the users, role memberships, databases
+and CONNECT grants requested by the client relations, and plans only
+the DDL needed to converge, batched into as few round trips as
+PostgreSQL allows. The batches() of the roles and per-database plans
+are run by the provisioning worker.
+'''
+
+from collections import namedtuple, OrderedDict
+
+from charms.pgbouncer.helpers import pgidentifier
+
+
+SNAPSHOT_SQL = """
+    SELECT 'role', rolname::text, NULL::text
+    FROM pg_roles
+    UNION ALL
+    SELECT 'member', member.rolname::text, role.rolname::text
+    FROM pg_roles AS role, pg_roles AS member, pg_auth_members
+    WHERE
+        member.oid = pg_auth_members.member
+        AND role.oid = pg_auth_members.roleid
+    UNION ALL
+    SELECT 'database', datname::text, NULL
+    FROM pg_database
+    UNION ALL
+    SELECT 'connect', pg_database.datname::text, grantee.rolname::text
+    FROM pg_database, aclexplode(pg_database.datacl) AS acl,
+        pg_roles AS grantee
+    WHERE
+        grantee.oid = acl.grantee
+        AND acl.privilege_type = 'CONNECT'
+    """
+
+
+Report = namedtuple('Report',
+                    ['statements', 'round_trips', 'legacy_round_trips'])
+
+
+class Provisioner(object):
+    '''Converge backend roles and databases from a catalog snapshot.
+
+    Call snapshot() once, declare the wanted state with add_user() and
+    add_database(), then plan_roles() and plan_databases().
+    '''
+    def __init__(self, con):
+        self.con = con
+
+        # The catalog snapshot.
+        self.roles = set()
+        self.memberships = {}      # member -> set of granted roles
+        self.databases = set()
+        self.connect_grants = {}   # database -> set of grantees
+
+        # The requested state.
+        self.users = OrderedDict()      # user -> (password, roles, admin)
+        self.grants = OrderedDict()     # database -> set of users
+
+        self.round_trips = 0
+
+    def snapshot(self):
+        '''Load the relevant system catalogs into memory.'''
+        cur = self.con.cursor()
+        cur.execute(SNAPSHOT_SQL)
+        self.round_trips += 1
+        for kind, name, detail in cur.fetchall():
+            if kind == 'role':
+                self.roles.add(name)
+            elif kind == 'member':
+                self.memberships.setdefault(name, set()).add(detail)
+            elif kind == 'database':
+                self.databases.add(name)
+            elif kind == 'connect':
+                self.connect_grants.setdefault(name, set()).add(detail)
+
+    def add_user(self, user, password, roles=(), admin=False):
+        '''Request a login role, granted exactly the given roles.'''
+        self.users[user] = (password, set(roles), admin)
+
+    def add_database(self, database, user):
+        '''Request a database, with CONNECT granted to user.'''
+        self.grants.setdefault(database, set()).add(user)
+
+    def plan_roles(self):
+        '''The statements creating users and roles and granting roles.'''
+        statements = []
+        roles = set(self.roles)
+
+        for user, (password, _, admin) in self.users.items():
+            if user in roles:
+                continue
+            if admin:
+                statements.append((
+                    "Creating superuser {}".format(user),
+                    "CREATE ROLE %s WITH SUPERUSER LOGIN PASSWORD %s",
+                    (pgidentifier(user), password)))
+            else:
+                statements.append((
+                    "Creating user {}".format(user),
+                    "CREATE ROLE %s WITH LOGIN PASSWORD %s",
+                    (pgidentifier(user), password)))
+            roles.add(user)
+
+        for user, (_, wanted_roles, _) in self.users.items():
+            existing_roles = self.memberships.get(user, set())
+            for role in sorted(wanted_roles - existing_roles):
+                if role not in roles:
+                    statements.append((
+                        "Creating role {}".format(role),
+                        "CREATE ROLE %s INHERIT NOLOGIN",
+                        (pgidentifier(role),)))
+                    roles.add(role)
+                statements.append((
+                    "Granting {} to {}".format(role, user),
+                    "GRANT %s TO %s",
+                    (pgidentifier(role), pgidentifier(user))))
+            for role in sorted(existing_roles - wanted_roles):
+                statements.append((
+                    "Revoking {} from {}".format(role, user),
+                    "REVOKE %s FROM %s",
+                    (pgidentifier(role), pgidentifier(user))))
+
+        return statements
+
+    def plan_databases(self):
+        '''The statements creating and granting each database.
+
+        Returns an OrderedDict mapping each requested database to its
+        list of statements, which may be empty.
+        '''
+        databases = OrderedDict()
+        for database, users in self.grants.items():
+            statements = databases[database] = []
+            if database not in self.databases:
+                statements.append((
+                    "Creating database {}".format(database),
+                    "CREATE DATABASE %s",
+                    (pgidentifier(database),)))
+            granted = self.connect_grants.get(database, set())
+            for user in sorted(users - granted):
+                statements.append((
+                    "Granting CONNECT on {} to {}".format(database, user),
+                    "GRANT CONNECT ON DATABASE %s TO %s",
+                    (pgidentifier(database), pgidentifier(user))))
+        return databases
+
+    def batches(self, statements):
+        '''Group statements into as few round trips as possible.
+
+        Returns a list of SQL strings. CREATE DATABASE cannot run
+        inside the implicit transaction of a multi-statement query,
+        so each one is sent alone and splits the batch.
+        '''
+        cur = self.con.cursor()
+        batches = []
+        batch = []
+        for _, sql, params in statements:
+            statement = cur.mogrify(sql, params).decode('UTF-8')
+            if sql.startswith('CREATE DATABASE'):
+                if batch:
+                    batches.append(';\n'.join(batch))
+                    batch = []
+                batches.append(statement)
+            else:
+                batch.append(statement)
+        if batch:
+            batches.append(';\n'.join(batch))
+        return batches
+
+    def legacy_round_trips(self):
+        '''Round trips the per-client ensure_* helpers would have made.'''
+        trips = 0
+        for user, (_, wanted_roles, _) in self.users.items():
+            existing_roles = self.memberships.get(user, set())
+            # role_exists(), optional CREATE ROLE, membership query.
+            trips += 2 + (0 if user in self.roles else 1)
+            for role in wanted_roles - existing_roles:
+                # role_exists(), optional CREATE ROLE, GRANT.
+                trips += 2 + (0 if role in self.roles else 1)
+            trips += len(existing_roles - wanted_roles)
+        for database, users in self.grants.items():
+            # Existence check, optional CREATE DATABASE, and a GRANT
+            # issued for every client.
+            trips += 1 + (0 if database in self.databases else 1)
+            trips += len(users)
+        return trips
+
+    def report(self, statements, batches):
+        '''Return a :class:`Report` of statements run as batches.'''
+        return Report(statements=len(statements),
+                      round_trips=self.round_trips + len(batches),
+                      legacy_round_trips=self.legacy_round_trips())
@@ -0,0 +1,171 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Relation data, read lazily and written once per relation per hook.
+
+Relations presents the same structure as charmhelpers.context.Relations,
+relname -> relid -> unit -> settings, with the local unit's settings in
+each relation's local attribute. Nothing is read until it is used, and
+what is read is cached for the rest of the hook. Local settings are
+buffered, and flush() sends each relation's changed settings in a
+single relation-set. Settings whose value is unchanged are not sent.
+'''
+
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+
+from charms.pgbouncer.instrumentation import timed_hookenv as hookenv
+
+
+class LocalSettings(MutableMapping):
+    '''The local unit's settings on a relation, with buffered writes.
+
+    Values are stored as strings, as Juju does. Setting a value to
+    None removes it.
+    '''
+    def __init__(self, relid):
+        self.relid = relid
+        self._current = None
+        self._pending = {}
+
+    def _settings(self):
+        if self._current is None:
+            self._current = hookenv.relation_get(
+                unit=hookenv.local_unit(), rid=self.relid) or {}
+        return self._current
+
+    def _merged(self):
+        merged = dict(self._settings())
+        merged.update(self._pending)
+        return dict((k, v) for k, v in merged.items() if v is not None)
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            if self._pending[key] is None:
+                raise KeyError(key)
+            return self._pending[key]
+        return self._settings()[key]
+
+    def __setitem__(self, key, value):
+        self._pending[key] = None if value is None else str(value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._pending[key] = None
+
+    def __iter__(self):
+        return iter(self._merged())
+
+    def __len__(self):
+        return len(self._merged())
+
+    def changes(self):
+        '''The pending settings that differ from those on the relation.'''
+        if not self._pending:
+            return {}
+        current = self._settings()
+        return dict((k, v) for k, v in self._pending.items()
+                    if current.get(k) != v)
+
+    def flush(self):
+        '''Send the changed settings with one relation-set.'''
+        changes = self.changes()
+        if changes:
+            hookenv.relation_set(self.relid, changes)
+            for key, value in changes.items():
+                if value is None:
+                    self._current.pop(key, None)
+                else:
+                    self._current[key] = value
+        self._pending = {}
+
+
+class Relation(Mapping):
+    '''The remote units on a relation, mapped to their settings.'''
+    def __init__(self, relid):
+        self.relid = relid
+        self.local = LocalSettings(relid)
+        self._units = None
+        self._settings = {}
+
+    def _unit_names(self):
+        if self._units is None:
+            self._units = hookenv.related_units(self.relid) or []
+        return self._units
+
+    def __getitem__(self, unit):
+        if unit not in self._settings:
+            if unit not in self._unit_names():
+                raise KeyError(unit)
+            self._settings[unit] = hookenv.relation_get(
+                unit=unit, rid=self.relid) or {}
+        return self._settings[unit]
+
+    def __iter__(self):
+        return iter(self._unit_names())
+
+    def __len__(self):
+        return len(self._unit_names())
+
+    def __contains__(self, unit):
+        return unit in self._unit_names()
+
+
+class Relations(Mapping):
+    '''Every relation, by relation name and then relation id.'''
+    def __init__(self):
+        self._relations = {}
+
+    def __getitem__(self, relname):
+        if relname not in self._relations:
+            self._relations[relname] = OrderedDict(
+                (relid, Relation(relid))
+                for relid in hookenv.relation_ids(relname) or [])
+        return self._relations[relname]
+
+    def __iter__(self):
+        return iter(self._relations)
+
+    def __len__(self):
+        return len(self._relations)
+
+    def flush(self):
+        '''Send pending local settings, one relation-set per relation.'''
+        for relations in self._relations.values():
+            for relation in relations.values():
+                relation.local.flush()
+
+
+_relations = None
+
+
+def get_relations():
+    '''Return the Relations for the current hook.
+
+    Pending local settings are flushed when the hook exits.
+    '''
+    global _relations
+    if _relations is None:
+        _relations = Relations()
+        hookenv.atexit(_flush_relations)
+    return _relations
+
+
+def _flush_relations():
+    global _relations
+    if _relations is not None:
+        relations, _relations = _relations, None
+        relations.flush()
@@ -0,0 +1,90 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Rendering of pgbouncer.ini.
+
+This module does not depend on charmhelpers or a Juju hook
+environment, so tools such as the pgbench harness can render exactly
+the configuration the charm would.
+'''
+
+import jinja2
+
+
+# Filesystem locations used by the template. Tools running pgbouncer
+# elsewhere override them. A user of None omits the setting, for
+# pgbouncer processes not started as root.
+PATHS = dict(auth_file='/etc/pgbouncer/userlist.txt',
+             tls_dir='/etc/pgbouncer',
+             user='postgres')
+
+
+def per_instance(total, count, minimum=0):
+    '''Share total between count instances, rounding down.
+
+    Pool sizes are divided so that the backend connections used by all
+    instances together do not exceed what one process would use.
+
+    >>> per_instance(20, 16, minimum=1)
+    1
+    >>> per_instance(5, 2)
+    2
+    '''
+    return max(minimum, total // count)
+
+
+def listen_backlog(setting, max_client_conn):
+    '''The listen queue length for a process accepting max_client_conn.
+
+    0 sizes the queue for a quarter of the clients connecting at once,
+    as after a failover or an application restart.
+
+    >>> listen_backlog(0, 100)
+    128
+    >>> listen_backlog(0, 10000)
+    2500
+    >>> listen_backlog(512, 10000)
+    512
+    '''
+    if setting:
+        return setting
+    return min(max(128, max_client_conn // 4), 65535)
+
+
+def render_config(template_dir, config, instance, database_stanzas,
+                  count=1, reuseport=False, listen_addr='*', paths=None):
+    '''Render pgbouncer.ini for one of count pgbouncer processes.
+
+    config is the charm configuration, and instance the process's
+    :class:`charms.pgbouncer.service.Instance`, or any object with the
+    same attributes. Pool sizes and max_client_conn are divided
+    between the processes.
+    '''
+    max_client_conn = -(-config['max_client_conn'] // count)
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir))
+    template = env.get_template('pgbouncer.ini.tmpl')
+    return template.render(
+        config=config,
+        listen_addr=listen_addr,
+        paths=dict(PATHS, **(paths or {})),
+        database_stanzas=database_stanzas,
+        instance=instance,
+        so_reuseport=reuseport,
+        default_pool_size=per_instance(config['default_pool_size'], count,
+                                       minimum=1),
+        reserve_pool_size=per_instance(config['reserve_pool_size'], count),
+        max_client_conn=max_client_conn,
+        listen_backlog=listen_backlog(config.get('listen_backlog', 0),
+                                      max_client_conn))
@@ -0,0 +1,179 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''The pgbouncer processes running on this unit.
+
+pgbouncer is single threaded. To use more than one core, several
+pgbouncer processes share the listen port using SO_REUSEPORT. Each
+runs as an instance of a systemd template unit, with its own
+configuration file, pidfile, logfile and unix socket directory.
+When only one process is wanted, the packaged pgbouncer service is
+used as before.
+'''
+
+from collections import namedtuple
+from functools import lru_cache
+import multiprocessing
+import os.path
+import re
+import subprocess
+from textwrap import dedent
+
+from charmhelpers.core import host
+
+
+SERVICE_NAME = 'pgbouncer'
+
+SOCKET_DIR = '/var/run/postgresql'
+
+INSTANCE_SERVICE = 'pgbouncer-instance@{}'
+
+INSTANCE_UNIT_PATH = '/etc/systemd/system/pgbouncer-instance@.service'
+
+# The instance started temporarily to accept connections while a
+# lone pgbouncer process restarts.
+SPARE = 'spare'
+
+# SO_REUSEPORT support appeared in pgbouncer 1.12, and SHUTDOWN
+# WAIT_FOR_CLIENTS in 1.23. Earlier versions keep their listening
+# socket while shutting down.
+REUSEPORT_VERSION = (1, 12)
+WAIT_FOR_CLIENTS_VERSION = (1, 23)
+
+
+Instance = namedtuple('Instance', ['index', 'service', 'config_path',
+                                   'pidfile', 'logfile', 'unix_socket_dir'])
+
+
+def process_count(setting):
+    '''Convert the processes config option to a number of processes.
+
+    >>> process_count('4')
+    4
+    >>> process_count('auto') == multiprocessing.cpu_count()
+    True
+    '''
+    setting = str(setting or '1').strip().lower()
+    if setting == 'auto':
+        return multiprocessing.cpu_count()
+    count = int(setting)
+    if count < 1:
+        raise ValueError('processes must be at least 1')
+    return count
+
+
+def instances(count):
+    '''Return the :class:`Instance` list for count processes.'''
+    if count == 1:
+        return [Instance(index=0, service=SERVICE_NAME,
+                         config_path='/etc/pgbouncer/pgbouncer.ini',
+                         pidfile=os.path.join(SOCKET_DIR, 'pgbouncer.pid'),
+                         logfile='/var/log/postgresql/pgbouncer.log',
+                         unix_socket_dir=SOCKET_DIR)]
+    # The first instance keeps the standard socket directory, so local
+    # tools that assume it continue to work.
+    return [Instance(index=i, service=INSTANCE_SERVICE.format(i),
+                     config_path='/etc/pgbouncer/pgbouncer-{}.ini'.format(i),
+                     pidfile=os.path.join(SOCKET_DIR,
+                                          'pgbouncer-{}.pid'.format(i)),
+                     logfile='/var/log/postgresql/pgbouncer-{}.log'.format(i),
+                     unix_socket_dir=(SOCKET_DIR if i == 0 else
+                                      os.path.join(SOCKET_DIR,
+                                                   'pgbouncer-{}'.format(i))))
+            for i in range(count)]
+
+
+def spare_instance():
+    '''Return the :class:`Instance` used while restarting a lone process.
+
+    It runs from the systemd template unit, like the instances used
+    when there are several processes.
+    '''
+    name = 'pgbouncer-{}'.format(SPARE)
+    return Instance(index=SPARE, service=INSTANCE_SERVICE.format(SPARE),
+                    config_path='/etc/pgbouncer/{}.ini'.format(name),
+                    pidfile=os.path.join(SOCKET_DIR, '{}.pid'.format(name)),
+                    logfile='/var/log/postgresql/{}.log'.format(name),
+                    unix_socket_dir=os.path.join(SOCKET_DIR, name))
+
+
+@lru_cache()
+def version():
+    '''The installed pgbouncer version, as a tuple of integers.
+
+    Returns (0,) if it cannot be determined.
+    '''
+    try:
+        out = subprocess.check_output(['/usr/sbin/pgbouncer', '--version'],
+                                      universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return (0,)
+    return parse_version(out)
+
+
+def parse_version(out):
+    '''Extract the version from the output of pgbouncer --version.
+
+    >>> parse_version('PgBouncer 1.12.0\\nlibevent 2.1.11-stable')
+    (1, 12, 0)
+    >>> parse_version('pgbouncer version 1.7.2')
+    (1, 7, 2)
+    '''
+    match = re.search(r'(\d+)\.(\d+)(?:\.(\d+))?', out)
+    if match is None:
+        return (0,)
+    return tuple(int(n) for n in match.groups() if n is not None)
+
+
+def install_instance_unit():
+    '''Install the systemd template unit used to run several processes.'''
+    contents = dedent('''\
+        # This file is maintained by the pgbouncer juju charm.
+        [Unit]
+        Description=PgBouncer connection pooler (instance %i)
+        After=network.target
+
+        [Service]
+        Type=simple
+        User=postgres
+        ExecStartPre=/bin/mkdir -p {socket_dir}/pgbouncer-%i
+        ExecStart=/usr/sbin/pgbouncer /etc/pgbouncer/pgbouncer-%i.ini
+        ExecReload=/bin/kill -HUP $MAINPID
+        KillSignal=SIGINT
+        Restart=on-failure
+
+        [Install]
+        WantedBy=multi-user.target
+        ''').format(socket_dir=SOCKET_DIR)
+    install_unit(INSTANCE_UNIT_PATH, contents)
+
+
+def install_unit(path, contents):
+    '''Install a systemd unit file, reloading systemd if it changed.
+
+    Returns True if the unit file was changed.
+    '''
+    if _read(path) == contents:
+        return False
+    host.write_file(path, contents.encode(), perms=0o644)
+    subprocess.check_call(['systemctl', 'daemon-reload'])
+    return True
+
+
+def _read(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return f.read()
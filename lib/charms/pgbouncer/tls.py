@@ -0,0 +1,122 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''TLS certificates and keys for pgbouncer, from the charm config.
+
+Material is checked before anything is installed: certificates must
+parse and be unexpired, and each key must match its certificate. Only
+files whose contents differ are replaced, each by an atomic rename, so
+pgbouncer never reads a half written file and unchanged material
+causes no reload.
+'''
+
+from base64 import b64decode
+import binascii
+import hashlib
+import os
+import os.path
+import subprocess
+
+from charmhelpers.core import host
+
+
+# (config option, file) for each file pgbouncer.ini refers to. A
+# certificate and key are only used as a pair.
+FILES = [('client_crt', 'cert_client'),
+         ('client_key', 'key_client'),
+         ('client_ca', 'root_client.crt'),
+         ('server_crt', 'cert_server'),
+         ('server_key', 'key_server'),
+         ('server_ca', 'root_server.crt')]
+
+PAIRS = [('cert_client', 'key_client'), ('cert_server', 'key_server')]
+
+
+def material(config):
+    '''Return the wanted TLS files, mapping file name to contents.
+
+    Raises ValueError if an option is not valid base64.
+    '''
+    files = {}
+    for option, name in FILES:
+        if config.get(option):
+            try:
+                contents = b64decode(config[option])
+            except binascii.Error:
+                raise ValueError('{} is not valid base64'.format(option))
+            files[name] = contents.strip() + b'\n'
+    for cert, key in PAIRS:
+        if cert not in files or key not in files:
+            files.pop(cert, None)
+            files.pop(key, None)
+    return files
+
+
+def _openssl(args, data):
+    proc = subprocess.run(['openssl'] + args, input=data,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        return None
+    return proc.stdout
+
+
+def validate(files):
+    '''Raise ValueError if the material would not work.'''
+    for name, contents in sorted(files.items()):
+        if name.startswith('key_'):
+            continue
+        if _openssl(['x509', '-noout'], contents) is None:
+            raise ValueError('{} is not a valid certificate'.format(name))
+        if _openssl(['x509', '-noout', '-checkend', '0'], contents) is None:
+            raise ValueError('{} has expired'.format(name))
+    for cert, key in PAIRS:
+        if cert not in files:
+            continue
+        public_key = _openssl(['pkey', '-pubout'], files[key])
+        if public_key is None:
+            raise ValueError('{} is not a valid private key'.format(key))
+        if _openssl(['x509', '-noout', '-pubkey'], files[cert]) != public_key:
+            raise ValueError('{} does not match {}'.format(cert, key))
+
+
+def _digest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def install(directory, files, owner='postgres', group='postgres'):
+    '''Install files into directory, returning the names changed.
+
+    Files no longer wanted are removed.
+    '''
+    changed = set()
+    for name, contents in sorted(files.items()):
+        path = os.path.join(directory, name)
+        if _digest(path) == hashlib.sha256(contents).hexdigest():
+            continue
+        host.write_file(path + '.new', contents, owner, group, 0o600)
+        changed.add(name)
+    # A certificate and its key are swapped in together.
+    for name in sorted(changed):
+        path = os.path.join(directory, name)
+        os.rename(path + '.new', path)
+    for _, name in FILES:
+        path = os.path.join(directory, name)
+        if name not in files and os.path.exists(path):
+            os.unlink(path)
+            changed.add(name)
+    return changed
@@ -0,0 +1,186 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Demand driven pool sizing.
+
+The admin consoles of the local pgbouncer processes are sampled over a
+window. For each pgbouncer database, demand is the number of server
+connections in use plus the number of clients waiting for one, summed
+over all processes. The recommended pool size covers the 95th
+percentile of that demand, or the mean number of transactions in flight
+according to SHOW STATS if that is higher, plus some headroom. Pools
+sharing a backend are scaled down together if they would exceed its
+connection budget.
+'''
+
+from collections import namedtuple
+import math
+import time
+
+
+# The admin console pseudo database is never tuned.
+ADMIN_DATABASE = 'pgbouncer'
+
+PERCENTILE = 0.95
+
+
+Demand = namedtuple('Demand', ['peak', 'waiting', 'maxwait', 'concurrency',
+                               'pool_size'])
+
+
+def show(con, what):
+    '''Run a SHOW command on a pgbouncer admin console connection.'''
+    cur = con.cursor()
+    cur.execute('SHOW {}'.format(what))
+    columns = [d[0] for d in cur.description]
+    rows = [dict(zip(columns, row)) for row in cur.fetchall()]
+    cur.close()
+    return rows
+
+
+def _busy_seconds(cons):
+    '''Total seconds spent in transactions, per database.'''
+    busy = {}
+    for con in cons:
+        for row in show(con, 'STATS'):
+            # pgbouncer 1.8 replaced the request counters with
+            # transaction and query counters.
+            usecs = row.get('total_xact_time', row.get('total_query_time'))
+            if usecs is not None:
+                busy[row['database']] = (busy.get(row['database'], 0) +
+                                         int(usecs) / 1000000.0)
+    return busy
+
+
+def _pool_sizes(cons):
+    sizes = {}
+    for con in cons:
+        for row in show(con, 'DATABASES'):
+            sizes[row['name']] = (sizes.get(row['name'], 0) +
+                                  int(row['pool_size'] or 0))
+    return sizes
+
+
+def _pools(cons):
+    '''Current demand and wait time per database, over all processes.'''
+    pools = {}
+    for con in cons:
+        for row in show(con, 'POOLS'):
+            demand, waiting, maxwait = pools.get(row['database'], (0, 0, 0))
+            pools[row['database']] = (
+                demand + int(row['sv_active']) + int(row['cl_waiting']),
+                waiting + int(row['cl_waiting']),
+                max(maxwait, int(row['maxwait'])))
+    return pools
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[max(int(math.ceil(fraction * len(values))) - 1, 0)]
+
+
+def sample(cons, window, interval, clock=time.time, sleep=time.sleep):
+    '''Observe demand on the admin console connections cons.
+
+    SHOW POOLS is sampled every interval seconds for window seconds.
+    Returns a dictionary mapping database names to :class:`Demand`.
+    '''
+    samples = []
+    start = clock()
+    busy_before = _busy_seconds(cons)
+    while True:
+        samples.append(_pools(cons))
+        if clock() - start + interval > window:
+            break
+        sleep(interval)
+    elapsed = max(clock() - start, 1e-6)
+    busy_after = _busy_seconds(cons)
+    pool_sizes = _pool_sizes(cons)
+
+    databases = set()
+    for pools in samples:
+        databases.update(pools)
+    databases.discard(ADMIN_DATABASE)
+
+    demand = {}
+    for database in databases:
+        observed = [pools.get(database, (0, 0, 0)) for pools in samples]
+        busy = (busy_after.get(database, 0) -
+                busy_before.get(database, 0))
+        demand[database] = Demand(
+            peak=_percentile([o[0] for o in observed], PERCENTILE),
+            waiting=max(o[1] for o in observed),
+            maxwait=max(o[2] for o in observed),
+            concurrency=max(busy, 0) / elapsed,
+            pool_size=pool_sizes.get(database))
+    return demand
+
+
+def recommend(demand, budgets, groups, headroom=1.25):
+    '''Recommend a pool size for each database.
+
+    demand maps database names to :class:`Demand`. groups maps each
+    database name to the backend its pool connects to, and budgets
+    maps each backend to the number of connections available to this
+    unit. Backends missing from budgets are unconstrained.
+
+    >>> demand = dict(a=Demand(8, 0, 0, 2.0, 20), b=Demand(0, 0, 0, 0, 20))
+    >>> sorted(recommend(demand, {}, {}).items())
+    [('a', 10), ('b', 1)]
+    >>> sorted(recommend(demand, {'m': 6}, dict(a='m', b='m')).items())
+    [('a', 5), ('b', 1)]
+    '''
+    sizes = dict((database, max(1, int(math.ceil(
+        max(d.peak, d.concurrency) * headroom))))
+        for database, d in demand.items())
+
+    members = {}
+    for database in sizes:
+        members.setdefault(groups.get(database), []).append(database)
+    for backend, databases in members.items():
+        budget = budgets.get(backend)
+        total = sum(sizes[database] for database in databases)
+        if budget is None or total <= budget:
+            continue
+        # Every pool keeps at least one connection. The rest of the
+        # budget is shared in proportion to the recommendations.
+        spare = max(budget - len(databases), 0)
+        wanted = total - len(databases)
+        for database in databases:
+            sizes[database] = 1 + (spare * (sizes[database] - 1) //
+                                   max(wanted, 1))
+    return sizes
+
+
+BUDGET_SQL = '''
+    SELECT
+        current_setting('max_connections')::integer
+        - current_setting('superuser_reserved_connections')::integer
+        - (SELECT count(*) FROM pg_stat_activity
+           WHERE datid IS NOT NULL
+               AND host(client_addr) IS DISTINCT FROM %s)
+    '''
+
+
+def connection_budget(con, address):
+    '''Backend connections available to the pgbouncer unit at address.
+
+    This is max_connections, less the connections reserved for
+    superusers and those in use by every other client, including other
+    pgbouncer units.
+    '''
+    cur = con.cursor()
+    cur.execute(BUDGET_SQL, (address,))
+    return max(cur.fetchone()[0], 0)
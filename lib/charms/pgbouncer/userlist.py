@@ -0,0 +1,100 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''The pgbouncer userlist.txt credential store.
+
+The master copy of userlist.txt is kept in leadership settings.
+Userlist parses it once, serves lookups from a dictionary and records
+which entries have been changed, so the leader can publish all new
+credentials with a single leader-set at the end of the hook.
+'''
+
+import csv
+from io import StringIO
+import os.path
+
+from charmhelpers.core import host
+
+
+USERLIST_PATH = '/etc/pgbouncer/userlist.txt'
+
+# userlist.txt is trivially parsed and regenerated using Python's
+# csv module.
+CSV_DIALECT = dict(delimiter=' ', doublequote=True, quoting=csv.QUOTE_ALL)
+
+
+def parse(text):
+    '''Parse userlist.txt contents into a dictionary.'''
+    if not text:
+        return {}
+    return dict(csv.reader(text.splitlines(), **CSV_DIALECT))
+
+
+def serialize(passwords):
+    '''Render a dictionary as userlist.txt contents, sorted by user.'''
+    s = StringIO()
+    csv.writer(s, **CSV_DIALECT).writerows(sorted(passwords.items()))
+    return s.getvalue()
+
+
+class Userlist(object):
+    '''An indexed, in-memory copy of the leader's userlist.
+
+    synced holds credentials copied from the backend, which are
+    installed alongside the charm's own.
+    '''
+    def __init__(self, text, synced=None):
+        self.passwords = parse(text)
+        self.synced = parse(synced)
+        self.dirty = set()
+
+    def get(self, username):
+        return self.passwords.get(username)
+
+    def set(self, username, password):
+        if self.passwords.get(username) != password:
+            self.passwords[username] = password
+            self.dirty.add(username)
+
+    def generate(self, username):
+        '''Create and return a new random password for username.'''
+        self.set(username, host.pwgen())
+        return self.passwords[username]
+
+    def serialize(self):
+        return serialize(self.passwords)
+
+    def merged(self):
+        '''The userlist.txt contents, including synced credentials.
+
+        The charm's own entries take precedence.
+        '''
+        passwords = dict(self.synced)
+        passwords.update(self.passwords)
+        return serialize(passwords)
+
+
+def write_userlist(text, path=USERLIST_PATH):
+    '''Install text as userlist.txt, if its entries differ.
+
+    Returns True if the file was rewritten. Files differing only in
+    ordering or quoting are considered the same.
+    '''
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            if parse(f.read()) == parse(text):
+                return False
+    host.write_file(path, text.encode(), 'postgres', 'postgres', 0o400)
+    return True
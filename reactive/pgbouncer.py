@@ -13,43 +13,53 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import csv
-from io import StringIO
+from collections import OrderedDict
+import json
 import os.path
 from textwrap import dedent
-from base64 import b64decode
-
-from charmhelpers import context
-from charmhelpers.contrib.openstack.cert_utils import install_certs
-from charmhelpers.core import hookenv, host
-from charmhelpers.core.hookenv import log, INFO
-from charms import reactive, leadership
+import time
+
+from charmhelpers.core import host, unitdata
+from charmhelpers.core.hookenv import log, INFO, WARNING
+from charms import reactive
+from charms import leadership as _leadership
+from charms.pgbouncer import (balancing, connections, credentials, handover,
+                              history, instrumentation, jobqueue, lag,
+                              ostuning, placement, pools, reldata, rendering,
+                              service, tls, tuning, userlist)
+from charms.pgbouncer.helpers import fingerprint, quote_identifier
+from charms.pgbouncer.instrumentation import (instrumented, phase,
+                                              timed_hookenv as hookenv)
+from charms.pgbouncer.provisioning import Provisioner
 from charms.reactive import hook, when, when_any, when_not, not_unless, Endpoint
 
-import jinja2
 import psycopg2
-from psycopg2.extensions import AsIs
 
 from relations.pgsql.requires import ConnectionString, ConnectionStrings
 
 
-SERVICE_NAME = 'pgbouncer'
-
 CLIENT_RELNAME = 'db-proxy'
+PEER_RELNAME = 'cluster'
+
+leadership = instrumentation.TimedTools(_leadership,
+                                        instrumentation.LEADERSHIP_TOOLS)
 
 
 @when('apt.installed.pgbouncer')
+@instrumented
 def bootstrap():
     reactive.set_state('pgbouncer.enabled')
 
 
 @hook('stop')
+@instrumented
 def stop():
     reactive.remove_state('pgbouncer.enabled')
 
 
 @when('pgbouncer.enabled')
 @when_not('backend-db-admin.connected')
+@instrumented
 def blocked():
     hookenv.status_set('blocked', 'Backend relation required')
 
@@ -57,6 +67,7 @@ def blocked():
 @when('pgbouncer.enabled')
 @when('backend-db-admin.connected')
 @when_not('backend-db-admin.master.available')
+@instrumented
 def waiting(backend):
     hookenv.status_set('waiting', 'Waiting for backend relation')
 
@@ -64,6 +75,7 @@ def waiting(backend):
 @when('backend-db-admin.connected')
 @when_not('backend-db-admin.master.available')
 @when('backend-db-admin.master.removed-available')
+@instrumented
 def check_backend_db_available():
     # Try to connect to the database: avoids a situation where
     # backend-db-admin.master.available and database was out of reach
@@ -78,8 +90,10 @@ def check_backend_db_available():
 @when('pgbouncer.enabled')
 @when('backend-db-admin.master.available')
 @when_not('pgbouncer.service_resumed')
+@instrumented
 def enable(backend):
-    if host.service_resume(SERVICE_NAME):
+    if all([host.service_resume(instance.service)
+            for instance in get_instances()]):
         reactive.set_state('pgbouncer.service_resumed')
     else:
         hookenv.status_set('blocked', 'Failed to start')
@@ -88,18 +102,36 @@ def enable(backend):
 @when_not('pgbouncer.enabled')
 @when('apt.installed.pgbouncer')
 @when('pgbouncer.service_resumed')
+@instrumented
 def disable():
     hookenv.status_set('maintenance', 'Disabling')
-    host.service_pause(SERVICE_NAME)
+    for instance in get_instances():
+        host.service_pause(instance.service)
     hookenv.status_set('maintenance', 'Disabled')
     reactive.remove_state('pgbouncer.service_resumed')
 
 
 @when('pgbouncer.needs_restart')
+@instrumented
 def restart():
     hookenv.status_set('maintenance', 'Restarting')
     hookenv.log('Resarting pgbouncer')
-    if host.service_restart(SERVICE_NAME):
+    instances = get_instances()
+    if can_handover(instances):
+        # The instances are drained together while a spare accepts
+        # connections on the shared port.
+        spare = service.spare_instance()
+        service.install_instance_unit()
+        ok = handover.restart([(instance, admin_dsn(instance))
+                               for instance in instances],
+                              hookenv.config()['drain_timeout'],
+                              spare, admin_dsn(spare))
+    else:
+        # Instances are restarted one at a time. When there are several,
+        # the others keep accepting connections on the shared port.
+        ok = all([host.service_restart(instance.service)
+                  for instance in instances])
+    if ok:
         hookenv.status_set('active', 'Active')
         reactive.remove_state('pgbouncer.needs_reload')
         reactive.remove_state('pgbouncer.needs_restart')
@@ -109,6 +141,7 @@ def restart():
 
 @when('pgbouncer.needs_reload')
 @when_not('pgbouncer.needs_restart')
+@instrumented
 def reload():
     config = hookenv.config()
     service_ip = None
@@ -121,7 +154,8 @@ def reload():
                                       service_ip]):
         hookenv.log('pgbouncer restart required')
         reactive.set_state('pgbouncer.needs_restart')
-    elif host.service_reload(SERVICE_NAME):
+    elif all([host.service_reload(instance.service)
+              for instance in get_instances()]):
         reactive.remove_state('pgbouncer.needs_reload')
         hookenv.status_set('active', 'Active')
     else:
@@ -136,50 +170,156 @@ def reload():
           'config.changed.server_ca',
           'config.changed.server_crt',
           'config.changed.server_key')
+@instrumented
 def update_certificate(backend):
+    # configure() installs the new material, and pgbouncer re-reads its
+    # TLS files on reload.
     configure(backend)
+
+
+def install_tls():
+    """Install the TLS certificates and keys from the charm config.
+
+    Nothing is installed if the material is invalid, and False is
+    returned.
+    """
+    kv = unitdata.kv()
+    try:
+        files = tls.material(hookenv.config())
+        digest = fingerprint(dict((name, contents.decode('ascii', 'replace'))
+                                  for name, contents in files.items()))
+        if kv.get('pgbouncer.tls') == digest:
+            return True
+        tls.validate(files)
+    except ValueError as x:
+        log("Not installing TLS material: {}".format(x), WARNING)
+        hookenv.status_set('blocked', 'Invalid TLS config: {}'.format(x))
+        return False
+    changed = tls.install(rendering.PATHS['tls_dir'], files)
+    if changed:
+        log("Installed TLS files {}".format(', '.join(sorted(changed))))
+        reactive.set_state('pgbouncer.needs_reload')
+    kv.set('pgbouncer.tls', digest)
+    return True
+
+
+@when('pgbouncer.enabled')
+@when('backend-db-admin.master.available')
+@when('config.changed.processes')
+@instrumented
+def configure_processes(backend):
+    try:
+        count = service.process_count(hookenv.config()['processes'])
+    except ValueError:
+        hookenv.status_set('blocked', 'Invalid processes setting')
+        return
+    if count > 1 and service.version() < service.REUSEPORT_VERSION:
+        # Several processes share the port with so_reuseport, which
+        # older versions refuse to start with.
+        log('pgbouncer {} does not support SO_REUSEPORT, running a single '
+            'process'.format('.'.join(map(str, service.version()))), WARNING)
+        hookenv.status_set('blocked', 'processes > 1 requires pgbouncer '
+                           '1.12+')
+        count = 1
+    previous = get_instances()
+    if count == len(previous):
+        return
+    hookenv.log('Running {} pgbouncer processes'.format(count))
+    unitdata.kv().set('pgbouncer.processes', count)
+    if count > 1:
+        service.install_instance_unit()
+    wanted = set(instance.service for instance in get_instances())
+    for instance in previous:
+        if instance.service not in wanted:
+            host.service_pause(instance.service)
+    configure(backend)
+    reactive.remove_state('pgbouncer.service_resumed')
     reactive.set_state('pgbouncer.needs_restart')
 
 
+def get_instances():
+    """Return the :class:`Instance` for each pgbouncer process."""
+    return service.instances(unitdata.kv().get('pgbouncer.processes', 1))
+
+
+def handover_mode():
+    """True if restarts should hand over rather than drop connections."""
+    mode = hookenv.config()['restart_mode']
+    if mode not in ('restart', 'handover'):
+        log('Invalid restart_mode {!r}'.format(mode), WARNING)
+        return False
+    # Older versions keep accepting connections while they drain, and
+    # drop them when they exit.
+    return (mode == 'handover' and
+            service.version() >= service.WAIT_FOR_CLIENTS_VERSION)
+
+
+def can_handover(instances):
+    """True if the running instances can be restarted by handover.
+
+    Every running process must already be listening with SO_REUSEPORT.
+    If not, such as when restart_mode has just been changed, a normal
+    restart is needed.
+    """
+    if not (handover_mode() and
+            reactive.is_state('pgbouncer.service_resumed')):
+        return False
+    return all(handover.reuseport_enabled(admin_dsn(instance))
+               for instance in instances)
+
+
 @when('pgbouncer.enabled')
 @when('backend-db-admin.master.available')
-def configure(backend):
+@instrumented
+def configure(backend, force=False):
+    """Reconcile the backend, clients and pgbouncer configuration.
+
+    The inputs are fingerprinted, and nothing is done if they are
+    unchanged since the last successful run, unless force is True.
+    """
     config = hookenv.config()
 
-    relations = context.Relations()
+    relations = reldata.get_relations()
 
-    backend = get_backend()
+    clusters = get_clusters()
+    backends = get_backends()
+
+    kv = unitdata.kv()
+    inputs = reconcile_fingerprint(relations, backends)
+    if not force and kv.get('pgbouncer.reconciled') == inputs:
+        log("Inputs unchanged since the last reconcile, skipping")
+        return
+
+    # Leave pgbouncer running with its current files and configuration
+    # until the TLS material is fixed.
+    if not install_tls():
+        return
 
     con = connect()
     if con is None:
         return
 
-    certs = {}
-    if len(config['client_crt']) > 0 and len(config['client_key']) > 0:
-        certs['client'] = {
-            'cert': b64decode(config['client_crt']).rstrip(),
-            'key': b64decode(config['client_key']).rstrip()
-        }
-    if len(config['server_crt']) > 0 and len(config['server_key']) > 0:
-        certs['server'] = {
-            'cert': b64decode(config['server_crt']).rstrip(),
-            'key': b64decode(config['server_key']).rstrip()
-        }
-    if len(certs) > 0:
-        install_certs("/etc/pgbouncer", certs,
-                      user="postgres", group="postgres")
-    if len(config['client_ca']) > 0:
-        host.install_ca_cert(
-            b64decode(config['client_ca']).rstrip(),
-            name="/etc/pgbouncer/root_client.crt")
-    if len(config['server_ca']) > 0:
-        host.install_ca_cert(
-            b64decode(config['server_ca']).rstrip(),
-            name="/etc/pgbouncer/root_server.crt")
-
-    if config['auth_user'] and hookenv.is_leader():
-        ensure_user(con, config['auth_user'], 'auth', True)
-    dbnames = set()
+    # The leader provisions each backend cluster. Catalogs are read
+    # once, and only the DDL needed to converge is queued after all
+    # clients have been examined. auth_query runs on the cluster of
+    # the database being connected to, so auth_user is on them all.
+    provisioners = {}
+    wanted_extensions = {}
+    if hookenv.is_leader():
+        for cluster in backends:
+            cluster_con = connect(cluster=cluster)
+            if cluster_con is None:
+                continue
+            provisioner = provisioners[cluster] = Provisioner(cluster_con)
+            with phase('provisioning-snapshot'):
+                provisioner.snapshot()
+            if config['auth_user']:
+                provisioner.add_user(config['auth_user'],
+                                     get_password(config['auth_user']),
+                                     ['auth'], True)
+    pool_params = {}
+    clients = []
+    requested = {}
     for relname in ['db', 'db-admin']:
         for relid, relation in relations[relname].items():
             for client_unit, client_relinfo in relation.items():
@@ -193,65 +333,197 @@ def configure(backend):
                             if role.strip())
                 dbname = (client_relinfo.get('database', '').strip() or
                           get_dbname(client_unit))
-                extensions = set(ext.strip()
-                                 for ext in client_relinfo.get('extensions',
-                                                               '').split(',')
-                                 if ext.strip())
-
-                if hookenv.is_leader():
-                    ensure_user(con, uname, roles, relname == 'db-admin')
-                    ensure_database(con, uname, dbname)
-                    ensure_extensions(dbname, extensions)
-
-                dbnames.add(dbname)
-
-                relation.local['version'] = backend.version
-
-                # Send the clients their connection details, starting
-                # with the 'old' v1 protocol. The lead pgbouncer unit will
-                # advertise as the master, and any remaining pgbouncer
-                # units will advertise as a standby.
-                vip = config['vip']
-                if vip:
-                    relation.local['host'] = vip
-                else:
-                    relation.local['host'] = hookenv.unit_private_ip()
-                relation.local['database'] = dbname
-                relation.local['port'] = str(config['listen_port'])
-                relation.local['user'] = uname
-                relation.local['roles'] = client_relinfo.get('roles')
-                relation.local['password'] = pw
-                relation.local['state'] = ('master' if hookenv.is_leader()
-                                           else 'standby')
-                relation.local['allowed-units'] = ' '.join(
-                    sorted(relation.keys()))
-
-                # Next, 'new' v2 protocol, where each unit advertises
-                # the master and all standby connection strings. Clients
-                # should use these connection strings rather than construct
-                # their own from host, database, port etc. If they don't,
-                # they will only be able to connect to a single backend unit
-                # through this pgbouncer unit.
-                c = dict(host=relation.local['host'],
-                         dbname=relation.local['database'],
-                         port=relation.local['port'],
-                         user=relation.local['user'],
-                         password=relation.local['password'])
-                relation.local['master'] = ConnectionString(**c)
-                # pgbouncer presents a single standby. In the future,
-                # we should load balance this single standby over all
-                # available backends using HAProxy or similar.
-                c['dbname'] = '{}_standby'.format(c['dbname'])
-                relation.local['standbys'] = '\n'.join([ConnectionString(**c)])
-
+                exts = set(ext.strip()
+                           for ext in client_relinfo.get('extensions',
+                                                         '').split(',')
+                           if ext.strip())
+
+                wanted_extensions.setdefault(dbname, set()).update(exts)
+                if client_relinfo.get('backend'):
+                    requested[dbname] = client_relinfo['backend'].strip()
+
+                params, errors = pools.parse(client_relinfo)
+                for error in errors:
+                    log("Ignoring invalid pool settings from {}: {}"
+                        "".format(client_unit, error), WARNING)
+                pool_params.setdefault(dbname, {}).update(params)
+
+                clients.append((relid, relation, client_relinfo, uname, pw,
+                                roles, relname == 'db-admin', dbname))
                 break  # One client only. They will agree eventually.
 
+    # The leader places each database on a backend cluster, and the
+    # other units follow its placements. Databases on a cluster without
+    # a master are left alone until it has one again.
+    dbnames = set(client[-1] for client in clients)
+    placements = place_databases(dbnames, clusters, backends, requested)
+    for _, _, _, uname, pw, roles, admin, dbname in clients:
+        cluster = placements.get(dbname)
+        if cluster in provisioners:
+            provisioners[cluster].add_user(uname, pw, roles, admin)
+            provisioners[cluster].add_database(dbname, uname)
+
+    # The leader's DDL is run by the provisioning worker. Clients are
+    # sent their connection details once their database is ready. The
+    # leader publishes the ready databases for the other units.
+    ready = get_ready_databases()
+    if hookenv.is_leader():
+        # Databases on clusters that could not be examined this hook
+        # keep their previous state.
+        ready = set(dbname for dbname in ready & dbnames
+                    if placements.get(dbname) not in provisioners)
+        with phase('provisioning-queue'):
+            for cluster, provisioner in sorted(provisioners.items()):
+                ready.update(queue_provisioning(
+                    provisioner, wanted_extensions, cluster))
+        if ready != get_ready_databases():
+            set_leader_settings(ready_databases=json.dumps(sorted(ready)))
+
+    peers = pgbouncer_units(relations)
+    for relid, relation, client_relinfo, uname, pw, _, _, dbname in clients:
+        if placements.get(dbname) not in backends:
+            continue  # Not yet placed, or its cluster has no master
+        if dbname not in ready:
+            continue
+        backend = backends[placements[dbname]]
+        standbys = get_standbys(backend)
+        relation.local['version'] = backend.version
+
+        # Send the clients their connection details, starting
+        # with the 'old' v1 protocol. The lead pgbouncer unit will
+        # advertise as the master, and any remaining pgbouncer
+        # units will advertise as a standby.
+        vip = config['vip']
+        if vip:
+            relation.local['host'] = vip
+        else:
+            relation.local['host'] = hookenv.unit_private_ip()
+        relation.local['database'] = dbname
+        relation.local['port'] = str(config['listen_port'])
+        relation.local['user'] = uname
+        relation.local['roles'] = client_relinfo.get('roles')
+        relation.local['password'] = pw
+        relation.local['state'] = ('master' if hookenv.is_leader()
+                                   else 'standby')
+        relation.local['allowed-units'] = ' '.join(sorted(relation.keys()))
+
+        # Next, 'new' v2 protocol, where each unit advertises
+        # the master and all standby connection strings. Clients
+        # should use these connection strings rather than construct
+        # their own from host, database, port etc. If they don't,
+        # they will only be able to connect to a single backend unit
+        # through this pgbouncer unit.
+        # If enabled, the connection strings list every pgbouncer
+        # unit, in an order particular to each client relation, so
+        # clients are spread over the units and fail over between
+        # them. Multi-host connection strings need libpq 10 or later.
+        if vip:
+            hosts = [(vip, relation.local['port'])]
+        elif config['multihost_connection_strings']:
+            hosts = [peers[unit] for unit in balancing.rendezvous_order(
+                relid, [(unit, 1) for unit in peers])]
+        else:
+            hosts = [(relation.local['host'], relation.local['port'])]
+        # Clients on this machine, such as subordinates, try the
+        # unix socket first, falling back to TCP while the pgbouncer
+        # process restarts.
+        socket_dir = local_socket_dir(relid, client_relinfo)
+        relation.local['unix-socket-dir'] = socket_dir
+        if socket_dir:
+            hosts.insert(0, (socket_dir, relation.local['port']))
+        c = dict(host=','.join(host for host, _ in hosts),
+                 dbname=relation.local['database'],
+                 port=','.join(port for _, port in hosts),
+                 user=relation.local['user'],
+                 password=relation.local['password'])
+        if (config['load_balance_hosts'] and not socket_dir and
+                len(hosts) > 1):
+            c['load_balance_hosts'] = 'random'
+        relation.local['master'] = ConnectionString(**c)
+        # pgbouncer presents a pool per backend standby. Each
+        # client relation is given its own ordering of them, so
+        # clients using the first connection string are spread
+        # over all standbys in proportion to their weights.
+        standby_pools = (standby_pool_order(standbys, relid) or
+                         ['standby'])
+        relation.local['standbys'] = '\n'.join(
+            ConnectionString(**dict(c, dbname='{}_{}'.format(dbname, pool)))
+            for pool in standby_pools)
+
     # We have everything we need. Generate a valid pgbouncer
     # configuration.
-    generate_pgbouncer_config(dbnames)
+    generate_pgbouncer_config(
+        dict((dbname, cluster) for dbname, cluster in placements.items()
+             if dbname in dbnames), pool_params)
+
+    # Retry next hook if the backend was lost part way through. The
+    # fingerprint is retaken, as the leader may have generated new
+    # passwords.
+    if reactive.is_state('backend-db-admin.master.available'):
+        kv.set('pgbouncer.reconciled',
+               reconcile_fingerprint(relations, get_backends()))
+
+
+def reconcile_fingerprint(relations, backends):
+    """Fingerprint everything configure() depends on.
+
+    The userlist is taken from the hook's :class:`Userlist`, which
+    includes passwords not yet published to leadership settings.
+    """
+    kv = unitdata.kv()
+    settings = dict(get_leader_settings(),
+                    userlist=get_userlist().serialize())
+    # Synced credentials only change userlist.txt.
+    settings.pop('userlist_synced', None)
+    # Only the first unit's settings are used, so only they are read.
+    clients = dict((relname, dict(
+        (relid, [list(relation),
+                 dict(relation[next(iter(relation))]) if relation else {}])
+        for relid, relation in relations[relname].items()))
+        for relname in ['db', 'db-admin'])
+    return fingerprint(dict(hookenv.config()),
+                       [[name, str(backend.master), sorted(backend.standbys),
+                         backend.version]
+                        for name, backend in backends.items()],
+                       clients,
+                       settings,
+                       hookenv.is_leader(),
+                       hookenv.unit_private_ip(),
+                       kv.get('pgbouncer.processes'),
+                       kv.get('pgbouncer.pool_sizes'),
+                       kv.get('pgbouncer.lagging_standbys'),
+                       sorted(pgbouncer_units(relations).items()))
+
+
+def pgbouncer_units(relations):
+    """Return the (host, port) of each running pgbouncer unit.
+
+    Peers advertise themselves while pgbouncer is running. The local
+    unit is always included.
+    """
+    units = {hookenv.local_unit(): (hookenv.unit_private_ip(),
+                                    str(hookenv.config()['listen_port']))}
+    for relation in relations[PEER_RELNAME].values():
+        for unit in relation:
+            settings = relation[unit]
+            if settings.get('host') and settings.get('port'):
+                units[unit] = (settings['host'], settings['port'])
+    return units
+
+
+@when('pgbouncer.enabled')
+@instrumented
+def advertise_to_peers():
+    """Tell the other pgbouncer units where this one listens."""
+    running = reactive.is_state('pgbouncer.service_resumed')
+    for relation in reldata.get_relations()[PEER_RELNAME].values():
+        relation.local['host'] = hookenv.unit_private_ip() if running else None
+        relation.local['port'] = (str(hookenv.config()['listen_port'])
+                                  if running else None)
 
 
 @when('apt.installed.pgbouncer')
+@instrumented
 def ensure_admin_passwords():
     users = ['root', 'postgres', 'ubuntu', 'pgbouncer', 'nagios']
     for user in users:
@@ -265,46 +537,184 @@ def ensure_admin_passwords():
                 user, user, 0o600)
 
 
-@when('config.changed.listen_port')
+@when_any('config.changed.listen_port', 'config.changed.processes')
+@instrumented
 def ensure_console_shortcut():
-    """Generate a small script to connect to the pgbouncer console."""
+    """Generate a small script to connect to the pgbouncer console.
+
+    When several pgbouncer processes are running, the console of a
+    specific process is reached by passing its number as the first
+    argument.
+    """
     config = hookenv.config()
+    instances = get_instances()
+    cases = ''
+    if len(instances) > 1:
+        cases = ''.join(
+            '    {}) shift; exec psql -h {} -p {} pgbouncer "$@" ;;\n'.format(
+                instance.index, instance.unix_socket_dir,
+                config['listen_port'])
+            for instance in instances)
+        cases = 'case "$1" in\n{}esac\n'.format(cases)
     contents = dedent("""\
                       #!/bin/sh
                       export LC_ALL=en_US.UTF-8
-                      exec psql -h localhost -p {} pgbouncer
-                      """).format(config['listen_port'])
+                      {}exec psql -h localhost -p {} pgbouncer "$@"
+                      """).format(cases, config['listen_port'])
     host.write_file('/usr/local/bin/pgbouncer-cli',
                     contents.encode(), perms=0o555)
     reactive.set_state('pgbouncer.cli.created')
 
 
-@when('config.changed.listen_port')
+@when_any('config.changed.listen_port', 'config.changed.metrics_port')
+@instrumented
 def open_ports():
-    key = 'listen_port'
     config = hookenv.config()
-    if config.previous(key) is not None:
-        hookenv.close_port(config.previous(key))
-    hookenv.open_port(config[key])
+    for key in ['listen_port', 'metrics_port']:
+        previous = config.previous(key)
+        if previous and previous != config[key]:
+            hookenv.close_port(previous)
+        if config[key]:
+            hookenv.open_port(config[key])
+
+
+EXPORTER_SERVICE = 'pgbouncer-exporter'
 
 
-def generate_pgbouncer_config(databases):
-    loader = jinja2.FileSystemLoader(
-        os.path.join(hookenv.charm_dir(), 'templates'))
-    env = jinja2.Environment(loader=loader)
-    env.globals['config'] = hookenv.config()
+@when('pgbouncer.enabled')
+@instrumented
+def configure_os_limits():
+    """Size file descriptor limits and kernel queues for the connections.
+
+    Changed file descriptor limits only apply to restarted processes.
+    """
+    config = hookenv.config()
+    count = len(get_instances())
+    clients = -(-config['max_client_conn'] // count)
+    servers = unitdata.kv().get('pgbouncer.server_connections') or 0
+    nofile = ostuning.required_fds(clients, -(-servers // count))
+    ceiling = ostuning.fd_ceiling()
+    if nofile > ceiling:
+        hookenv.status_set('blocked', 'max_client_conn needs {} file '
+                           'descriptors per process, over the limit of {}'
+                           ''.format(nofile, ceiling))
+        nofile = ceiling
+    backlog = rendering.listen_backlog(config['listen_backlog'], clients)
+    settings = dict(nofile=nofile, sysctls=ostuning.sysctls(backlog, servers))
+    if not reactive.helpers.data_changed('pgbouncer.os_limits', settings):
+        return
+
+    hookenv.log('Setting LimitNOFILE={} for {} client and {} server '
+                'connections'.format(nofile, clients, servers))
+    if ostuning.install_limits(nofile):
+        reactive.set_state('pgbouncer.needs_restart')
+    ostuning.apply_sysctls(settings['sysctls'])
+
+
+@when('pgbouncer.enabled')
+@when('pgbouncer.service_resumed')
+@instrumented
+def configure_exporter():
+    """Install and run the Prometheus exporter, if enabled."""
+    config = hookenv.config()
+    password = get_password('nagios')
+    if not config['metrics_port'] or password is None:
+        settings = None
+    else:
+        settings = dict(metrics_port=config['metrics_port'],
+                        interval=config['metrics_interval'],
+                        listen_port=config['listen_port'],
+                        password=password,
+                        socket_dirs=[instance.unix_socket_dir
+                                     for instance in get_instances()])
+    if not reactive.helpers.data_changed('pgbouncer.exporter', settings):
+        return
+
+    unit_path = '/etc/systemd/system/{}.service'.format(EXPORTER_SERVICE)
+    if settings is None:
+        if os.path.exists(unit_path):
+            hookenv.log('Disabling Prometheus exporter')
+            host.service_pause(EXPORTER_SERVICE)
+        return
+
+    hookenv.log('Configuring Prometheus exporter on port {}'
+                ''.format(settings['metrics_port']))
+    script = '/usr/local/bin/pgbouncer-exporter'
+    install_script('pgbouncer-exporter.py', script)
+    host.write_file('/etc/pgbouncer/exporter.env',
+                    'PGPASSWORD={}\n'.format(password).encode(),
+                    perms=0o600)
+    args = ['--listen-port', str(settings['metrics_port']),
+            '--interval', str(settings['interval']),
+            '--port', str(settings['listen_port'])]
+    for socket_dir in settings['socket_dirs']:
+        args.extend(['--socket-dir', socket_dir])
+    service.install_unit(
+        unit_path,
+        dedent("""\
+               # This file is maintained by the pgbouncer juju charm.
+               [Unit]
+               Description=Prometheus exporter for PgBouncer
+               After=network.target
+
+               [Service]
+               User=postgres
+               EnvironmentFile=/etc/pgbouncer/exporter.env
+               ExecStart=/usr/bin/python3 {} {}
+               Restart=always
+               RestartSec=10
+
+               [Install]
+               WantedBy=multi-user.target
+               """).format(script, ' '.join(args)))
+    host.service_resume(EXPORTER_SERVICE)
+    host.service_restart(EXPORTER_SERVICE)
+
+
+def install_script(name, path):
+    """Install a script shipped in the charm's scripts directory."""
+    with open(os.path.join(hookenv.charm_dir(), 'scripts', name), 'rb') as f:
+        host.write_file(path, f.read(), perms=0o755)
+
+
+@instrumented
+def generate_pgbouncer_config(databases, pool_params=None):
+    """Render the pgbouncer configuration.
+
+    databases maps each client database to the backend cluster it is
+    placed on.
+    """
+    pool_params = pool_params or {}
     vip = hookenv.config('vip')
     if vip:
-        env.globals['listen_addr'] = '*'
+        listen_addr = '*'
     else:
-        env.globals['listen_addr'] = hookenv.unit_private_ip()
+        listen_addr = hookenv.unit_private_ip()
 
     def pgbouncer_quote(x):
         return x.replace('"', '""')
 
-    backend = get_backend()
+    backends = get_backends()
+
+    # Standbys lagging too far behind keep their pools, so client
+    # connection strings remain valid, but the pools are pointed at
+    # another standby of the cluster, or its master if none remain.
+    lagging = set(unitdata.kv().get('pgbouncer.lagging_standbys') or [])
+
+    def _route(backend, routable, key):
+        order = standby_pool_order(routable, key)
+        return routable[order[0]][0] if order else backend.master
+
+    config = hookenv.config()
+    instances = get_instances()
+    count = len(instances)
+
+    # Pool sizes applied by the tune-pools action. Pool parameters
+    # requested by clients take precedence.
+    pool_sizes = unitdata.kv().get('pgbouncer.pool_sizes') or {}
 
-    database_stanzas = set()
+    database_stanzas = []
+    server_connections = []
 
     def _bouncer_cs(cs, dbname):
         # Convert backend relation ConnectionString to pgbouncer
@@ -312,64 +722,301 @@ def generate_pgbouncer_config(databases):
         # since the client supplies these, and dbname is forced.
         return ConnectionString(cs, user=None, password=None, dbname=dbname)
 
-    # Database section for the master or standalone database.
-    for dbname in databases:
+    def _stanza(name, dbname, cs):
+        params = {}
+        if name in pool_sizes:
+            params['pool_size'] = pool_sizes[name]
+        params.update(pool_params.get(dbname, {}))
+        server_connections.append(pools.server_connections(
+            params, config['default_pool_size'], config['reserve_pool_size']))
+        return "{} = {}{}".format(pgbouncer_quote(name), cs,
+                                  pools.render(params, count))
+
+    # Database section for the master or standalone database, a
+    # pool for each standby, and the <db>_standby pool used by v1
+    # clients. Each pgbouncer unit points <db>_standby at a different
+    # standby, chosen by weight.
+    for dbname, cluster in sorted(databases.items()):
+        backend = backends.get(cluster)
+        if backend is None:
+            continue
+        standbys = get_standbys(backend)
+        routable = dict((pool, s) for pool, s in standbys.items()
+                        if standby_address(s[0]) not in lagging)
         if backend.master:
-            database_stanzas.add("{} = {}".format(
-                pgbouncer_quote(dbname),
-                _bouncer_cs(backend.master, dbname)))
-        for standby in backend.standbys:
-            database_stanzas.add("{}_standby = {}".format(
-                pgbouncer_quote(dbname),
+            database_stanzas.append(_stanza(
+                dbname, dbname, _bouncer_cs(backend.master, dbname)))
+        for pool, (standby, _) in sorted(standbys.items()):
+            if pool not in routable:
+                standby = _route(backend, routable, pool)
+            database_stanzas.append(_stanza(
+                "{}_{}".format(dbname, pool), dbname,
                 _bouncer_cs(standby, dbname)))
-            break
+        if standbys:
+            database_stanzas.append(_stanza(
+                "{}_standby".format(dbname), dbname,
+                _bouncer_cs(_route(backend, routable, hookenv.local_unit()),
+                            dbname)))
+
+    # Regenerate /etc/pgbouncer/pgbouncer.ini, or one configuration
+    # file per process when several share the listen port. Pool sizes
+    # are divided between the processes.
+    template_dir = os.path.join(hookenv.charm_dir(), 'templates')
+    reuseport = count > 1 or handover_mode()
+    if handover_mode():
+        # A spare covers while the processes restart.
+        instances = instances + [service.spare_instance()]
+    for instance in instances:
+        contents = rendering.render_config(
+            template_dir, config, instance, database_stanzas, count,
+            reuseport, listen_addr)
+        config_path = instance.config_path
+
+        if (not os.path.exists(config_path) or
+                contents.encode() != open(config_path, 'rb').read()):
+            hookenv.log('Updating {}'.format(config_path))
+            host.write_file(config_path, contents.encode())
+            if instance.index != service.SPARE:
+                reactive.set_state('pgbouncer.needs_reload')
+
+    # Used to size the file descriptor limits.
+    unitdata.kv().set('pgbouncer.server_connections', sum(server_connections))
 
-    # Regenerate /etc/pgbouncer/pgbouncer.ini
-    template = env.get_template('pgbouncer.ini.tmpl')
-    contents = template.render(database_stanzas=database_stanzas)
-    config_path = '/etc/pgbouncer/pgbouncer.ini'
 
-    if contents.encode() != open(config_path, 'rb').read():
-        hookenv.log('Updating pgbouncer.ini')
-        host.write_file('/etc/pgbouncer/pgbouncer.ini', contents.encode())
-        reactive.set_state('pgbouncer.needs_reload')
+@not_unless('backend-db-admin.master.available')
+@instrumented
+def connect(dbname='postgres', cluster=None):
+    """Return a connection to dbname on a backend cluster's master.
+
+    The first cluster is used by default. Connections are cached and
+    shared for the rest of the hook, and closed when it exits. Callers
+    must not close them.
+    """
+    try:
+        return connections.get_cache().get(backend_dsn(dbname, cluster))
+    except psycopg2.OperationalError:
+        if cluster is None or cluster == next(iter(get_backends()), None):
+            backend_unavailable()
+        else:
+            log("Unable to connect to backend cluster {}".format(cluster),
+                WARNING)
+        return None
 
-    # Regenerate /etc/default/pgbouncer.
-    # contents = dedent("""\
-    #                   START=1
-    #                   ulimit -n 65536
-    #                   """)
-    # host.write_file('/etc/default/pgbouncer', contents)
+
+def backend_dsn(dbname, cluster=None):
+    """The libpq connection string for dbname on a cluster's master."""
+    c = dict(get_backend(cluster).master)
+    c['dbname'] = dbname
+    return str(ConnectionString(**c))
+
+
+def backend_unavailable():
+    # Even though our reactive states are set, they may lag behind
+    # reality. The PostgreSQL backend may have already run its
+    # -departed hook and revoked access, before this units
+    # backend-db-admin-relation-departed hook has had a chance to
+    # run.
+    hookenv.log("connect(): failed to connect to database,"
+                " removing backend-db-admin.master.available")
+    reactive.remove_state('backend-db-admin.master.available')
+    reactive.set_state(
+        'backend-db-admin.master.removed-available')
+
+
+def get_clusters():
+    """Return the :class:`ConnectionStrings` of each backend cluster.
+
+    Each backend-db-admin relation is a cluster, named for the related
+    application, whether or not it currently has a master. The name is
+    remembered for as long as the relation exists, so a cluster whose
+    units have all departed keeps its name and its databases. Clusters
+    are in name order.
+    """
+    relations = reldata.get_relations()['backend-db-admin']
+    kv = unitdata.kv()
+    known = kv.get('pgbouncer.cluster_names') or {}
+    names = {}
+    clusters = {}
+    for relid in Endpoint.from_name('backend-db-admin').relations:
+        units = list(relations.get(relid, ()))
+        if units:
+            names[relid] = units[0].split('/')[0]
+        elif relid in known:
+            names[relid] = known[relid]
+        else:
+            continue  # Not yet joined by any unit
+        clusters[names[relid]] = ConnectionStrings(relid)
+    if names != known:
+        kv.set('pgbouncer.cluster_names', names)
+    return OrderedDict(sorted(clusters.items()))
 
 
 @not_unless('backend-db-admin.master.available')
-def connect(dbname='postgres'):
-    c = dict(get_backend().master)
-    c['dbname'] = dbname
+def get_backends():
+    """Return the :class:`ConnectionStrings` of each backend cluster
+    with a master, in name order.
+    """
+    return OrderedDict((name, backend)
+                       for name, backend in get_clusters().items()
+                       if backend.master)
+
+
+def get_backend(cluster=None):
+    """Return the :class:`ConnectionStrings` of a backend cluster.
+
+    The first cluster is returned by default.
+    """
+    backends = get_backends()
+    if cluster is None:
+        return next(iter(backends.values()), None)
+    return backends.get(cluster)
+
+
+def place_databases(dbnames, clusters, backends, requested):
+    """Return the backend cluster of each database.
+
+    The leader places new databases on clusters with a master, and
+    publishes the placements in leadership settings. Databases stay on
+    their cluster while it is related, even while it has no master, so
+    a failover never moves them. Other units use the leader's
+    placements, leaving out databases it has not yet placed.
+    """
+    current = placement.deserialize(get_leader_settings().get('placements'))
+    if not hookenv.is_leader():
+        return dict((dbname, cluster) for dbname, cluster in current.items()
+                    if dbname in dbnames and cluster in clusters)
     try:
-        con = psycopg2.connect(str(ConnectionString(**c)))
-    except psycopg2.OperationalError:
-        # Even though our reactive states are set, they may lag behind
-        # reality. The PostgreSQL backend may have already run its
-        # -departed hook and revoked access, before this units
-        # backend-db-admin-relation-departed hook has had a chance to
-        # run.
-        hookenv.log("connect(): failed to connect to database,"
-                    " removing backend-db-admin.master.available")
-        reactive.remove_state('backend-db-admin.master.available')
-        reactive.set_state(
-            'backend-db-admin.master.removed-available')
+        mapping = placement.parse_mapping(
+            hookenv.config()['database_backends'])
+    except ValueError as x:
+        log("Ignoring database_backends: {}".format(x), WARNING)
+        mapping = {}
+    placed = placement.place(dbnames, clusters, current, mapping, requested,
+                             backends)
+    for dbname in sorted(dbnames):
+        wanted = mapping.get(dbname) or requested.get(dbname)
+        if dbname not in placed:
+            log("No backend cluster {} for database {}".format(
+                wanted, dbname), WARNING)
+        elif wanted and wanted != placed[dbname]:
+            log("Database {} stays on backend cluster {}, which holds its "
+                "data, rather than {}".format(dbname, placed[dbname], wanted),
+                WARNING)
+    # Databases no longer used keep their placement, so they return to
+    # the cluster holding their data.
+    if dict(current, **placed) != current:
+        set_leader_settings(
+            placements=placement.serialize(dict(current, **placed)))
+    return placed
+
+
+def get_ready_databases():
+    """Return the databases the leader has provisioned for their clients.
+    """
+    try:
+        return set(json.loads(
+            get_leader_settings().get('ready_databases') or '[]'))
+    except (TypeError, ValueError):
+        return set()
+
+
+def get_standbys(backend):
+    """Return the routable backend standbys.
+
+    Returns a dictionary mapping pool suffix to a (ConnectionString,
+    weight) tuple. Standbys are numbered in address order, so pool
+    names remain stable while the set of standbys is unchanged.
+    Standbys given a weight of 0 in the standby_weights option are
+    omitted.
+    """
+    try:
+        weights = balancing.parse_weights(hookenv.config()['standby_weights'])
+    except ValueError as x:
+        log("Ignoring standby_weights: {}".format(x), WARNING)
+        hookenv.status_set('blocked', 'Invalid standby_weights: {}'.format(x))
+        weights = {}
+    standbys = sorted((dict(cs).get('host', ''), str(dict(cs).get('port', '')),
+                       cs) for cs in backend.standbys)
+    pools = {}
+    for i, (addr, port, standby) in enumerate(standbys):
+        weight = balancing.weight_for(weights, addr, port)
+        if weight > 0:
+            pools['standby_{}'.format(i)] = (standby, weight)
+    return pools
+
+
+def standby_address(cs):
+    """The host:port of a backend ConnectionString."""
+    c = dict(cs)
+    return '{}:{}'.format(c.get('host', ''), c.get('port', ''))
+
+
+@when('pgbouncer.enabled')
+@when('backend-db-admin.master.available')
+@instrumented
+def monitor_standby_lag():
+    """Route around standbys lagging more than standby_max_lag."""
+    threshold = hookenv.config()['standby_max_lag']
+    kv = unitdata.kv()
+    excluded = set(kv.get('pgbouncer.lagging_standbys') or [])
+    backends = [(cluster, backend)
+                for cluster, backend in get_backends().items()
+                if backend.standbys]
+    if threshold > 0 and backends:
+        last = kv.get('pgbouncer.lag_checked_at', 0)
+        if time.time() - last < lag.CHECK_INTERVAL:
+            return
+        kv.set('pgbouncer.lag_checked_at', time.time())
+        lags = {}
+        for cluster, backend in backends:
+            dsns = dict((standby_address(cs),
+                         str(ConnectionString(
+                             cs, dbname='postgres',
+                             connect_timeout=str(lag.CONNECT_TIMEOUT))))
+                        for cs in backend.standbys)
+            # Standbys are compared with the master's WAL position, so
+            # one whose WAL receiver has stalled is seen to lag.
+            lags.update(lag.measure_all(connections.get_cache(), dsns,
+                                        backend.version,
+                                        backend_dsn('postgres', cluster)))
+        lagging = lag.lagging(lags, excluded, threshold)
+        for name in sorted(lagging - excluded):
+            log("Standby {} is {:.0f}s behind, routing around it".format(
+                name, lags[name]), WARNING)
+        for name in sorted(excluded & set(lags) - lagging):
+            log("Standby {} is {:.0f}s behind, routing to it again".format(
+                name, lags[name]), INFO)
+    else:
+        lagging = set()
+    if lagging != excluded:
+        kv.set('pgbouncer.lagging_standbys', sorted(lagging))
+        reconfigure()
+
+
+def local_socket_dir(key, relinfo):
+    """The unix socket directory to advertise to a client, or None.
+
+    Only clients on this machine can reach the socket. With several
+    pgbouncer processes, each has its own socket, and clients are
+    spread over them by rendezvous hash of key.
+    """
+    if not hookenv.config()['unix_socket_clients']:
+        return None
+    addresses = set([relinfo.get('private-address'),
+                     relinfo.get('ingress-address')])
+    if hookenv.unit_private_ip() not in addresses:
         return None
-    con.autocommit = True
-    return con
+    instances = dict((str(instance.index), instance)
+                     for instance in get_instances())
+    order = balancing.rendezvous_order(
+        key, [(index, 1) for index in instances])
+    return instances[order[0]].unix_socket_dir
 
 
-@not_unless('backend-db-admin.master.available')
-def get_backend():
-    '''Return the :class:`ConnectionStrings` to the backend databases'''
-    tep = Endpoint.from_name('backend-db-admin')
-    for relid in tep.relations:
-        return ConnectionStrings(relid)
+def standby_pool_order(standbys, key):
+    """Order standby pool suffixes for key by weighted rendezvous hash."""
+    return balancing.rendezvous_order(
+        key, [(pool, weight) for pool, (_, weight) in standbys.items()])
 
 
 def get_username(relid, unit, schema=False):
@@ -400,178 +1047,552 @@ def get_password(username):
     The password will be generated and stored in userlist.txt if it
     does not already exist.
     """
-    # userlist.txt is trivially parsed and regenerated using Python's
-    # csv module.
-    csv_dialect = dict(delimiter=' ', doublequote=True, quoting=csv.QUOTE_ALL)
-
-    # Master copy is stored in leadership settings.
-    userlist = leadership.leader_get('userlist')
-    if userlist:
-        passwords = dict(csv.reader(userlist.splitlines(), **csv_dialect))
-    else:
-        passwords = {}
+    store = get_userlist()
+    password = store.get(username)
+    if password is None and hookenv.is_leader():
+        password = store.generate(username)
+    return password
 
-    if username not in passwords and hookenv.is_leader():
-        passwords[username] = host.pwgen()
-        s = StringIO()
-        csv.writer(s, **csv_dialect).writerows(passwords.items())
-        leadership.leader_set(userlist=s.getvalue())
 
-    return passwords.get(username)
+_leader_settings = None
+_leader_changes = {}
+
+
+def get_leader_settings():
+    """Return the leadership settings, read once per hook.
+
+    Settings changed with set_leader_settings() are included.
+    """
+    global _leader_settings
+    if _leader_settings is None:
+        _leader_settings = dict(leadership.leader_get() or {})
+        hookenv.atexit(flush_leader_settings)
+    return _leader_settings
+
+
+def set_leader_settings(**settings):
+    """Change leadership settings.
+
+    Changes are published by a single leader-set when the hook exits.
+    """
+    get_leader_settings().update(settings)
+    _leader_changes.update(settings)
+
+
+def flush_leader_settings():
+    # Registered before the hook's other exit handlers, so runs after
+    # them and publishes their changes too.
+    global _leader_settings
+    changes = dict(_leader_changes)
+    _leader_settings = None
+    _leader_changes.clear()
+    if changes and hookenv.is_leader():
+        leadership.leader_set(**changes)
+
+
+_userlist = None
+
+
+def get_userlist():
+    """Return the :class:`Userlist` for this hook.
+
+    The master copy is stored in leadership settings. It is parsed
+    on first use, and any new passwords are published by a single
+    leader-set when the hook exits.
+    """
+    global _userlist
+    if _userlist is None:
+        settings = get_leader_settings()
+        _userlist = userlist.Userlist(settings.get('userlist'),
+                                      settings.get('userlist_synced'))
+        hookenv.atexit(flush_userlist)
+    return _userlist
+
+
+def flush_userlist():
+    global _userlist
+    store, _userlist = _userlist, None
+    if store is None or not store.dirty or not hookenv.is_leader():
+        return
+    hookenv.log('Publishing {} new userlist entries'.format(len(store.dirty)))
+    contents = store.serialize()
+    set_leader_settings(userlist=contents)
+    # The leadership.changed.userlist state will not be seen by this
+    # unit, so install the new userlist.txt here rather than waiting
+    # for sync_userlist().
+    if (userlist.write_userlist(store.merged()) and
+            reactive.is_state('pgbouncer.service_resumed')):
+        for instance in get_instances():
+            host.service_reload(instance.service)
 
 
 @when('apt.installed.pgbouncer')
 @when_not('leadership.set.userlist')
+@instrumented
 def initialize_userlist():
     '''Ensure userlist.txt exists to keep the pgbouncer daemon happy.'''
-    userlist = '/etc/pgbouncer/userlist.txt'
-    host.write_file(userlist, ''.encode(), 'postgres', 'postgres', 0o400)
+    host.write_file(userlist.USERLIST_PATH, ''.encode(),
+                    'postgres', 'postgres', 0o400)
 
 
 @when('apt.installed.pgbouncer')
-@when('leadership.changed.userlist')
+@when_any('leadership.changed.userlist', 'leadership.changed.userlist_synced')
+@instrumented
 def sync_userlist():
-    userlist = '/etc/pgbouncer/userlist.txt'
-    host.write_file(userlist, leadership.leader_get('userlist').encode(),
-                    'postgres', 'postgres', 0o400)
+    if userlist.write_userlist(get_userlist().merged()):
+        reactive.set_state('pgbouncer.needs_reload')
 
 
-def ensure_database(con, user, database):
-    cur = con.cursor()
-    try:
-        cur.execute(
-            "SELECT datname FROM pg_database WHERE datname = %s", (database,))
-        if not cur.fetchone():
-            log("Creating database {}".format(database), INFO)
-            cur.execute("CREATE DATABASE %s", (pgidentifier(database),))
-        cur.execute(
-            "GRANT CONNECT ON DATABASE %s TO %s",
-            (pgidentifier(database), pgidentifier(user)))
-    except psycopg2.IntegrityError:
-        # Race with another unit. DB already created.
-        pass
-
-
-def ensure_user(con, user, roles, admin):
-    cur = con.cursor()
-    if not role_exists(con, user):
-        if admin:
-            log("Creating superuser {}".format(user), INFO)
-            cur.execute("CREATE ROLE %s WITH SUPERUSER LOGIN PASSWORD %s",
-                        (pgidentifier(user), get_password(user)))
-        else:
-            log("Creating user {}".format(user), INFO)
-            cur.execute("CREATE ROLE %s WITH LOGIN PASSWORD %s",
-                        (pgidentifier(user), get_password(user)))
-
-    # Reset the user's roles.
-    wanted_roles = set(roles)
-    cur.execute("""
-        SELECT role.rolname
-        FROM pg_roles AS role, pg_roles AS member, pg_auth_members
-        WHERE
-            member.oid = pg_auth_members.member
-            AND role.oid = pg_auth_members.roleid
-            AND member.rolname = %s
-        """, (user,))
-    existing_roles = set(r[0] for r in cur.fetchall())
-    roles_to_grant = wanted_roles.difference(existing_roles)
-    roles_to_revoke = existing_roles.difference(wanted_roles)
-
-    for role in roles_to_grant:
-        if not role_exists(con, role):
-            log("Creating role {}".format(role), INFO)
-            cur.execute("CREATE ROLE %s INHERIT NOLOGIN",
-                        (pgidentifier(role),))
-        log("Granting {} to {}".format(role, user), INFO)
-        cur.execute(
-            "GRANT %s TO %s",
-            (pgidentifier(role), pgidentifier(user)))
-
-    for role in roles_to_revoke:
-        log("Revoking {} from {}".format(role, user), INFO)
-        cur.execute(
-            "REVOKE %s FROM %s",
-            (pgidentifier(role), pgidentifier(user)))
-
-
-def role_exists(con, role):
-    cur = con.cursor()
-    cur.execute("SELECT rolname FROM pg_roles WHERE rolname = %s", (role,))
-    return cur.fetchone() is not None
-
-
-def ensure_extensions(dbname, extensions):
-    if extensions:
-        con = connect(dbname)
+@when('leadership.is_leader')
+@when('pgbouncer.enabled')
+@when('backend-db-admin.master.available')
+@instrumented
+def sync_credentials():
+    """Copy allowlisted credentials from the backend into userlist.txt.
+
+    Logins for these users are then checked locally, rather than with
+    auth_query. The backend is checked again every
+    credential_sync_interval seconds, at the next hook.
+    """
+    config = hookenv.config()
+    roles = credentials.allowlist(config['credential_sync_roles'])
+    kv = unitdata.kv()
+    store = get_userlist()
+    current = store.synced
+    if not roles:
+        if current:
+            log("Credential sync disabled, removing {} synced users"
+                "".format(len(current)))
+            publish_synced_credentials({})
+        return
+
+    last = kv.get('pgbouncer.credentials_synced_at', 0)
+    if (kv.get('pgbouncer.credential_sync_roles') == roles and
+            time.time() - last < config['credential_sync_interval']):
+        return
+
+    # Every cluster must be reached, or the roles on those that were
+    # not would be dropped. A role on several clusters is taken from
+    # the first.
+    synced = {}
+    for cluster in reversed(get_backends()):
+        con = connect(cluster=cluster)
         if con is None:
             return
-        cur = con.cursor()
-        for ext in extensions:
-            cur.execute('CREATE EXTENSION IF NOT EXISTS %s',
-                        (pgidentifier(ext),))
+        try:
+            synced.update(credentials.fetch(con, roles,
+                                            exclude=store.passwords))
+        except psycopg2.Error as x:
+            log("Unable to sync credentials: {}".format(x), WARNING)
+            return
+    kv.set('pgbouncer.credentials_synced_at', time.time())
+    kv.set('pgbouncer.credential_sync_roles', roles)
+
+    added, changed, removed = credentials.diff(current, synced)
+    if added or changed or removed:
+        log("Synced credentials: {} added, {} changed, {} removed".format(
+            len(added), len(changed), len(removed)), INFO)
+        publish_synced_credentials(synced)
+
+
+def publish_synced_credentials(synced):
+    store = get_userlist()
+    store.synced = synced
+    set_leader_settings(userlist_synced=userlist.serialize(synced))
+    # As in flush_userlist(), the leader installs its own copy.
+    if userlist.write_userlist(store.merged()):
+        reactive.set_state('pgbouncer.needs_reload')
 
 
-def sanitize(s):
-    s = s.replace(':', '_')
-    s = s.replace('-', '_')
-    s = s.replace('/', '_')
-    s = s.replace('"', '_')
-    s = s.replace("'", '_')
-    return s
+@instrumented
+def queue_provisioning(provisioner, wanted_extensions, cluster):
+    """Queue the DDL needed to provision a backend cluster.
+
+    Roles are provisioned by one job, and each database, with its
+    grants and extensions, by another that waits for the roles. Returns
+    the set of databases ready for their clients.
+    """
+    queue = jobqueue.Queue()
+    dsn = backend_dsn('postgres', cluster)
+    planned = provisioner.plan_roles()
+    batches = provisioner.batches(planned)
+    roles = jobqueue.make_job('roles on {}'.format(cluster), dsn, batches)
+    roles_state = queue.enqueue(roles)
+    after = [] if roles_state == jobqueue.DONE else [(roles['name'],
+                                                      roles['id'])]
+    states = {roles['name']: roles_state}
+    for dbname, statements in provisioner.plan_databases().items():
+        exts = sorted(wanted_extensions.get(dbname, ()))
+        database_batches = provisioner.batches(statements)
+        planned.extend(statements)
+        batches.extend(database_batches)
+        job = jobqueue.make_job(
+            'database {} on {}'.format(dbname, cluster), dsn,
+            database_batches,
+            key=dict(users=sorted(provisioner.grants[dbname]),
+                     extensions=exts),
+            database_dsn=backend_dsn(dbname, cluster),
+            extensions=dict((ext, 'CREATE EXTENSION IF NOT EXISTS {}'
+                             ''.format(quote_identifier(ext)))
+                            for ext in exts),
+            after=after)
+        states[job['name']] = queue.enqueue(job)
+
+    if planned:
+        report = provisioner.report(planned, batches)
+        log("Planned {} statements for {} in {} round trips ({} round "
+            "trips saved)".format(
+                report.statements, cluster, report.round_trips,
+                max(report.legacy_round_trips - report.round_trips, 0)),
+            INFO)
+    for name, state in sorted(states.items()):
+        if state == jobqueue.PENDING:
+            log("Queued provisioning of {}".format(name), INFO)
+        elif state == jobqueue.FAILED:
+            log("Provisioning of {} failed. Run the resync action to "
+                "retry".format(name), WARNING)
+    if jobqueue.PENDING in states.values():
+        reactive.remove_state('pgbouncer.provisioned')
+        reactive.set_state('pgbouncer.provisioning')
+    if roles_state != jobqueue.DONE:
+        return set()
+    return set(dbname for dbname in provisioner.grants
+               if states['database {} on {}'.format(dbname, cluster)] ==
+               jobqueue.DONE)
+
+
+@when('pgbouncer.provisioning')
+@instrumented
+def check_provisioning():
+    """Reconcile once the queued provisioning jobs have completed."""
+    queue = jobqueue.Queue()
+    if not hookenv.is_leader():
+        # The new leader queues its own jobs.
+        dropped = queue.discard_pending()
+        if dropped:
+            log("No longer the leader, dropped {} queued provisioning "
+                "jobs".format(dropped), INFO)
+        reactive.remove_state('pgbouncer.provisioning')
+        return
+    # Jobs waiting for a failed job will never run.
+    blocked = queue.blocked()
+    names = set(job['name'] for job in blocked)
+    pending = [job for job in queue.jobs(jobqueue.PENDING)
+               if job['name'] not in names]
+    if pending:
+        hookenv.status_set('maintenance', 'Provisioning backend ({} jobs '
+                           'queued)'.format(len(pending)))
+        return
+    reactive.remove_state('pgbouncer.provisioning')
+    reactive.set_state('pgbouncer.provisioned')
+    failed = queue.jobs(jobqueue.FAILED) + blocked
+    for job in failed:
+        if job['attempts']:
+            log("Provisioning of {} failed after {} attempts: {}".format(
+                job['name'], job['attempts'], job['error']), WARNING)
+        else:
+            log("Provisioning of {} not attempted: {}".format(
+                job['name'], job['error']), WARNING)
+    unitdata.kv().unset('pgbouncer.reconciled')
+    reconfigure()
+    if failed:
+        hookenv.status_set('blocked', 'Backend provisioning failed, see '
+                           'the unit log')
+    elif reactive.is_state('pgbouncer.service_resumed'):
+        hookenv.status_set('active', 'Active')
 
 
-def pgidentifier(token):
-    '''Wrap a string for interpolation by psycopg2 as an SQL identifier'''
-    return AsIs(quote_identifier(token))
+PROVISIONER_SERVICE = 'pgbouncer-provisioner'
 
 
-def quote_identifier(identifier):
-    r'''Quote an identifier, such as a table or role name.
+@when('pgbouncer.enabled')
+@instrumented
+def configure_provisioner():
+    """Install and run the worker running queued provisioning jobs."""
+    source = os.path.join(hookenv.charm_dir(), 'lib', 'charms', 'pgbouncer',
+                          'jobqueue.py')
+    with open(source, 'rb') as f:
+        script = f.read()
+    if not reactive.helpers.data_changed('pgbouncer.provisioner',
+                                         [fingerprint(script.decode()),
+                                          hookenv.local_unit()]):
+        return
+    hookenv.log('Configuring provisioning worker')
+    path = '/usr/local/bin/pgbouncer-provisioner'
+    host.write_file(path, script, perms=0o755)
+    service.install_unit(
+        '/etc/systemd/system/{}.service'.format(PROVISIONER_SERVICE),
+        dedent("""\
+               # This file is maintained by the pgbouncer juju charm.
+               [Unit]
+               Description=Backend provisioning worker for PgBouncer
+               After=network.target
+
+               [Service]
+               ExecStart=/usr/bin/python3 {} --notify-unit {}
+               Restart=always
+               RestartSec=10
+
+               [Install]
+               WantedBy=multi-user.target
+               """).format(path, hookenv.local_unit()))
+    host.service_resume(PROVISIONER_SERVICE)
+    host.service_restart(PROVISIONER_SERVICE)
+
+
+HISTORY_SERVICE = 'pgbouncer-history'
+
+
+@when('pgbouncer.enabled')
+@when('pgbouncer.service_resumed')
+@instrumented
+def configure_history():
+    """Install and run the pool statistics history collector."""
+    config = hookenv.config()
+    password = get_password('nagios')
+    source = os.path.join(hookenv.charm_dir(), 'lib', 'charms', 'pgbouncer',
+                          'history.py')
+    with open(source, 'rb') as f:
+        script = f.read()
+    if not config['history_interval'] or password is None:
+        settings = None
+    else:
+        settings = dict(interval=config['history_interval'],
+                        retention=config['history_retention'] * 3600,
+                        listen_port=config['listen_port'],
+                        password=password,
+                        socket_dirs=[instance.unix_socket_dir
+                                     for instance in get_instances()],
+                        script=fingerprint(script.decode()))
+    if not reactive.helpers.data_changed('pgbouncer.history', settings):
+        return
 
-    In SQL, identifiers are quoted using " rather than ' (which is reserved
-    for strings).
+    unit_path = '/etc/systemd/system/{}.service'.format(HISTORY_SERVICE)
+    if settings is None:
+        if os.path.exists(unit_path):
+            hookenv.log('Disabling pool statistics history')
+            host.service_pause(HISTORY_SERVICE)
+        return
 
-    >>> print(quote_identifier('hello'))
-    "hello"
+    hookenv.log('Configuring pool statistics history')
+    path = '/usr/local/bin/pgbouncer-history'
+    host.write_file(path, script, perms=0o755)
+    host.mkdir(history.HISTORY_DIR, owner='postgres', group='postgres',
+               perms=0o750)
+    host.write_file('/etc/pgbouncer/history.env',
+                    'PGPASSWORD={}\n'.format(password).encode(),
+                    perms=0o600)
+    args = ['--interval', str(settings['interval']),
+            '--retention', str(settings['retention']),
+            '--port', str(settings['listen_port'])]
+    for socket_dir in settings['socket_dirs']:
+        args.extend(['--socket-dir', socket_dir])
+    service.install_unit(
+        unit_path,
+        dedent("""\
+               # This file is maintained by the pgbouncer juju charm.
+               [Unit]
+               Description=Pool statistics history for PgBouncer
+               After=network.target
+
+               [Service]
+               User=postgres
+               EnvironmentFile=/etc/pgbouncer/history.env
+               ExecStart=/usr/bin/python3 {} {}
+               Restart=always
+               RestartSec=10
+
+               [Install]
+               WantedBy=multi-user.target
+               """).format(path, ' '.join(args)))
+    host.service_resume(HISTORY_SERVICE)
+    host.service_restart(HISTORY_SERVICE)
+
+
+@when('actions.tune-pools')
+@instrumented
+def tune_pools():
+    """Recommend, and optionally apply, per-database pool sizes."""
+    reactive.remove_state('actions.tune-pools')
+    params = hookenv.action_get()
+    kv = unitdata.kv()
+
+    if params['reset']:
+        kv.unset('pgbouncer.pool_sizes')
+        hookenv.action_set({'applied': 'reset'})
+        reconfigure()
+        return
 
-    Quotes and Unicode are handled if you make use of them in your
-    identifiers.
+    if not reactive.is_state('pgbouncer.service_resumed'):
+        hookenv.action_fail('pgbouncer is not running')
+        return
+    con = connect()
+    if con is None:
+        hookenv.action_fail('Backend database unavailable')
+        return
 
-    >>> print(quote_identifier("'"))
-    "'"
-    >>> print(quote_identifier('"'))
-    """"
-    >>> print(quote_identifier("\\"))
-    "\"
-    >>> print(quote_identifier('\\"'))
-    "\"""
-    >>> print(quote_identifier('\\ aargh \u0441\u043b\u043e\u043d'))
-    U&"\\ aargh \0441\043b\043e\043d"
-    '''
+    cache = connections.get_cache()
     try:
-        identifier.encode('ascii')
-        return '"{}"'.format(identifier.replace('"', '""'))
-    except UnicodeEncodeError:
-        escaped = []
-        for c in identifier:
-            if c == '\\':
-                escaped.append(b'\\\\')
-            elif c == '"':
-                escaped.append(b'""')
-            else:
-                c = c.encode('ascii', 'backslashreplace')
-                # Note Python only supports 32 bit unicode, so we use
-                # the 4 hexdigit PostgreSQL syntax (\1234) rather than
-                # the 6 hexdigit format (\+123456).
-                if c.startswith(b'\\u'):
-                    c = b'\\' + c[2:]
-                escaped.append(c)
-        return 'U&"{}"'.format(''.join(s.decode('ascii') for s in escaped))
+        cons = [cache.get(admin_dsn(instance)) for instance in get_instances()]
+        demand = tuning.sample(cons, params['window'], params['interval'])
+    except psycopg2.Error as x:
+        hookenv.action_fail('Unable to sample pgbouncer: {}'.format(x))
+        return
+
+    # Hot standbys must allow at least as many connections as their
+    # master, so each cluster's master budget is used for all of its
+    # backends.
+    groups = pool_backends(demand)
+    cluster_budgets = {}
+    for cluster in set(cluster for cluster, _ in groups.values()):
+        cluster_con = connect(cluster=cluster)
+        if cluster_con is not None:
+            cluster_budgets[cluster] = tuning.connection_budget(
+                cluster_con, hookenv.unit_private_ip())
+    budgets = dict((group, cluster_budgets[group[0]])
+                   for group in groups.values()
+                   if group[0] in cluster_budgets)
+    sizes = tuning.recommend(demand, budgets, groups, params['headroom'])
+
+    lines = ['{:<40} {:>7} {:>11} {:>6} {:>7} {:>7} {:>11}'.format(
+        'database', 'current', 'recommended', 'peak', 'waiting', 'maxwait',
+        'concurrency')]
+    for database, d in sorted(demand.items()):
+        lines.append('{:<40} {:>7} {:>11} {:>6} {:>7} {:>7} {:>11.2f}'.format(
+            database, d.pool_size or '', sizes[database], d.peak, d.waiting,
+            d.maxwait, d.concurrency))
+    if len(cluster_budgets) == 1:
+        budget = next(iter(cluster_budgets.values()))
+    else:
+        budget = ', '.join('{}={}'.format(cluster, budget) for cluster, budget
+                           in sorted(cluster_budgets.items()))
+    hookenv.action_set({'recommendations': '\n'.join(lines),
+                        'budget': budget})
+
+    if params['dry-run']:
+        hookenv.action_set({'applied': 'false'})
+        return
+    kv.set('pgbouncer.pool_sizes', sizes)
+    hookenv.action_set({'applied': 'true'})
+    reconfigure()
+
+
+@when('actions.resync')
+@instrumented
+def resync():
+    """Reconcile everything, even if the inputs appear unchanged."""
+    reactive.remove_state('actions.resync')
+    unitdata.kv().unset('pgbouncer.reconciled')
+    # Provisioning is checked again, and failed jobs retried.
+    jobqueue.Queue().reset()
+    if not reactive.is_state('pgbouncer.enabled'):
+        hookenv.action_fail('pgbouncer is not enabled')
+    elif not reconfigure(force=True):
+        hookenv.action_fail('Backend database unavailable')
+    elif unitdata.kv().get('pgbouncer.reconciled') is None:
+        hookenv.action_fail('Reconcile failed, see the unit log')
+    elif reactive.is_state('pgbouncer.provisioning'):
+        hookenv.action_set({'result': 'Reconciled, backend provisioning '
+                                      'queued'})
+    else:
+        hookenv.action_set({'result': 'Reconciled'})
+
+
+@when('actions.slow-hooks')
+def slow_hooks():
+    """Report the slowest recent hooks."""
+    reactive.remove_state('actions.slow-hooks')
+    count = hookenv.action_get('count') or 10
+    records = list(instrumentation.read_records())
+    if not records:
+        hookenv.action_fail('No hook timings recorded')
+        return
+    hookenv.action_set({'hooks': len(records),
+                        'slowest': instrumentation.slowest(records, count)})
+
+
+@when('actions.pool-history')
+def pool_history():
+    """Report pool statistics over a window of the stored history."""
+    reactive.remove_state('actions.pool-history')
+    params = hookenv.action_get()
+    now = time.time()
+    samples = history.read(history.HISTORY_DIR, now - params['since'],
+                           now - params['until'])
+    if not samples:
+        hookenv.action_fail('No pool statistics recorded in that window')
+        return
+    hookenv.action_set({'databases': len(samples),
+                        'history': history.report(samples)})
+
+
+def reconfigure(force=False):
+    """Run configure() now, reloading pgbouncer if needed.
+
+    Returns False if the backend is unavailable.
+    """
+    if not reactive.is_state('backend-db-admin.master.available'):
+        return False
+    configure(get_backend(), force)
+    if (reactive.is_state('pgbouncer.needs_reload') and
+            reactive.is_state('pgbouncer.service_resumed')):
+        reload()
+    return True
+
+
+def admin_dsn(instance):
+    """The libpq connection string for an instance's admin console."""
+    return str(ConnectionString(host=instance.unix_socket_dir,
+                                port=str(hookenv.config()['listen_port']),
+                                dbname='pgbouncer', user='pgbouncer',
+                                password=get_password('pgbouncer')))
+
+
+def pool_backends(databases):
+    """Map pgbouncer database names to the backend pool they connect to.
+
+    Returns a (cluster, pool) tuple for each, where pool is 'master' or
+    the standby pool suffix.
+    """
+    backends = get_backends()
+    placements = placement.deserialize(
+        get_leader_settings().get('placements'))
+    # The longest matching name wins, as database names may share a
+    # prefix.
+    dbnames = sorted(placements, key=len, reverse=True)
+    cluster_standbys = {}
+    groups = {}
+    for database in databases:
+        cluster = next((placements[dbname] for dbname in dbnames
+                        if database == dbname or
+                        database.startswith(dbname + '_')), None)
+        if cluster not in backends:
+            cluster = next(iter(backends))
+        if cluster not in cluster_standbys:
+            cluster_standbys[cluster] = get_standbys(backends[cluster])
+        standbys = cluster_standbys[cluster]
+        default_standby = standby_pool_order(standbys, hookenv.local_unit())
+        groups[database] = (cluster, 'master')
+        for pool in standbys:
+            if database.endswith('_{}'.format(pool)):
+                groups[database] = (cluster, pool)
+        if database.endswith('_standby') and default_standby:
+            groups[database] = (cluster, default_standby[0])
+    return groups
+
+
+def sanitize(s):
+    s = s.replace(':', '_')
+    s = s.replace('-', '_')
+    s = s.replace('/', '_')
+    s = s.replace('"', '_')
+    s = s.replace("'", '_')
+    return s
 
 
 @when('ha.connected')
 @when_not("hacluster-configured")
+@instrumented
 def cluster_connected(hacluster):
     """Configure HA resources in corosync"""
     vip = hookenv.config('vip') or None
@@ -1,15 +1,40 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 # Copyright 2012 Canonical Ltd. All rights reserved.
 # Author: Liam Young <liam.young@canonical.com>
 
+"""Nagios checks for pgbouncer.
+
+All checks are evaluated from a snapshot of the pgbouncer admin console
+(SHOW CONFIG, LISTS, POOLS, STATS and DATABASES), collected over a
+single connection and cached on disk for --snapshot-ttl seconds.
+However many checks nrpe runs in a polling cycle, pgbouncer sees at
+most one connection per process.
+
+Each new snapshot keeps the SHOW STATS totals of the one it replaces,
+so the rate checks compute transactions per second and average times
+per database over the interval between the two.
+"""
 
 from collections import defaultdict
+from decimal import Decimal
+import errno
+import fcntl
+import glob
+import json
 from optparse import OptionParser
+import os
+import re
+import tempfile
+import time
+
 import psycopg2
 import psycopg2.extras
 
 
+SNAPSHOT_DIRS = ['/var/lib/nagios', tempfile.gettempdir()]
+
+
 def connect(database, user, password, host, port):
     """Connect to the database, returning the DB-API connection."""
     if not database:
@@ -21,98 +46,295 @@ def connect(database, user, password, host, port):
     if not port:
         port = "5434"
     if not password:
-        return psycopg2.connect("dbname=%s user=%s host=%s port=% \
-                                 sslmode=require"
+        return psycopg2.connect("dbname=%s user=%s host=%s port=%s "
+                                "sslmode=require"
                                 % (database, user, host, port))
     else:
-        return psycopg2.connect("dbname=%s user=%s password=%s host=%s \
-                                 port=% sslmode=require"
+        return psycopg2.connect("dbname=%s user=%s password=%s host=%s "
+                                "port=%s sslmode=require"
                                 % (database, user, password, host, port))
 
 
-def get_list_values(db_connection):
-    db_connection.set_isolation_level(0)
-    cur = db_connection.cursor()
-    cur.execute("""SHOW LISTS""")
-    rows = cur.fetchall()
-    cur.close()
-    return dict((str(key).rstrip("\x00"), value) for key, value in rows)
+def instance_socket_dirs(port):
+    """Return the unix socket directory of every local pgbouncer process.
 
+    When the charm runs several pgbouncer processes sharing a TCP port,
+    each has its own socket directory.
+    """
+    candidates = (['/var/run/postgresql'] +
+                  sorted(glob.glob('/var/run/postgresql/pgbouncer-*')))
+    return [d for d in candidates
+            if os.path.exists(os.path.join(d, '.s.PGSQL.%s' % port))]
+
+
+def _jsonable(value):
+    if isinstance(value, str):
+        return value.rstrip("\x00")
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
 
-def get_config_values(db_connection):
-    db_connection.set_isolation_level(0)
-    cur = db_connection.cursor()
-    cur.execute("""SHOW CONFIG""")
-    rows = cur.fetchall()
-    cur.close()
-    return dict((str(key).rstrip("\x00"), str(value).rstrip("\x00")) for key, value, changeable in rows)
 
+def _show(cur, command):
+    cur.execute("SHOW %s" % command)
+    return [dict((key, _jsonable(value)) for key, value in row.items())
+            for row in cur.fetchall()]
 
-def get_pool_stats(db_connection):
+
+def collect_snapshot(db_connection):
+    """Run every SHOW command needed by the checks over one connection."""
     db_connection.set_isolation_level(0)
     # need this special cursor to get columnname info
     cur = db_connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("""SHOW POOLS""")
-    rows = cur.fetchall()
+    snapshot = dict(taken=time.time())
+    snapshot['config'] = dict((row['key'], row['value'])
+                              for row in _show(cur, "CONFIG"))
+    snapshot['lists'] = dict((row['list'], row['items'])
+                             for row in _show(cur, "LISTS"))
+    snapshot['pools'] = _show(cur, "POOLS")
+    snapshot['stats'] = _show(cur, "STATS")
+    snapshot['databases'] = _show(cur, "DATABASES")
     cur.close()
+    return snapshot
+
+
+class SnapshotCache(object):
+    """A TTL-bounded, on-disk cache of admin console snapshots.
+
+    Concurrent checks serialize on a lock file, so when the cached
+    snapshot is stale only the first of them connects to pgbouncer.
+    """
+    def __init__(self, host, port, ttl, directory=None):
+        self.ttl = ttl
+        key = re.sub(r'[^A-Za-z0-9.]+', '_', '%s-%s' % (host, port))
+        self.directory = directory or self._writable_dir()
+        self.path = os.path.join(self.directory,
+                                 'pgbouncer-snapshot-%s.json' % key)
+
+    @staticmethod
+    def _writable_dir():
+        for directory in SNAPSHOT_DIRS:
+            if os.access(directory, os.W_OK):
+                return directory
+        return tempfile.gettempdir()
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _load(self):
+        snapshot = self._read()
+        if snapshot is None:
+            return None
+        if time.time() - snapshot.get('taken', 0) > self.ttl:
+            return None
+        return snapshot
+
+    def get(self, collect):
+        """Return a fresh snapshot, calling collect() if needed."""
+        snapshot = self._load()
+        if snapshot is not None:
+            return snapshot
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                snapshot = self._load()  # Another check may have won.
+                if snapshot is None:
+                    expired = self._read()
+                    snapshot = collect()
+                    if expired is not None and 'stats' in expired:
+                        snapshot['previous'] = dict(taken=expired['taken'],
+                                                    stats=expired['stats'])
+                    self._save(snapshot)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return snapshot
+
+    def _save(self, snapshot):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.snapshot')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.rename(tmp, self.path)
+        except Exception:
+            try:
+                os.unlink(tmp)
+            except OSError as x:
+                if x.errno != errno.ENOENT:
+                    raise
+            raise
+
+
+def get_pool_stats(snapshot):
     sum_keys = frozenset([
         'cl_active', 'cl_waiting', 'sv_active', 'sv_idle', 'sv_used',
         'sv_tested', 'sv_login'])
     summary = defaultdict(int)
-    for row in rows:
+    for row in snapshot['pools']:
         for key in sum_keys:
             summary[key] += int(row[key])
         summary['maxwait'] = max(summary['maxwait'], row['maxwait'])
     return summary
 
 
-def check_pool_wait(db_connection, warnlevel, critlevel):
-    stats_dict = get_pool_stats(db_connection)
-    cl_waiting = stats_dict['cl_waiting']
-    maxwait = stats_dict['maxwait']
-    status_message = ("Max seconds waiting for an available backend (maxwait): %d, "
-                      "FYI number of clients waiting for a backend (cl_waiting): %d"
-                      ) % (maxwait, cl_waiting)
-
-    # check if we have a client conns waiting for more than maxwait secs for backend:
-    if maxwait < warnlevel:
-        print "OK: " + status_message
+def nagios_status(value, warnlevel, critlevel, status_message):
+    if value < warnlevel:
+        print("OK: " + status_message)
         return 0
-    elif maxwait < critlevel:
-        print "WARNING: " + status_message
+    elif value < critlevel:
+        print("WARNING: " + status_message)
         return 1
     else:
-        print "CRITICAL: " + status_message
+        print("CRITICAL: " + status_message)
         return 2
 
 
-def check_max_conns(db_connection, warn_pct, critical_pct):
-    db_connection.set_isolation_level(0)
-    show_config = get_config_values(db_connection)
-    show_lists = get_list_values(db_connection)
-    max_connections = int(show_config["max_client_conn"])
-    current_count = int(show_lists["used_clients"])
+def check_pool_wait(snapshot, warnlevel, critlevel):
+    stats_dict = get_pool_stats(snapshot)
+    cl_waiting = stats_dict['cl_waiting']
+    maxwait = stats_dict['maxwait']
+    status_message = ("Max seconds waiting for an available backend "
+                      "(maxwait): %d, FYI number of clients waiting for a "
+                      "backend (cl_waiting): %d") % (maxwait, cl_waiting)
+
+    # check if we have a client conns waiting for more than maxwait secs
+    # for backend:
+    return nagios_status(maxwait, warnlevel, critlevel, status_message)
+
+
+def check_max_conns(snapshot, warn_pct, critical_pct):
+    max_connections = int(snapshot['config']["max_client_conn"])
+    current_count = int(snapshot['lists']["used_clients"])
     warn_limit = ((warn_pct * max_connections) / 100)
     critical_limit = ((critical_pct * max_connections) / 100)
-    status_message = "Current connections: %s Maximum connections: %s" % (current_count, max_connections)
+    status_message = "Current connections: %s Maximum connections: %s" % (
+        current_count, max_connections)
     if current_count < warn_limit:
-        print "OK: " + status_message
+        print("OK: " + status_message)
         return 0
     elif current_count < critical_limit:
-        print "WARNING: " + status_message
+        print("WARNING: " + status_message)
         return 1
     else:
-        print "CRITICAL: " + status_message
+        print("CRITICAL: " + status_message)
         return 2
 
 
+def database_rates(snapshot):
+    """Return the rates of each database since the previous snapshot.
+
+    Times are averages per transaction or query, in milliseconds.
+    Counters that went backwards, as after a restart, are ignored.
+    """
+    previous = snapshot.get('previous')
+    if not previous:
+        return {}
+    elapsed = snapshot['taken'] - previous['taken']
+    before = dict((row['database'], row) for row in previous['stats'])
+    rates = {}
+    for row in snapshot['stats']:
+        database = row['database']
+        if database == 'pgbouncer' or database not in before:
+            continue
+        try:
+            delta = dict((key, float(row['total_' + key]) -
+                          float(before[database]['total_' + key]))
+                         for key in ['xact_count', 'query_count',
+                                     'xact_time', 'query_time',
+                                     'wait_time'])
+        except KeyError:
+            continue  # pgbouncer older than 1.8
+        if elapsed <= 0 or min(delta.values()) < 0:
+            continue
+        xacts = delta['xact_count']
+        queries = delta['query_count']
+        rates[database] = dict(
+            tps=xacts / elapsed,
+            xact_ms=delta['xact_time'] / xacts / 1000 if xacts else 0,
+            query_ms=delta['query_time'] / queries / 1000 if queries else 0,
+            wait_ms=delta['wait_time'] / xacts / 1000 if xacts else 0)
+    return rates
+
+
+def _check_rate(snapshot, key, warnlevel, critlevel, label):
+    rates = database_rates(snapshot)
+    if not rates:
+        print("OK: No previous sample to compute rates from yet")
+        return 0
+    database, worst = max(sorted(rates.items()), key=lambda r: r[1][key])
+    status_message = ("%s %.1f ms on %s (%.1f transactions/s, average "
+                      "transaction %.1f ms, query %.1f ms, wait %.1f ms)"
+                      % (label, worst[key], database, worst['tps'],
+                         worst['xact_ms'], worst['query_ms'],
+                         worst['wait_ms']))
+    return nagios_status(worst[key], warnlevel, critlevel, status_message)
+
+
+def check_query_time(snapshot, warnlevel, critlevel):
+    return _check_rate(snapshot, 'query_ms', warnlevel, critlevel,
+                       "Highest average query time")
+
+
+def check_wait_time(snapshot, warnlevel, critlevel):
+    return _check_rate(snapshot, 'wait_ms', warnlevel, critlevel,
+                       "Highest average wait for a server")
+
+
+def pool_saturation(snapshot):
+    """Return the demand on each pool as a percentage of its size.
+
+    Demand is the active server connections plus the clients waiting
+    for one, so a pool with clients queueing is over 100%.
+    """
+    sizes = dict((row['name'], int(row['pool_size'] or 0))
+                 for row in snapshot.get('databases', []))
+    saturation = {}
+    for row in snapshot['pools']:
+        size = sizes.get(row['database'])
+        if not size or row['database'] == 'pgbouncer':
+            continue
+        demand = int(row['sv_active']) + int(row['cl_waiting'])
+        saturation[(row['database'], row['user'])] = dict(
+            percent=100.0 * demand / size, sv_active=int(row['sv_active']),
+            cl_waiting=int(row['cl_waiting']), pool_size=size)
+    return saturation
+
+
+def check_pool_saturation(snapshot, warnlevel, critlevel):
+    saturation = pool_saturation(snapshot)
+    if not saturation:
+        print("OK: No pools in use")
+        return 0
+    (database, user), worst = max(sorted(saturation.items()),
+                                  key=lambda p: p[1]['percent'])
+    status_message = ("Most saturated pool %s/%s at %d%% (sv_active %d, "
+                      "cl_waiting %d, pool_size %d)"
+                      % (database, user, worst['percent'],
+                         worst['sv_active'], worst['cl_waiting'],
+                         worst['pool_size']))
+    return nagios_status(worst['percent'], warnlevel, critlevel,
+                         status_message)
+
+
+CHECKS = {
+    'check_max_conns': check_max_conns,
+    'check_pool_wait': check_pool_wait,
+    'check_query_time': check_query_time,
+    'check_wait_time': check_wait_time,
+    'check_pool_saturation': check_pool_saturation,
+}
+
+
 class NagiosOptionParser(OptionParser):
     def error(self, msg):
-        print 'ERROR: %s' % msg
+        print('ERROR: %s' % msg)
         raise SystemExit(3)  # Code for Unknown
 
 
-if __name__ == '__main__':
+def main():
     parser = NagiosOptionParser()
     parser.add_option("-d", "--database", dest="database")
     parser.add_option("-u", "--user", dest="user")
@@ -120,37 +342,70 @@ if __name__ == '__main__':
     parser.add_option("-H", "--host", dest="host")
     parser.add_option("-P", "--port", dest="port")
     parser.add_option("-C", "--checkname", dest="checkname",
-                      help=("'check_max_conns': current and max client connections; "
-                            "'check_pool_wait': max time in secs waited for clients until pgbouncer "
-                            "finds an available backend, also instant number of clients waiting is shown "
-                            "in the status message"))
+                      help=("'check_max_conns': current and max client "
+                            "connections; 'check_pool_wait': max time in "
+                            "secs waited for clients until pgbouncer finds "
+                            "an available backend, also instant number of "
+                            "clients waiting is shown in the status "
+                            "message; 'check_query_time' and "
+                            "'check_wait_time': highest average query "
+                            "time and wait for a server of any database "
+                            "since the previous snapshot, in ms; "
+                            "'check_pool_saturation': highest active "
+                            "server connections plus waiting clients of "
+                            "any pool, as a percentage of its pool_size"))
+    parser.add_option("-a", "--all-instances", dest="all_instances",
+                      action="store_true", default=False,
+                      help=("check every local pgbouncer process through "
+                            "its unix socket, reporting the worst result"))
     parser.add_option("-w", "--warnlevel", dest="warnlevel", type=int)
     parser.add_option("-c", "--critlevel", dest="critlevel", type=int)
+    parser.add_option("-t", "--snapshot-ttl", dest="snapshot_ttl",
+                      type=float, default=60,
+                      help=("seconds a cached admin console snapshot is "
+                            "reused by later checks; 0 disables caching"))
+    parser.add_option("--snapshot-dir", dest="snapshot_dir",
+                      help="directory to store cached snapshots in")
 
     (options, args) = parser.parse_args()
 
-    if (options.warnlevel is None or options.critlevel is None
-            or options.checkname is None):
+    if (options.warnlevel is None or options.critlevel is None or
+            options.checkname is None):
         parser.error("--warnlevel, --critlevel and --checkname are required")
+    if options.checkname not in CHECKS:
+        parser.error("Invalid --checkname %s" % repr(options.checkname))
+    check = CHECKS[options.checkname]
+
+    hosts = [options.host]
+    if options.all_instances:
+        socket_dirs = instance_socket_dirs(options.port or "5434")
+        if len(socket_dirs) > 1:
+            hosts = socket_dirs
+
+    worst_code = 0
+    for host in hosts:
+        def collect():
+            conn = connect(options.database, options.user, options.password,
+                           host, options.port)
+            try:
+                return collect_snapshot(conn)
+            finally:
+                conn.close()
 
-    conn = None
-    exit_code = 3
-    try:
-        conn = connect(options.database, options.user, options.password,
-                       options.host, options.port)
-        if options.checkname == "check_max_conns":
-            exit_code = check_max_conns(
-                conn, int(options.warnlevel), int(options.critlevel))
-        elif options.checkname == "check_pool_wait":
-            exit_code = check_pool_wait(
-                conn, int(options.warnlevel), int(options.critlevel))
-        else:
-            parser.error("Invalid --checkname %s" % repr(options.checkname))
-    except psycopg2.Error, exception:
-        error_msg = str(exception)
-        print "ERROR: %s" % error_msg
-        exit_code = 2
-
-    if conn is not None:
-        conn.close()
-    raise SystemExit(exit_code)
+        exit_code = 3
+        try:
+            cache = SnapshotCache(host or "127.0.0.1", options.port or "5434",
+                                  options.snapshot_ttl, options.snapshot_dir)
+            snapshot = cache.get(collect)
+            exit_code = check(snapshot, int(options.warnlevel),
+                              int(options.critlevel))
+        except psycopg2.Error as exception:
+            error_msg = str(exception)
+            print("ERROR: %s" % error_msg)
+            exit_code = 2
+        worst_code = max(worst_code, exit_code)
+    raise SystemExit(worst_code)
+
+
+if __name__ == '__main__':
+    main()
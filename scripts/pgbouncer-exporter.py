@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Prometheus exporter for the pgbouncer admin console.
+
+A single poller thread keeps one admin connection open to each local
+pgbouncer process and collects SHOW POOLS, STATS, LISTS, SERVERS and
+CLIENTS every --interval seconds. HTTP scrapes of /metrics are answered
+from the most recent snapshot, so scraping never touches pgbouncer.
+
+The password is read from the PGPASSWORD environment variable.
+"""
+
+from argparse import ArgumentParser
+from collections import Counter, OrderedDict
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+import psycopg2
+
+
+# Counters in SHOW STATS. Everything else is exported as a gauge.
+COUNTER_PREFIX = 'total_'
+
+
+class Instance(object):
+    '''A local pgbouncer process, reached through its unix socket.'''
+    def __init__(self, index, socket_dir, port, user):
+        self.index = str(index)
+        self.dsn = 'dbname=pgbouncer host={} port={} user={}'.format(
+            socket_dir, port, user)
+        self.con = None
+
+    def query(self, sql):
+        if self.con is None or self.con.closed:
+            self.con = psycopg2.connect(self.dsn)
+            self.con.autocommit = True
+        cur = self.con.cursor()
+        cur.execute(sql)
+        columns = [d[0] for d in cur.description]
+        rows = [OrderedDict(zip(columns, row)) for row in cur.fetchall()]
+        cur.close()
+        return rows
+
+    def close(self):
+        if self.con is not None and not self.con.closed:
+            self.con.close()
+        self.con = None
+
+
+def is_number(value):
+    return (isinstance(value, (int, float, Decimal)) and
+            not isinstance(value, bool))
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+class Metrics(object):
+    '''Accumulate samples and render the Prometheus text format.'''
+    def __init__(self):
+        self.samples = OrderedDict()  # name -> (type, [(labels, value)])
+
+    def add(self, name, labels, value, kind='gauge'):
+        self.samples.setdefault(name, (kind, []))[1].append((labels, value))
+
+    def render(self):
+        lines = []
+        for name, (kind, samples) in self.samples.items():
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                if labels:
+                    lines.append('{}{{{}}} {}'.format(name, ','.join(
+                        '{}="{}"'.format(k, escape(v))
+                        for k, v in sorted(labels.items())), value))
+                else:
+                    lines.append('{} {}'.format(name, value))
+        lines.append('')
+        return '\n'.join(lines).encode('UTF-8')
+
+
+def collect(instance, metrics):
+    '''Add the admin console data of one pgbouncer to metrics.'''
+    labels = dict(instance=instance.index)
+
+    for row in instance.query('SHOW POOLS'):
+        pool = dict(labels, database=row['database'], user=row['user'])
+        for column, value in row.items():
+            if is_number(value):
+                metrics.add('pgbouncer_pools_{}'.format(column), pool, value)
+
+    for row in instance.query('SHOW STATS'):
+        database = dict(labels, database=row['database'])
+        for column, value in row.items():
+            if is_number(value):
+                kind = ('counter' if column.startswith(COUNTER_PREFIX)
+                        else 'gauge')
+                metrics.add('pgbouncer_stats_{}'.format(column),
+                            database, value, kind)
+
+    for row in instance.query('SHOW LISTS'):
+        item, value = list(row.values())[:2]
+        if is_number(value):
+            metrics.add('pgbouncer_lists_{}'.format(item), labels, value)
+
+    for kind in ('servers', 'clients'):
+        rows = instance.query('SHOW {}'.format(kind.upper()))
+        counts = Counter((row['database'], row['user'], row['state'])
+                         for row in rows)
+        for (database, user, state), count in sorted(counts.items()):
+            metrics.add('pgbouncer_{}'.format(kind),
+                        dict(labels, database=database, user=user,
+                             state=state), count)
+
+
+class Poller(threading.Thread):
+    '''Periodically rebuild the metrics snapshot.'''
+    daemon = True
+
+    def __init__(self, instances, interval):
+        super(Poller, self).__init__()
+        self.instances = instances
+        self.interval = interval
+        self.snapshot = b''
+
+    def poll(self):
+        start = time.time()
+        metrics = Metrics()
+        for instance in self.instances:
+            try:
+                collect(instance, metrics)
+                up = 1
+            except psycopg2.Error as x:
+                sys.stderr.write('pgbouncer {}: {}\n'.format(instance.index,
+                                                             x))
+                instance.close()
+                up = 0
+            except Exception:
+                # Such as a SHOW column missing from this pgbouncer
+                # version. Reported as down rather than left stale.
+                sys.stderr.write('pgbouncer {}: unable to collect:\n{}'
+                                 ''.format(instance.index,
+                                           traceback.format_exc()))
+                instance.close()
+                up = 0
+            metrics.add('pgbouncer_up', dict(instance=instance.index), up)
+        finish = time.time()
+        metrics.add('pgbouncer_exporter_last_poll_timestamp_seconds', {},
+                    round(finish, 3))
+        metrics.add('pgbouncer_exporter_poll_duration_seconds', {},
+                    round(finish - start, 6))
+        # Swapping the reference is atomic, so scrapes need no lock.
+        self.snapshot = metrics.render()
+
+    def run(self):
+        try:
+            while True:
+                started = time.time()
+                self.poll()
+                time.sleep(max(self.interval - (time.time() - started), 0))
+        except Exception:
+            # Exit rather than serve a stale snapshot, so systemd
+            # restarts the exporter.
+            sys.stderr.write(traceback.format_exc())
+            sys.stderr.flush()
+            os._exit(1)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(poller):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = poller.snapshot
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are too frequent to log.
+
+    return MetricsHandler
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--listen-address', default='')
+    parser.add_argument('--listen-port', type=int, default=9127)
+    parser.add_argument('--interval', type=float, default=15,
+                        help='seconds between polls of pgbouncer')
+    parser.add_argument('--port', type=int, default=6432,
+                        help='pgbouncer listen port')
+    parser.add_argument('--user', default='nagios')
+    parser.add_argument('--socket-dir', action='append', dest='socket_dirs',
+                        help='unix socket directory of a pgbouncer process. '
+                        'May be repeated.')
+    options = parser.parse_args()
+
+    socket_dirs = options.socket_dirs or ['/var/run/postgresql']
+    instances = [Instance(i, d, options.port, options.user)
+                 for i, d in enumerate(socket_dirs)]
+
+    poller = Poller(instances, options.interval)
+    poller.poll()
+    poller.start()
+
+    server = ThreadingHTTPServer((options.listen_address,
+                                  options.listen_port),
+                                 make_handler(poller))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
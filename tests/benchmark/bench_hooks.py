@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the reactive handlers against synthetic models.
+
+Each scenario runs one hook's worth of handlers on a model with the
+given number of client units, using the stand-ins in fakes.py, and
+reports the wall time along with the hook tool calls and backend round
+trips made.
+
+With --check, the counts are compared with baseline.json, and the run
+fails if any has grown, or if the time per client unit grows more than
+--max-scaling times between the smallest and largest models. Counts are
+deterministic, so any increase is a real change in the charm's
+behaviour. Use --update-baseline to accept new counts.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import importlib.util
+import json
+import os.path
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import fakes  # noqa: E402
+
+sys.path.insert(0, os.path.join(fakes.CHARM_DIR, 'lib'))
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+SIZES = [10, 100, 1000, 5000]
+
+# Client applications are related with this many units each, split
+# between the db and db-admin relations.
+UNITS_PER_APP = 2
+
+METRICS = ['round-trips', 'connections', 'relation-get', 'relation-set',
+           'leader-get', 'leader-set', 'write-file']
+
+
+def load_charm():
+    '''Import the reactive handlers using the fake modules.'''
+    fakes.install()
+    from charms.pgbouncer import connections, instrumentation, jobqueue
+    fakes.patch_connections(connections)
+    jobqueue.connect = fakes.RecordingConnection
+    jobqueue.log = lambda message: None
+    instrumentation.HOOK_LOG = os.path.join(
+        tempfile.mkdtemp(prefix='pgbouncer-bench-'), 'hooks.log')
+    spec = importlib.util.spec_from_file_location(
+        'pgbouncer_handlers',
+        os.path.join(fakes.CHARM_DIR, 'reactive', 'pgbouncer.py'))
+    handlers = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(handlers)
+    return handlers
+
+
+def build_model(units, leader=True):
+    '''A model with units client units related to the pgbouncer unit.'''
+    model = fakes.Model(leader=leader)
+    model.flags.update(['apt.installed.pgbouncer', 'pgbouncer.enabled',
+                        'pgbouncer.service_resumed',
+                        'backend-db-admin.connected',
+                        'backend-db-admin.master.available'])
+    model.relations['backend-db-admin'] = OrderedDict(
+        [('backend-db-admin:0', OrderedDict([('postgresql/0', {})]))])
+    for i in range(max(units // UNITS_PER_APP, 1)):
+        relname = 'db-admin' if i % 10 == 0 else 'db'
+        data = dict(database='app{}'.format(i), roles='reader,writer')
+        if i % 20 == 0:
+            data['extensions'] = 'pg_trgm,citext'
+        model.add_relation(relname, 'client{}'.format(i), UNITS_PER_APP, data)
+    return model
+
+
+def run_hook(handlers, model, force=False, handler=None):
+    '''Run configure(), or handler, as one hook, returning its wall time.
+    '''
+    fakes.use(model)
+    model.reset_counters()
+    start = time.perf_counter()
+    if handler is None:
+        handlers.configure(None, force)
+    else:
+        handler()
+    model.run_atexit()
+    return time.perf_counter() - start
+
+
+def run_worker(model):
+    '''Run the queued provisioning jobs, as the worker would.'''
+    from charms.pgbouncer import jobqueue
+    fakes.use(model)
+    queue = jobqueue.Queue()
+    while jobqueue.run_ready(queue):
+        pass
+
+
+def scenarios(handlers, units):
+    '''Yield (name, seconds, counters) for each scenario.'''
+    from charms.pgbouncer import jobqueue
+    jobqueue.QUEUE_DIR = tempfile.mkdtemp(prefix='pgbouncer-bench-')
+
+    leader = build_model(units)
+    # A new deployment. Every user, database and grant is queued.
+    yield 'leader-initial', run_hook(handlers, leader), leader.counters
+    run_worker(leader)
+    # The worker has provisioned everything. Clients are sent their
+    # connection details.
+    yield 'leader-provisioned', run_hook(
+        handlers, leader, handler=handlers.check_provisioning), \
+        leader.counters
+    # update-status and other hooks where nothing changed.
+    yield 'leader-steady', run_hook(handlers, leader), leader.counters
+    # The resync action. Everything is checked, nothing changes.
+    yield 'leader-resync', run_hook(handlers, leader, True), leader.counters
+
+    follower = build_model(units, leader=False)
+    follower.leader_settings = dict(leader.leader_settings)
+    follower.catalog = leader.catalog
+    yield 'follower-initial', run_hook(handlers, follower), follower.counters
+    yield 'follower-steady', run_hook(handlers, follower), follower.counters
+
+
+def benchmark(handlers, sizes):
+    results = OrderedDict()
+    for units in sizes:
+        for name, seconds, counters in scenarios(handlers, units):
+            result = OrderedDict((metric, counters[metric])
+                                 for metric in METRICS)
+            result['seconds'] = round(seconds, 4)
+            results['{}/{}'.format(name, units)] = result
+    return results
+
+
+def report(results):
+    columns = ['seconds'] + METRICS
+    print('{:<24}'.format('scenario/units') +
+          ''.join('{:>13}'.format(c) for c in columns))
+    for key, result in results.items():
+        print('{:<24}'.format(key) +
+              ''.join('{:>13}'.format(result[c]) for c in columns))
+
+
+def check(results, baseline, max_scaling):
+    '''Return a list of regressions against the baseline.'''
+    failures = []
+    for key, result in results.items():
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+        for metric in METRICS:
+            if result[metric] > expected.get(metric, 0):
+                failures.append('{} {}: {} > {}'.format(
+                    key, metric, result[metric], expected[metric]))
+
+    sizes = sorted(set(int(key.split('/')[1]) for key in results))
+    if len(sizes) > 1:
+        small, large = sizes[0], sizes[-1]
+        for name in sorted(set(key.split('/')[0] for key in results)):
+            per_unit_small = results['{}/{}'.format(name, small)]['seconds']
+            per_unit_small /= small
+            per_unit_large = results['{}/{}'.format(name, large)]['seconds']
+            per_unit_large /= large
+            if per_unit_large > max_scaling * max(per_unit_small, 1e-6):
+                failures.append(
+                    '{}: {:.1f}us per unit at {} units, {:.1f}us at {}'
+                    ''.format(name, per_unit_large * 1e6, large,
+                              per_unit_small * 1e6, small))
+    return failures
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='numbers of client units to model')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--check', action='store_true',
+                        help='fail on regressions against the baseline')
+    parser.add_argument('--max-scaling', type=float, default=4.0,
+                        help='tolerated growth in time per unit')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='record these counts as the new baseline')
+    options = parser.parse_args()
+
+    handlers = load_charm()
+    results = benchmark(handlers, options.sizes)
+    report(results)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if options.update_baseline:
+        baseline = OrderedDict(
+            (key, OrderedDict((m, result[m]) for m in METRICS))
+            for key, result in results.items())
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=2)
+            f.write('\n')
+
+    if options.check:
+        with open(BASELINE, 'r') as f:
+            baseline = json.load(f)
+        failures = check(results, baseline, options.max_scaling)
+        for failure in failures:
+            print('REGRESSION: {}'.format(failure))
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure pgbouncer throughput and latency under pgbench.
+
+A throwaway PostgreSQL cluster is created with initdb. For each
+configuration in the matrix, pgbouncer.ini is rendered by the charm's
+own rendering code, a local pgbouncer started in front of the cluster,
+and each pgbench workload run against it. TPS and p50/p95/p99
+transaction latency are written to a CSV and a JSON report.
+
+The matrix is the cross product of the charm configuration values
+given with --set, for example:
+
+    bench_pgbench.py --set pool_mode=transaction,session \\
+        --set default_pool_size=10,20,50 --set tls=off,on
+
+tls is not a charm option. When on, clients connect to pgbouncer with
+TLS, using a self-signed certificate.
+
+PostgreSQL server binaries, pgbench, pgbouncer and openssl must be
+installed. The PostgreSQL binaries are looked for in PATH and in
+/usr/lib/postgresql/*/bin.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import csv
+import glob
+import itertools
+import json
+import os.path
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import fakes  # noqa: E402
+
+sys.path.insert(0, os.path.join(fakes.CHARM_DIR, 'lib'))
+
+from charms.pgbouncer import rendering  # noqa: E402
+
+
+DATABASE = 'bench'
+USER = 'bench'
+PASSWORD = 'bench'
+
+# name -> pgbench arguments. Clients and threads are scaled by
+# --clients, except for the fan-in workload.
+WORKLOADS = OrderedDict([
+    ('read-only', ['--select-only']),
+    ('tpc-b', []),
+    ('connect', ['--connect']),
+    ('fan-in', ['--select-only', '--client=200', '--jobs=8']),
+])
+
+
+def find_binary(name):
+    path = shutil.which(name)
+    if path is None:
+        candidates = sorted(glob.glob('/usr/lib/postgresql/*/bin/' + name))
+        if candidates:
+            path = candidates[-1]
+    if path is None:
+        raise SystemExit('{} not found'.format(name))
+    return path
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit('Nothing listening on port {}'.format(port))
+
+
+class Cluster(object):
+    '''A throwaway PostgreSQL cluster listening on a unix socket.'''
+    def __init__(self, workdir, scale):
+        self.datadir = os.path.join(workdir, 'pgdata')
+        self.socket_dir = workdir
+        self.port = free_port()
+        self.pg_ctl = find_binary('pg_ctl')
+        subprocess.check_call([find_binary('initdb'), '--auth=trust',
+                               '--username=postgres', '--no-sync',
+                               '-D', self.datadir],
+                              stdout=subprocess.DEVNULL)
+        subprocess.check_call(
+            [self.pg_ctl, 'start', '-w', '-D', self.datadir,
+             '-l', os.path.join(workdir, 'postgresql.log'),
+             '-o', "-p {} -k {} -c listen_addresses='' "
+                   "-c max_connections=400 -c fsync=off".format(
+                       self.port, self.socket_dir)],
+            stdout=subprocess.DEVNULL)
+        self.psql('CREATE ROLE {} LOGIN SUPERUSER'.format(USER))
+        self.psql('CREATE DATABASE {} OWNER {}'.format(DATABASE, USER))
+        subprocess.check_call(
+            [find_binary('pgbench'), '--initialize', '--quiet',
+             '--scale={}'.format(scale), '-h', self.socket_dir,
+             '-p', str(self.port), '-U', USER, DATABASE],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def psql(self, sql):
+        subprocess.check_call([find_binary('psql'), '-q', '-h',
+                               self.socket_dir, '-p', str(self.port), '-U',
+                               'postgres', '-c', sql, 'postgres'])
+
+    def stop(self):
+        subprocess.call([self.pg_ctl, 'stop', '-m', 'fast', '-D',
+                         self.datadir], stdout=subprocess.DEVNULL)
+
+
+class Bouncer(object):
+    '''A local pgbouncer, configured through the charm's template.'''
+    def __init__(self, workdir, cluster, settings):
+        self.workdir = workdir
+        self.port = free_port()
+        self.tls = settings.pop('tls', 'off') == 'on'
+        config = fakes.default_config()
+        config.update(settings)
+        config.update(listen_port=self.port, auth_user='',
+                      admin_users=USER)
+        if self.tls:
+            self.make_certificate()
+            # The template only checks these are set. The files are
+            # written by make_certificate().
+            config.update(client_crt='-', client_key='-')
+        instance = SimpleNamespace(
+            pidfile=os.path.join(workdir, 'pgbouncer.pid'),
+            logfile=os.path.join(workdir, 'pgbouncer.log'),
+            unix_socket_dir=workdir)
+        stanza = '{} = host={} port={} dbname={}'.format(
+            DATABASE, cluster.socket_dir, cluster.port, DATABASE)
+        paths = dict(auth_file=os.path.join(workdir, 'userlist.txt'),
+                     tls_dir=workdir, user=None)
+        with open(paths['auth_file'], 'w') as f:
+            f.write('"{}" "{}"\n'.format(USER, PASSWORD))
+        self.ini = os.path.join(workdir, 'pgbouncer.ini')
+        with open(self.ini, 'w') as f:
+            f.write(rendering.render_config(
+                os.path.join(fakes.CHARM_DIR, 'templates'), config,
+                instance, [stanza], listen_addr='127.0.0.1', paths=paths))
+        self.process = subprocess.Popen([find_binary('pgbouncer'), self.ini])
+        wait_for_port(self.port)
+
+    def make_certificate(self):
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-days', '1', '-subj', '/CN=localhost',
+             '-keyout', os.path.join(self.workdir, 'key_client'),
+             '-out', os.path.join(self.workdir, 'cert_client')],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop(self):
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def parse_tps(output):
+    '''Extract TPS from pgbench output, excluding connection time.
+
+    >>> parse_tps('tps = 10.5 (including connections establishing)\\n'
+    ...           'tps = 11.25 (excluding connections establishing)\\n')
+    11.25
+    >>> parse_tps('tps = 99.000000 (without initial connection time)\\n')
+    99.0
+    '''
+    found = re.findall(r'^tps = ([\d.]+) \((.*)\)', output, re.M)
+    for tps, note in found:
+        if 'including' not in note:
+            return float(tps)
+    return float(found[0][0]) if found else None
+
+
+def latencies(log_prefix):
+    '''Transaction latencies in milliseconds, from pgbench -l logs.'''
+    values = []
+    for path in glob.glob(log_prefix + '*'):
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                # client_id transaction_no time script_no time_epoch
+                # time_us, with time in microseconds.
+                if len(fields) >= 3 and fields[2].isdigit():
+                    values.append(int(fields[2]) / 1000.0)
+        os.unlink(path)
+    return values
+
+
+def run_workload(workdir, bouncer, name, args, options):
+    log_prefix = os.path.join(workdir, 'pgbench_log_{}'.format(
+        re.sub(r'\W', '_', name)))
+    env = dict(os.environ, PGPASSWORD=PASSWORD,
+               PGSSLMODE='require' if bouncer.tls else 'disable')
+    command = [find_binary('pgbench'), '--no-vacuum',
+               '--client={}'.format(options.clients),
+               '--jobs={}'.format(options.jobs),
+               '--time={}'.format(options.duration),
+               '--log', '--log-prefix={}'.format(log_prefix),
+               '-h', '127.0.0.1', '-p', str(bouncer.port), '-U', USER]
+    # Later options override the defaults above.
+    out = subprocess.check_output(command + args + [DATABASE], env=env,
+                                  universal_newlines=True,
+                                  stderr=subprocess.STDOUT)
+    times = latencies(log_prefix)
+    return OrderedDict([
+        ('tps', parse_tps(out)),
+        ('transactions', len(times)),
+        ('p50_ms', percentile(times, 0.50)),
+        ('p95_ms', percentile(times, 0.95)),
+        ('p99_ms', percentile(times, 0.99)),
+    ])
+
+
+def parse_matrix(assignments):
+    '''Expand key=v1,v2 assignments into a list of settings.
+
+    >>> parse_matrix(['pool_mode=session,transaction', 'tls=on'])
+    [{'pool_mode': 'session', 'tls': 'on'}, \
+{'pool_mode': 'transaction', 'tls': 'on'}]
+    '''
+    axes = OrderedDict()
+    for assignment in assignments:
+        key, _, values = assignment.partition('=')
+        axes[key.strip()] = [coerce(v.strip()) for v in values.split(',')]
+    return [dict(zip(axes.keys(), combination))
+            for combination in itertools.product(*axes.values())]
+
+
+def coerce(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--set', action='append', dest='matrix',
+                        default=[], metavar='OPTION=VALUE[,VALUE...]',
+                        help='charm option values to benchmark. '
+                        'May be repeated.')
+    parser.add_argument('--workload', action='append', dest='workloads',
+                        choices=list(WORKLOADS),
+                        help='workloads to run (default: all)')
+    parser.add_argument('--duration', type=int, default=30,
+                        help='seconds to run each workload')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--scale', type=int, default=10,
+                        help='pgbench scale factor')
+    parser.add_argument('--output', default='pgbench-report',
+                        help='report filename, without extension')
+    options = parser.parse_args()
+
+    matrix = parse_matrix(options.matrix) or [{}]
+    workloads = options.workloads or list(WORKLOADS)
+
+    rows = []
+    workdir = tempfile.mkdtemp(prefix='pgbouncer-bench-')
+    cluster = Cluster(workdir, options.scale)
+    try:
+        for settings in matrix:
+            bouncer = Bouncer(workdir, cluster, dict(settings))
+            try:
+                for name in workloads:
+                    result = run_workload(workdir, bouncer, name,
+                                          WORKLOADS[name], options)
+                    row = OrderedDict(sorted(settings.items()))
+                    row['workload'] = name
+                    row.update(result)
+                    rows.append(row)
+                    print(json.dumps(row))
+            finally:
+                bouncer.stop()
+    finally:
+        cluster.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(options.output + '.json', 'w') as f:
+        json.dump(rows, f, indent=2)
+    columns = []
+    for row in rows:
+        columns.extend(k for k in row if k not in columns)
+    with open(options.output + '.csv', 'w') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,509 @@
+# Copyright 2012-2016 Canonical Ltd. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-process stand-ins for Juju, the charm layers and the backend.
+
+install() registers fake charmhelpers, charms.reactive,
+charms.leadership and relations.pgsql modules, so the reactive handlers
+can be imported and driven outside a Juju deployment. All state lives
+in a Model, which also counts the hook tool invocations and backend
+round trips made on its behalf.
+
+The backend is a recorded cursor stand-in. It keeps just enough of a
+catalog, built from the DDL it is sent, for the charm to see its own
+changes on the next hook.
+"""
+
+from collections import Counter, OrderedDict
+import json
+import os.path
+import random
+import re
+import sys
+import threading
+import types
+
+import psycopg2
+from psycopg2.extensions import adapt
+import yaml
+
+
+CHARM_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                         os.pardir, os.pardir))
+
+# The model hook tools and backend calls are sent to.
+MODEL = None
+
+
+class Config(dict):
+    '''The charm configuration, as returned by hookenv.config().'''
+    def __init__(self, *args, **kw):
+        super(Config, self).__init__(*args, **kw)
+        self._prev = dict(self)
+
+    def previous(self, key):
+        return self._prev.get(key)
+
+    def changed(self, key):
+        return self._prev.get(key) != self.get(key)
+
+
+def default_config():
+    with open(os.path.join(CHARM_DIR, 'config.yaml'), 'r') as f:
+        options = yaml.safe_load(f)['options']
+    return dict((key, option['default']) for key, option in options.items()
+                if 'default' in option)
+
+
+class Catalog(object):
+    '''The backend state visible to the charm.'''
+    def __init__(self):
+        self.roles = set(['postgres'])
+        self.members = set()        # (member, role)
+        self.databases = set(['postgres', 'template0', 'template1'])
+        self.connect = set()        # (database, grantee)
+        self.extensions = {}        # database -> set of extensions
+
+
+class Model(object):
+    '''A synthetic Juju model, seen from one pgbouncer unit.'''
+    def __init__(self, unit='pgbouncer/0', leader=True, config=None):
+        self.unit = unit
+        self.leader = leader
+        self.config = Config(default_config(), **(config or {}))
+        self.leader_settings = {}
+        self.flags = set()
+        self.kv = {}
+        self.files = {}
+        self.relations = OrderedDict()  # relname -> OrderedDict of relids
+        self.local = {}                 # relid -> local unit settings
+        self.backend = dict(master='host=10.0.0.10 port=5432 dbname=postgres'
+                                   ' user=juju_pgbouncer password=secret',
+                            standbys=['host=10.0.0.11 port=5432 '
+                                      'dbname=postgres user=juju_pgbouncer '
+                                      'password=secret'],
+                            version='12')
+        self.catalog = Catalog()
+        self.counters = Counter()
+        self.atexit = []
+        self.random = random.Random(0)
+        self._lock = threading.Lock()
+        self._relid = 0
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def add_relation(self, relname, app, units, data):
+        '''Relate a client application, returning the relation id.'''
+        self._relid += 1
+        relid = '{}:{}'.format(relname, self._relid)
+        self.relations.setdefault(relname, OrderedDict())[relid] = \
+            OrderedDict(('{}/{}'.format(app, i), dict(data))
+                        for i in range(units))
+        self.local[relid] = {}
+        return relid
+
+    def relation_units(self, relid):
+        relname = relid.split(':', 1)[0]
+        return self.relations.get(relname, {}).get(relid, {})
+
+    def reset_counters(self):
+        self.counters = Counter()
+
+    def run_atexit(self):
+        while self.atexit:
+            callback, args, kwargs = self.atexit.pop()
+            callback(*args, **kwargs)
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+# charmhelpers.core.hookenv
+
+def config(scope=None):
+    if scope is None:
+        return MODEL.config
+    return MODEL.config.get(scope)
+
+
+def log(message, level=None):
+    pass
+
+
+def relation_ids(reltype=None):
+    MODEL.count('relation-ids')
+    return list(MODEL.relations.get(reltype, {}).keys())
+
+
+def related_units(relid=None):
+    MODEL.count('relation-list')
+    return list(MODEL.relation_units(relid).keys())
+
+
+def relation_get(attribute=None, unit=None, rid=None):
+    MODEL.count('relation-get')
+    if unit == MODEL.unit:
+        data = MODEL.local.get(rid, {})
+    else:
+        data = MODEL.relation_units(rid).get(unit, {})
+    if attribute is None:
+        return dict(data)
+    return data.get(attribute)
+
+
+def relation_set(relation_id=None, relation_settings=None, **kwargs):
+    MODEL.count('relation-set')
+    settings = dict(relation_settings or {}, **kwargs)
+    local = MODEL.local.setdefault(relation_id, {})
+    for key, value in settings.items():
+        if value is None:
+            local.pop(key, None)
+        else:
+            local[key] = str(value)
+
+
+def atexit(callback, *args, **kwargs):
+    MODEL.atexit.append((callback, args, kwargs))
+
+
+def _hookenv():
+    noop = lambda *args, **kw: None  # noqa: E731
+    return _module(
+        'charmhelpers.core.hookenv',
+        CRITICAL='CRITICAL', ERROR='ERROR', WARNING='WARNING', INFO='INFO',
+        DEBUG='DEBUG', TRACE='TRACE',
+        config=config, log=log, atexit=atexit, atstart=noop,
+        is_leader=lambda: MODEL.leader,
+        local_unit=lambda: MODEL.unit,
+        unit_private_ip=lambda: '10.0.0.1',
+        charm_dir=lambda: CHARM_DIR,
+        hook_name=lambda: 'benchmark',
+        status_set=noop, open_port=noop, close_port=noop,
+        action_get=lambda key=None: {}, action_set=noop, action_fail=noop,
+        relation_ids=relation_ids, related_units=related_units,
+        relation_get=relation_get, relation_set=relation_set)
+
+
+# charmhelpers.core.host
+
+def write_file(path, content, owner='root', group='root', perms=0o444):
+    MODEL.count('write-file')
+    MODEL.files[path] = content
+
+
+def pwgen(length=None):
+    return ''.join(MODEL.random.choice('abcdefghijklmnopqrstuvwxyz0123456789')
+                   for _ in range(length or 16))
+
+
+def _host():
+    ok = lambda *args, **kw: True  # noqa: E731
+    return _module(
+        'charmhelpers.core.host',
+        write_file=write_file, pwgen=pwgen,
+        service_resume=ok, service_pause=ok, service_restart=ok,
+        service_reload=ok, service_start=ok, service_stop=ok,
+        service_running=ok)
+
+
+# charmhelpers.core.unitdata
+
+class KV(object):
+    '''The unit's key/value store. Values are copied, as if serialized.'''
+    def get(self, key, default=None):
+        if key not in MODEL.kv:
+            return default
+        return json.loads(MODEL.kv[key])
+
+    def set(self, key, value):
+        MODEL.kv[key] = json.dumps(value)
+        return value
+
+    def unset(self, key):
+        MODEL.kv.pop(key, None)
+
+    def flush(self, save=True):
+        pass
+
+
+def _unitdata():
+    return _module('charmhelpers.core.unitdata', kv=KV)
+
+
+# charms.reactive
+
+def set_state(state):
+    MODEL.flags.add(state)
+
+
+def remove_state(state):
+    MODEL.flags.discard(state)
+
+
+def is_state(state):
+    return state in MODEL.flags
+
+
+def data_changed(data_id, data, hash_type='md5'):
+    key = 'reactive.data_changed.{}'.format(data_id)
+    serialized = json.dumps(data, sort_keys=True, default=str)
+    changed = MODEL.kv.get(key) != serialized
+    MODEL.kv[key] = serialized
+    return changed
+
+
+def _decorator(*args, **kwargs):
+    return lambda func: func
+
+
+class Endpoint(object):
+    def __init__(self, relname):
+        self.relations = list(MODEL.relations.get(relname, {}).keys())
+
+    @classmethod
+    def from_name(cls, relname):
+        return cls(relname)
+
+
+def _reactive():
+    helpers = _module('charms.reactive.helpers', data_changed=data_changed)
+    return _module(
+        'charms.reactive',
+        helpers=helpers, set_state=set_state, remove_state=remove_state,
+        is_state=is_state, set_flag=set_state, clear_flag=remove_state,
+        is_flag_set=is_state, hook=_decorator, when=_decorator,
+        when_all=_decorator, when_any=_decorator, when_not=_decorator,
+        when_none=_decorator, not_unless=_decorator, only_once=_decorator,
+        Endpoint=Endpoint, main=lambda: None)
+
+
+# charms.leadership
+
+def leader_get(attribute=None):
+    MODEL.count('leader-get')
+    if attribute is None:
+        return dict(MODEL.leader_settings)
+    return MODEL.leader_settings.get(attribute)
+
+
+def leader_set(settings=None, **kw):
+    MODEL.count('leader-set')
+    settings = dict(settings or {}, **kw)
+    for key, value in settings.items():
+        if MODEL.leader_settings.get(key) != value:
+            MODEL.flags.add('leadership.changed.{}'.format(key))
+        if value is None:
+            MODEL.leader_settings.pop(key, None)
+        else:
+            MODEL.leader_settings[key] = value
+            MODEL.flags.add('leadership.set.{}'.format(key))
+
+
+# relations.pgsql.requires
+
+class ConnectionString(str):
+    '''A libpq connection string, as in the pgsql interface.'''
+    def __new__(self, conn_str=None, **kw):
+        if conn_str is not None:
+            for key, v1, v2 in re.findall(
+                    r"(\w+)\s*=\s*(?:'((?:.|\.)*?)'|(\S*))(?=(?:\s|\Z))",
+                    conn_str):
+                if key not in kw:
+                    kw[key] = v1 or v2
+
+        def quote(x):
+            q = str(x).replace("\\", "\\\\").replace("'", "\\'")
+            q = q.replace('\n', ' ')
+            if ' ' in q:
+                q = "'" + q + "'"
+            return q
+
+        c = str.__new__(self, ' '.join('{}={}'.format(k, quote(v))
+                                       for k, v in sorted(kw.items()) if v))
+        c._kw = dict((k, v) for k, v in kw.items() if v)
+        return c
+
+    def keys(self):
+        return iter(self._kw.keys())
+
+    def __getitem__(self, key):
+        return self._kw[key]
+
+    def __getattr__(self, key):
+        try:
+            return self._kw[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class ConnectionStrings(OrderedDict):
+    def __init__(self, relid):
+        super(ConnectionStrings, self).__init__()
+        self.relid = relid
+        self.master = ConnectionString(MODEL.backend['master'])
+        self.standbys = set(ConnectionString(s)
+                            for s in MODEL.backend['standbys'])
+        self.version = MODEL.backend['version']
+
+
+# The backend
+
+IDENT = r'"((?:[^"]|"")*)"'
+
+
+def _ident(quoted):
+    return quoted.replace('""', '"')
+
+
+class RecordingCursor(object):
+    '''A cursor executing against the in-memory Catalog.'''
+    def __init__(self, con):
+        self.con = con
+        self.rows = []
+        self.description = None
+
+    def mogrify(self, sql, params=None):
+        if params:
+            sql = sql % tuple(adapt(p).getquoted().decode('UTF-8')
+                              for p in params)
+        return sql.encode('UTF-8')
+
+    def execute(self, sql, params=None):
+        MODEL.count('round-trips')
+        if params is not None:
+            sql = self.mogrify(sql, params)
+        if isinstance(sql, bytes):
+            sql = sql.decode('UTF-8')
+        self.rows = []
+        self.description = None
+        for statement in sql.split(';\n'):
+            self._statement(statement.strip())
+        if self.rows:
+            self.description = [('column{}'.format(i),)
+                                for i in range(len(self.rows[0]))]
+
+    def _statement(self, sql):
+        catalog = MODEL.catalog
+        m = re.match(r'CREATE ROLE {}'.format(IDENT), sql)
+        if m:
+            catalog.roles.add(_ident(m.group(1)))
+            return
+        m = re.match(r'(GRANT|REVOKE) {} (?:TO|FROM) {}'.format(IDENT, IDENT),
+                     sql)
+        if m:
+            member = (_ident(m.group(3)), _ident(m.group(2)))
+            if m.group(1) == 'GRANT':
+                catalog.members.add(member)
+            else:
+                catalog.members.discard(member)
+            return
+        m = re.match(r'CREATE DATABASE {}'.format(IDENT), sql)
+        if m:
+            if _ident(m.group(1)) in catalog.databases:
+                raise psycopg2.IntegrityError('database exists')
+            catalog.databases.add(_ident(m.group(1)))
+            return
+        m = re.match(r'GRANT CONNECT ON DATABASE {} TO {}'.format(IDENT,
+                                                                  IDENT), sql)
+        if m:
+            catalog.connect.add((_ident(m.group(1)), _ident(m.group(2))))
+            return
+        m = re.match(r'CREATE EXTENSION IF NOT EXISTS {}'.format(IDENT), sql)
+        if m:
+            catalog.extensions.setdefault(self.con.dbname, set()).add(
+                _ident(m.group(1)))
+            return
+        if 'aclexplode' in sql:
+            self.rows = ([('role', r, None) for r in sorted(catalog.roles)] +
+                         [('member', m, r) for m, r in
+                          sorted(catalog.members)] +
+                         [('database', d, None) for d in
+                          sorted(catalog.databases)] +
+                         [('connect', d, g) for d, g in
+                          sorted(catalog.connect)])
+        elif 'pg_extension' in sql:
+            self.rows = [(e,) for e in sorted(
+                catalog.extensions.get(self.con.dbname, ()))]
+        elif 'max_connections' in sql:
+            self.rows = [(100,)]
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+
+class RecordingConnection(object):
+    def __init__(self, dsn):
+        MODEL.count('connections')
+        self.dsn = dsn
+        self.dbname = ConnectionString(dsn)['dbname']
+        self.autocommit = False
+        self.closed = False
+
+    def cursor(self, *args, **kw):
+        return RecordingCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+def install():
+    '''Register the fake modules in sys.modules.'''
+    charmhelpers = _module('charmhelpers')
+    core = _module('charmhelpers.core')
+    core.hookenv = _hookenv()
+    core.host = _host()
+    core.unitdata = _unitdata()
+    charmhelpers.core = core
+    _reactive()
+    _module('charms.leadership', leader_get=leader_get,
+            leader_set=leader_set)
+    _module('relations')
+    _module('relations.pgsql')
+    _module('relations.pgsql.requires', ConnectionString=ConnectionString,
+            ConnectionStrings=ConnectionStrings)
+
+
+def use(model):
+    '''Direct hook tools and backend calls to model.'''
+    global MODEL
+    MODEL = model
+
+
+def patch_connections(connections):
+    '''Make the charm's ConnectionCache open recorded connections.'''
+    class RecordingCache(connections.ConnectionCache):
+        def get(self, dsn):
+            with self._lock:
+                con = self._connections.get(dsn)
+                if con is None:
+                    con = self._connections[dsn] = RecordingConnection(dsn)
+                    self.opened += 1
+            return con
+    connections.ConnectionCache = RecordingCache
@@ -81,12 +81,13 @@ class TestDeployment(unittest.TestCase):
                 rel = json.loads(raw)
 
                 master = rel.get('master')
-                # Technically, standbys is a newline separated list of
-                # connection strings but pgbouncer only ever advertises
-                # a single endpoint (multiple standbys will be load balanced
-                # using haproxy).
-                standby = rel.get('standbys')
-                conn_str[unit][relname] = dict(master=master, standby=standby)
+                # standbys is a newline separated list of connection
+                # strings, one per backend standby. The first is the
+                # one this client should prefer.
+                standbys = rel.get('standbys').splitlines()
+                conn_str[unit][relname] = dict(master=master,
+                                               standby=standbys[0],
+                                               standbys=standbys)
         cls.conn_str = conn_str
 
     _needs_cleanup = False
@@ -140,6 +141,15 @@ class TestDeployment(unittest.TestCase):
         cur.execute('SELECT rolsuper from pg_roles where rolname=session_user')
         self.assertFalse(cur.fetchone()[0])
 
+    def test_every_standby(self):
+        for unit in self.conn_str.keys():
+            for standby in self.conn_str[unit]['db']['standbys']:
+                with self.subTest(unit=unit, standby=standby):
+                    con = psycopg2.connect(standby)
+                    cur = con.cursor()
+                    cur.execute('SELECT pg_is_in_recovery()')
+                    self.assertTrue(cur.fetchone()[0])
+
     def test_client_config(self):
         self.configure('psql',
                        roles='fred', database='newdb', extensions='unaccent')